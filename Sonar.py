@@ -10,10 +10,56 @@ import serial.tools.list_ports # For COM port detection
 import functools
 import operator
 import json
+import argparse
+import collections
+import threading
+import asyncio
+import socket
+import struct
+import sqlite3
+import tempfile
 from pygame.locals import *
 from geopy.distance import geodesic
 from geopy.point import Point
 
+# --- Command-line Arguments ---
+def nmea_sim_output_arg(text):
+    """--nmea-sim-output: 'inproc', 'serial' or 'udp:[HOST:]PORT', the last one as a (host, port) tuple."""
+    if text in ('inproc', 'serial'):
+        return text
+    kind, _, address = text.partition(':')
+    host, _, port = address.rpartition(':')
+    if kind == 'udp' and port.isdigit() and 0 < int(port) < 65536:
+        return (host or '127.0.0.1', int(port))
+    raise argparse.ArgumentTypeError(f"destino no válido '{text}' (inproc, serial o udp:[HOST:]PUERTO)")
+
+arg_parser = argparse.ArgumentParser(description="Simulador de sonar de barrido")
+arg_parser.add_argument('--scenario', metavar='FICHERO',
+                        help="Fichero JSON de escenario (cardúmenes, fondo, barco propio, opciones de menú)")
+arg_parser.add_argument('--bench-nmea', metavar='N', type=int, nargs='?', const=200000, default=None,
+                        help="Mide el rendimiento del procesado NMEA con N sentencias y sale")
+arg_parser.add_argument('--bench-peces', metavar='N', type=int, nargs='?', const=100000, default=None,
+                        help="Mide el tiempo por frame del modelo de partículas con un cardumen de N peces y sale")
+arg_parser.add_argument('--replay', metavar='FICHERO',
+                        help="Reproduce un registro NMEA (grabado con GRABAR NMEA o NMEA plano) como entrada")
+arg_parser.add_argument('--replay-speed', metavar='X', default='1',
+                        help="Velocidad de reproducción: 1 (tiempo real), 2, 10... o 'max' (lo más rápido posible)")
+arg_parser.add_argument('--replay-start', metavar='S', type=float, default=0.0,
+                        help="Segundos desde el inicio del registro en los que empieza la reproducción")
+arg_parser.add_argument('--nmea-sim', metavar='HZ', type=float,
+                        help="Genera NMEA sintético de la derrota del escenario a HZ posiciones por segundo")
+arg_parser.add_argument('--nmea-sim-output', metavar='DESTINO', type=nmea_sim_output_arg, default='inproc',
+                        help="Salida del generador: inproc, serial (puerto abierto, p.ej. loop://) o udp:[HOST:]PUERTO")
+arg_parser.add_argument('--nmea-sim-corrupt', metavar='FRACCION', type=float, default=0.0,
+                        help="Fracción de sentencias generadas con checksum erróneo")
+arg_parser.add_argument('--sim-interference', action='store_true',
+                        help="Demostración: añade interferencia simulada de otros sonares para probar el rechazo de interferencias")
+arg_parser.add_argument('--bench-ingest', action='store_true',
+                        help="Mide la capacidad de ingesta NMEA (en proceso, serie loop:// y UDP) y sale")
+arg_parser.add_argument('--bench-escenario', action='store_true',
+                        help="Mide el arranque de un escenario de 10.000 cardúmenes con un fondo de 100 MB y sale")
+cli_args, _ = arg_parser.parse_known_args()
+# --- End Command-line Arguments ---
 
 # Inicializamos el motor de juegos
 pygame.init()
@@ -23,36 +69,77 @@ except pygame.error:
     print("Warning: No audio device found. Audio disabled.")
 
 # --- COM Port Detection Utility ---
+# Optional: device-change notifications on Linux. Without it the scanner just polls.
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+COM_PORT_SCAN_INTERVAL_S = 5.0
+
 def get_available_com_ports():
     ports = serial.tools.list_ports.comports()
     available_ports = [port.device for port in ports]
 #print(f"Available COM ports: {available_ports}") # For debugging
     return available_ports
+
+class ComPortScanner:
+    """
+    Enumerates the serial ports on a background thread, every COM_PORT_SCAN_INTERVAL_S
+    and whenever a tty device is added or removed (if pyudev is available), so the
+    menu can read the cached list instantly.
+    """
+    def __init__(self, interval_s=COM_PORT_SCAN_INTERVAL_S):
+        self.interval_s = interval_s
+        self._ports = ()
+        self._wake = threading.Event()
+        self._observer = None
+        if pyudev is not None:
+            try:
+                monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+                monitor.filter_by('tty')
+                self._observer = pyudev.MonitorObserver(monitor, callback=lambda device: self._wake.set(), daemon=True)
+                self._observer.start()
+            except Exception as e:
+                print(f"ADVERTENCIA: Sin avisos de conexión de puertos (pyudev): {e}")
+                self._observer = None
+        self._thread = threading.Thread(target=self._run, name="com-port-scanner", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._ports = tuple(get_available_com_ports()) # Replaced whole: safe to read from the UI
+            except Exception as e:
+                print(f"ADVERTENCIA: Error al enumerar los puertos COM: {e}")
+            self._wake.wait(self.interval_s)
+            self._wake.clear()
+
+    def ports(self):
+        """Last enumerated port list (never blocks)."""
+        return list(self._ports)
+
+    def rescan(self):
+        """Asks for a fresh enumeration without waiting for it."""
+        self._wake.set()
+
+com_port_scanner = ComPortScanner()
 # --- End COM Port Detection Utility ---
 
 # Updated initial serial state:
 puerto = None  # Will store the currently connected port device string
 baudios = 9600  # Default baud rate, can be changed by user
-ser = None
-serial_port_available = False # Will be True only after a successful connection by user
+serial_port_available = False # True while serial_manager has the port open (refreshed once per frame)
 
 
 # Initialize NMEA data variables
-latitude_str = "N/A"
-longitude_str = "N/A"
+# The navigation data itself lives in nmea_state (NmeaState, below); these numeric
+# copies are refreshed once per frame for the rest of the program.
 current_ship_lat_deg = None # Numerical latitude in decimal degrees
 current_ship_lon_deg = None # Numerical longitude in decimal degrees
-
-speed_str = "N/A"
-heading_str = "N/A"
 current_ship_heading = 0.0  # Initialize current ship heading
-zda_time_str = "N/A"
-zda_date_str = "N/A"
 # rot_str = "N/A" # ROT string removed
 
-att_pitch_str = "N/A"
-att_roll_str = "N/A"
-
 def is_valid_nmea_checksum(sentence):
     """
     Validates the checksum of an NMEA sentence.
@@ -67,7 +154,7 @@ def is_valid_nmea_checksum(sentence):
     if not checksum_part or not all(c in '0123456789ABCDEFabcdef' for c in checksum_part):
         return False
 
-    if data_part.startswith('$'):
+    if data_part[:1] in ('$', '!'): # '!' starts encapsulated sentences (AIS)
         data_part = data_part[1:]
 
     calculated_checksum = functools.reduce(operator.xor, (ord(c) for c in data_part), 0)
@@ -79,6 +166,40 @@ def is_valid_nmea_checksum(sentence):
 
     return calculated_checksum == received_checksum
 
+def nmea_checksum(body):
+    """XOR checksum of the characters between '$' and '*'."""
+    return functools.reduce(operator.xor, (ord(c) for c in body), 0)
+
+def build_nmea_sentence(body):
+    """Builds a complete '$...*hh' sentence from its body (without '$')."""
+    return f"${body}*{nmea_checksum(body):02X}"
+
+def _degrees_minutes(value_deg, decimals=4):
+    # Whole degrees and minutes rounded to the decimals shown, carrying 60.0000' into the degrees
+    a = abs(value_deg)
+    d = int(a)
+    minutes = round((a - d) * 60.0, decimals)
+    if minutes >= 60.0:
+        d, minutes = d + 1, 0.0
+    return d, minutes
+
+def format_nmea_lat(lat_deg):
+    """Decimal degrees -> ('ddmm.mmmm', 'N'|'S')."""
+    d, minutes = _degrees_minutes(lat_deg)
+    return f"{d:02d}{minutes:07.4f}", ('N' if lat_deg >= 0 else 'S')
+
+def format_nmea_lon(lon_deg):
+    """Decimal degrees -> ('dddmm.mmmm', 'E'|'W')."""
+    d, minutes = _degrees_minutes(lon_deg)
+    return f"{d:03d}{minutes:07.4f}", ('E' if lon_deg >= 0 else 'W')
+
+def format_lat_lon_dm(lat_deg, lon_deg):
+    """Decimal degrees -> on-screen strings ("dd° mm.mmm'N", "ddd° mm.mmm'W") for the cursor and marks."""
+    lat_d, lat_m = _degrees_minutes(lat_deg, 3)
+    lon_d, lon_m = _degrees_minutes(lon_deg, 3)
+    return (f"{lat_d:02d}° {lat_m:06.3f}'{'N' if lat_deg >= 0 else 'S'}",
+            f"{lon_d:03d}° {lon_m:06.3f}'{'E' if lon_deg >= 0 else 'W'}")
+
 # Helper function to convert NMEA lat/lon (DDDMM.MMMM, H) to decimal degrees
 def nmea_to_decimal_degrees(nmea_val_str, hemisphere):
     """Converts NMEA format latitude or longitude to decimal degrees."""
@@ -123,33 +244,74 @@ def format_minutes_to_3dp(raw_minutes_str):
         # Input is a whole number, e.g., "47"
         return f"{raw_minutes_str}.000"
 
-def parse_zda(sentence):
-    global zda_time_str, zda_date_str
-    try:
-        parts = sentence.split(',')
-        if len(parts) > 4:
-            utc_time_full = parts[1] # e.g., "172814.12"
-            day = parts[2]
-            month = parts[3]
-            year = parts[4]
-
-            # Format time: HH:MM:SS
-            if len(utc_time_full) >= 6:
-                h = utc_time_full[0:2]
-                m = utc_time_full[2:4]
-                s = utc_time_full[4:6]
-                zda_time_str = f"{h}:{m}:{s}"
-            else:
-                zda_time_str = "N/A" # Or keep old value
-
-            # Format date: dd/mm/yyyy
-            if day and month and year: # Ensure all parts are present
-                zda_date_str = f"{day}/{month}/{year}"
-            else:
-                zda_date_str = "N/A" # Or keep old value
-        # else: fields not present, keep old values or set to N/A
-    except Exception as e:
-        print(f"Error parsing ZDA sentence: {sentence} - {e}")
+# --- NMEA Records ---
+# Parsers return one of these small records (or None); NmeaState applies them.
+# 'source' is the sentence address (talker + type, e.g. 'GPGGA'), set by parse_nmea_sentence.
+class Fix:
+    """
+    Position fix (GGA, GLL, RMC). lat/lon are None if the fields could not be converted.
+    quality ranks the fix (see FIX_QUALITY_*): 0 = receiver says invalid, None = not stated.
+    sog_knots/cog_deg are the speed and course over ground of RMC (None if absent).
+    """
+    __slots__ = ('lat', 'lon', 'lat_field', 'lat_hemisphere', 'lon_field', 'lon_hemisphere', 'quality',
+                 'sog_knots', 'cog_deg', 'source')
+    def __init__(self, lat, lon, lat_field, lat_hemisphere, lon_field, lon_hemisphere, quality=None,
+                 sog_knots=None, cog_deg=None):
+        self.lat = lat
+        self.lon = lon
+        self.lat_field = lat_field
+        self.lat_hemisphere = lat_hemisphere
+        self.lon_field = lon_field
+        self.lon_hemisphere = lon_hemisphere
+        self.quality = quality
+        self.sog_knots = sog_knots
+        self.cog_deg = cog_deg
+        self.source = None
+
+class Heading:
+    """Ship's heading (HDT true, HDG magnetic sensor heading, or course over ground from VTG)."""
+    __slots__ = ('degrees', 'reference', 'source')
+    def __init__(self, degrees, reference):
+        self.degrees = degrees
+        self.reference = reference # 'T', 'M' or 'C' (COG)
+        self.source = None
+
+class Speed:
+    """
+    Speed in knots: over ground (VTG, with its course if present) or through the water (VHW log).
+    'field' keeps the text as received for display.
+    """
+    __slots__ = ('knots', 'field', 'course', 'source')
+    def __init__(self, knots, field, course=None):
+        self.knots = knots
+        self.field = field
+        self.course = course
+        self.source = None
+
+class Time:
+    """UTC time and date (ZDA), as the text fields received."""
+    __slots__ = ('hhmmss', 'day', 'month', 'year', 'source')
+    def __init__(self, hhmmss, day, month, year):
+        self.hhmmss = hhmmss
+        self.day = day
+        self.month = month
+        self.year = year
+        self.source = None
+
+class Attitude:
+    """Pitch and roll in degrees (PFEC,GPatt)."""
+    __slots__ = ('pitch', 'roll', 'source')
+    def __init__(self, pitch, roll):
+        self.pitch = pitch
+        self.roll = roll
+        self.source = None
+# --- End NMEA Records ---
+
+def parse_zda(fields):
+    # $--ZDA,hhmmss.ss,dd,mm,yyyy,...
+    if len(fields) > 4:
+        return Time(fields[1][:6], fields[2], fields[3], fields[4])
+    return None
 
 def parse_rot(sentence): # This function is no longer called but kept for now
     global rot_str
@@ -178,190 +340,1390 @@ def parse_rot(sentence): # This function is no longer called but kept for now
         print(f"Generic error parsing ROT sentence: {sentence} - {e}")
         rot_str = "N/A"
 
-def parse_fec_gpatt(sentence):
-    global att_pitch_str, att_roll_str
+def _parse_optional_float(field, name, fields):
+    if not field:
+        return None
     try:
-        parts = sentence.split(',')
-        if len(parts) > 4:  
-            pitch_val_str = parts[3]
-            roll_val_full_str = parts[4]  
-            roll_val_str = roll_val_full_str.split('*')[0]
-            if pitch_val_str:
-                try:
-                    float(pitch_val_str) 
-                    att_pitch_str = f"{pitch_val_str}°"
-                except ValueError:
-                    att_pitch_str = "N/A" 
-                    print(f"Invalid pitch value: {pitch_val_str} in {sentence}")
-            else:
-                att_pitch_str = "N/A"
-            if roll_val_str: 
-                try:
-                    float(roll_val_str) 
-                    att_roll_str = f"{roll_val_str}°"
-                except ValueError:
-                    att_roll_str = "N/A" 
-                    print(f"Invalid roll value: {roll_val_str} in {sentence}")
-            else:
-                att_roll_str = "N/A"
-    except Exception as e:
-        print(f"Error parsing PFEC,GPatt sentence: {sentence} - {e}")
+        return float(field)
+    except ValueError:
+        print(f"Invalid {name} value: {field} in {','.join(fields)}")
+        return None
+
+def parse_fec_gpatt(fields):
+    # $PFEC,GPatt,yaw,pitch,roll
+    if len(fields) > 4:
+        return Attitude(_parse_optional_float(fields[3], 'pitch', fields),
+                        _parse_optional_float(fields[4], 'roll', fields))
+    return None
+
+# Fix quality ranks (higher is better). GGA states a quality digit, RMC and GLL a status and
+# (NMEA 2.3+) a mode indicator; 0 means the receiver flags the position as invalid.
+FIX_QUALITY_GGA = {'0': 0, '1': 2, '2': 3, '3': 2, '4': 5, '5': 4, '6': 1, '7': 1, '8': 0, '9': 3}
+FIX_QUALITY_MODE = {'A': 2, 'D': 3, 'P': 3, 'R': 5, 'F': 4, 'E': 1, 'M': 1, 'S': 0, 'N': 0}
+FIX_QUALITY_VALID = 2 # Status 'A' without a mode indicator
+
+def _make_fix(lat_field, lat_hemisphere, lon_field, lon_hemisphere, quality):
+    return Fix(nmea_to_decimal_degrees(lat_field, lat_hemisphere),
+               nmea_to_decimal_degrees(lon_field, lon_hemisphere),
+               lat_field, lat_hemisphere, lon_field, lon_hemisphere, quality)
+
+def _status_quality(status, mode):
+    if status.upper() == 'V':
+        return 0
+    return FIX_QUALITY_MODE.get(mode.upper(), FIX_QUALITY_VALID) if mode else FIX_QUALITY_VALID
+
+def parse_gll(fields):
+    # $--GLL,lat,N,lon,E,hhmmss,status,mode
+    quality = _status_quality(fields[6] if len(fields) > 6 else '', fields[7] if len(fields) > 7 else '')
+    if len(fields) > 4 and fields[1] and fields[2] and fields[3] and fields[4]:
+        return _make_fix(fields[1], fields[2], fields[3], fields[4], quality)
+    return None
+
+def parse_gga(fields):
+    # $--GGA,hhmmss,lat,N,lon,E,quality,...
+    quality = FIX_QUALITY_GGA.get(fields[6], FIX_QUALITY_VALID) if len(fields) > 6 and fields[6] else None
+    if len(fields) > 5 and fields[2] and fields[3] and fields[4] and fields[5]:
+        return _make_fix(fields[2], fields[3], fields[4], fields[5], quality)
+    return None
+
+def parse_rmc(fields):
+    # $--RMC,hhmmss,status,lat,N,lon,E,sog,cog,date,var,E/W,mode
+    quality = _status_quality(fields[2] if len(fields) > 2 else '', fields[12] if len(fields) > 12 else '')
+    if len(fields) > 6 and fields[3] and fields[4] and fields[5] and fields[6]:
+        fix = _make_fix(fields[3], fields[4], fields[5], fields[6], quality)
+        if len(fields) > 8:
+            fix.sog_knots = _parse_optional_float(fields[7], 'RMC speed', fields)
+            fix.cog_deg = _parse_optional_float(fields[8], 'RMC course', fields)
+        return fix
+    return None
+
+def parse_vtg(fields):
+    # $--VTG,cog,T,cog,M,sog_kn,N,sog_kmh,K
+    if len(fields) > 5 and fields[5]:
+        return Speed(_parse_optional_float(fields[5], 'VTG speed', fields), fields[5],
+                     _parse_optional_float(fields[1], 'VTG course', fields))
+    return None
+
+def parse_vhw(fields):
+    # $--VHW,hdg,T,hdg,M,stw_kn,N,stw_kmh,K (speed through the water from the log)
+    if len(fields) > 5 and fields[5]:
+        return Speed(_parse_optional_float(fields[5], 'VHW speed', fields), fields[5])
+    return None
+
+def parse_hdt(fields):
+    # $--HDT,heading,T
+    if len(fields) > 1 and fields[1]:
+        degrees = _parse_optional_float(fields[1], 'HDT heading', fields)
+        if degrees is not None:
+            return Heading(degrees, 'T')
+    return None
+
+def parse_hdg(fields):
+    # $--HDG,heading,deviation,E/W,variation,E/W
+    if len(fields) > 1 and fields[1]:
+        degrees = _parse_optional_float(fields[1], 'HDG heading', fields)
+        if degrees is not None:
+            return Heading(degrees, 'M')
+    return None
+
+# --- AIS (!AIVDM / !AIVDO) ---
+# AIS payloads are 6-bit armored ASCII. Field layouts are tables of (name, start bit, length, kind)
+# with kind 'u' unsigned, 'i' signed (two's complement) or 't' 6-bit text, per ITU-R M.1371.
+AIS_SIXBIT = bytes.maketrans(
+    bytes(range(48, 88)) + bytes(range(96, 120)),
+    bytes(range(0, 40)) + bytes(range(40, 64)))
+AIS_TEXT_CHARS = "@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_ !\"#$%&'()*+,-./0123456789:;<=>?"
+
+_AIS_CLASS_A_POSITION = (
+    ('status', 38, 4, 'u'), ('sog', 50, 10, 'u'), ('lon', 61, 28, 'i'), ('lat', 89, 27, 'i'),
+    ('cog', 116, 12, 'u'), ('heading', 128, 9, 'u'))
+_AIS_CLASS_B_POSITION = (
+    ('sog', 46, 10, 'u'), ('lon', 57, 28, 'i'), ('lat', 85, 27, 'i'),
+    ('cog', 112, 12, 'u'), ('heading', 124, 9, 'u'))
+AIS_LAYOUTS = {
+    1: _AIS_CLASS_A_POSITION,
+    2: _AIS_CLASS_A_POSITION,
+    3: _AIS_CLASS_A_POSITION,
+    5: (('callsign', 70, 42, 't'), ('name', 112, 120, 't'), ('shiptype', 232, 8, 'u'),
+        ('to_bow', 240, 9, 'u'), ('to_stern', 249, 9, 'u')),
+    18: _AIS_CLASS_B_POSITION,
+    19: _AIS_CLASS_B_POSITION + (('name', 143, 120, 't'), ('shiptype', 263, 8, 'u'),
+                                 ('to_bow', 271, 9, 'u'), ('to_stern', 280, 9, 'u')),
+    (24, 0): (('name', 40, 120, 't'),),
+    (24, 1): (('shiptype', 40, 8, 'u'), ('callsign', 90, 42, 't'),
+              ('to_bow', 132, 9, 'u'), ('to_stern', 141, 9, 'u')),
+}
+# Raw values meaning "not available"; they are dropped from the report.
+AIS_NOT_AVAILABLE = {'sog': 1023, 'lon': 181 * 600000, 'lat': 91 * 600000, 'cog': 3600, 'heading': 511,
+                     'shiptype': 0, 'to_bow': 0, 'to_stern': 0}
+AIS_SCALE = {'sog': 0.1, 'lon': 1 / 600000.0, 'lat': 1 / 600000.0, 'cog': 0.1}
+AIS_MAX_PENDING_FRAGMENTS = 64
+
+class AisReport:
+    """One decoded AIS message: the MMSI and the available fields of its layout (already scaled)."""
+    __slots__ = ('mmsi', 'msg_type', 'fields', 'own', 'source')
+    def __init__(self, mmsi, msg_type, fields, own):
+        self.mmsi = mmsi
+        self.msg_type = msg_type
+        self.fields = fields
+        self.own = own # True for !AIVDO (our own transponder)
+        self.source = None
+
+def decode_ais_payload(payload, fill_bits=0, own=False):
+    """De-armors a complete payload and decodes it with its layout; None for unsupported types."""
+    value = 0
+    for sixbit in payload.encode('ascii').translate(AIS_SIXBIT):
+        value = (value << 6) | (sixbit & 0x3F)
+    nbits = 6 * len(payload) - fill_bits
+    value >>= fill_bits
+
+    def field(start, length):
+        return (value >> (nbits - start - length)) & ((1 << length) - 1)
+
+    if nbits < 40:
+        return None
+    msg_type = field(0, 6)
+    layout = AIS_LAYOUTS.get(msg_type if msg_type != 24 else (24, field(38, 2)))
+    if layout is None:
+        return None
+    fields = {}
+    for name, start, length, kind in layout:
+        if start + length > nbits: # Truncated message: keep what arrived
+            break
+        raw = field(start, length)
+        if kind == 't':
+            text = ''.join(AIS_TEXT_CHARS[(raw >> shift) & 0x3F] for shift in range(length - 6, -1, -6))
+            text = text.split('@', 1)[0].strip()
+            if text:
+                fields[name] = text
+            continue
+        if kind == 'i' and raw & (1 << (length - 1)):
+            raw -= 1 << length
+        if AIS_NOT_AVAILABLE.get(name) == raw:
+            continue
+        fields[name] = raw * AIS_SCALE[name] if name in AIS_SCALE else raw
+    return AisReport(field(8, 30), msg_type, fields, own)
+
+class AisFragmentAssembler:
+    """
+    Joins multi-sentence AIS messages (e.g. type 5) by talker, channel and sequential message ID.
+    The serial and network reader threads both parse, so the pending parts are kept under a lock.
+    """
+    def __init__(self):
+        self.pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, fields):
+        # !--VDM,count,number,seq_id,channel,payload,fill
+        count, number = int(fields[1]), int(fields[2])
+        payload, fill_bits = fields[5], int(fields[6] or 0)
+        if count == 1:
+            return payload, fill_bits
+        with self._lock:
+            return self._add_part((fields[0], fields[3], fields[4]), count, number, payload, fill_bits)
+
+    def _add_part(self, key, count, number, payload, fill_bits):
+        if number == 1 or key not in self.pending:
+            if number != 1:
+                return None # Tail of a message whose first part was lost
+            if len(self.pending) >= AIS_MAX_PENDING_FRAGMENTS:
+                self.pending.clear()
+            self.pending[key] = [payload]
+            return None
+        parts = self.pending[key]
+        if number != len(parts) + 1: # Out of order or missing part: drop the message
+            del self.pending[key]
+            return None
+        parts.append(payload)
+        if number < count:
+            return None
+        del self.pending[key]
+        return ''.join(parts), fill_bits
+
+ais_fragments = AisFragmentAssembler()
+
+def parse_vdm(fields):
+    # !--VDM,count,number,seq_id,channel,payload,fill (VDO: the same, from our own transponder)
+    if len(fields) < 7 or not fields[5]:
+        return None
+    message = ais_fragments.add(fields)
+    if message is None:
+        return None
+    return decode_ais_payload(message[0], message[1], own=fields[0].endswith('VDO'))
+
+AIS_VESSEL_TIMEOUT_S = 360.0 # Class A/B at anchor report every 3 min; drop after two missed reports
+AIS_TABLE_INITIAL_CAPACITY = 256
+
+class AisVesselTable:
+    """
+    Vessels heard on AIS, one row per MMSI in parallel NumPy columns (NaN = unknown) so the
+    whole fleet is projected onto the PPI at once. Updates touch a single row; 'version'
+    changes whenever a row is added, moved or removed.
+    """
+    NUMERIC_COLUMNS = ('lat', 'lon', 'sog', 'cog', 'heading', 'shiptype', 'to_bow', 'to_stern')
+
+    def __init__(self, capacity=AIS_TABLE_INITIAL_CAPACITY):
+        self.count = 0
+        self.version = 0
+        self.rows = {} # MMSI -> row
+        self.mmsi = np.zeros(capacity, dtype=np.int64)
+        self.last_seen = np.zeros(capacity)
+        self.columns = {name: np.full(capacity, np.nan) for name in self.NUMERIC_COLUMNS}
+        self.names = [None] * capacity
+        self.callsigns = [None] * capacity
+
+    def _grow(self):
+        capacity = 2 * len(self.mmsi)
+        self.mmsi = np.resize(self.mmsi, capacity)
+        self.last_seen = np.resize(self.last_seen, capacity)
+        for name, column in self.columns.items():
+            grown = np.full(capacity, np.nan)
+            grown[:self.count] = column[:self.count]
+            self.columns[name] = grown
+        self.names.extend([None] * (capacity - len(self.names)))
+        self.callsigns.extend([None] * (capacity - len(self.callsigns)))
+
+    def update(self, report, now):
+        row = self.rows.get(report.mmsi)
+        if row is None:
+            if self.count == len(self.mmsi):
+                self._grow()
+            row = self.count
+            self.count += 1
+            self.rows[report.mmsi] = row
+            self.mmsi[row] = report.mmsi
+            for column in self.columns.values():
+                column[row] = np.nan
+            self.names[row] = self.callsigns[row] = None
+            self.version += 1
+        self.last_seen[row] = now
+        for name, value in report.fields.items():
+            column = self.columns.get(name)
+            if column is not None:
+                column[row] = value
+            elif name == 'name':
+                self.names[row] = value
+            elif name == 'callsign':
+                self.callsigns[row] = value
+        if 'lat' in report.fields or 'lon' in report.fields:
+            self.version += 1
+
+    def expire(self, now, timeout_s=AIS_VESSEL_TIMEOUT_S):
+        """Removes vessels not heard for timeout_s (the last row is moved into each gap)."""
+        stale = np.nonzero(self.last_seen[:self.count] < now - timeout_s)[0]
+        for row in stale[::-1]:
+            last = self.count - 1
+            del self.rows[int(self.mmsi[row])]
+            if row != last:
+                self.mmsi[row] = self.mmsi[last]
+                self.last_seen[row] = self.last_seen[last]
+                for column in self.columns.values():
+                    column[row] = column[last]
+                self.names[row], self.callsigns[row] = self.names[last], self.callsigns[last]
+                self.rows[int(self.mmsi[row])] = row
+            self.count = last
+        if len(stale):
+            self.version += 1
+
+    def project(self, ship_lat, ship_lon, ship_hdg_deg, cc_x, cc_y, disp_radius_px, range_m):
+        """
+        Screen positions of every vessel with a position, head-up around the own ship like the
+        geo markers. Returns (rows, xs, ys, course_deg) for the vessels inside the range ring;
+        course_deg is the heading (or COG) relative to our own, NaN if neither is known.
+        """
+        n = self.count
+        lat, lon = self.columns['lat'][:n], self.columns['lon'][:n]
+        rows = np.nonzero(~(np.isnan(lat) | np.isnan(lon)))[0]
+        if ship_lat is None or ship_lon is None or not len(rows) or range_m <= 0:
+            return rows[:0], np.empty(0), np.empty(0), np.empty(0)
+        x_px, y_px = geo_to_ppi_xy(lat[rows], lon[rows], ship_lat, ship_lon, ship_hdg_deg,
+                                   disp_radius_px / range_m)
+        inside = x_px * x_px + y_px * y_px <= disp_radius_px * disp_radius_px
+        rows, x_px, y_px = rows[inside], x_px[inside], y_px[inside]
+        course = self.columns['heading'][rows]
+        course = np.where(np.isnan(course), self.columns['cog'][rows], course)
+        return rows, cc_x + x_px, cc_y + y_px, (course - ship_hdg_deg) % 360.0
+
+ais_vessels = AisVesselTable()
+# --- End AIS ---
+
+# Parsers keyed by sentence type; the two-letter talker ID (GP, GN, GL, HE...) is ignored.
+# Proprietary sentences ('P' + manufacturer) are keyed by address and first field.
+NMEA_PARSERS = {
+    'GLL': parse_gll,
+    'GGA': parse_gga,
+    'RMC': parse_rmc,
+    'VTG': parse_vtg,
+    'VHW': parse_vhw,
+    'HDT': parse_hdt,
+    'HDG': parse_hdg,
+    'ZDA': parse_zda,
+    'PFEC,GPatt': parse_fec_gpatt,
+    'VDM': parse_vdm,
+    'VDO': parse_vdm,
+}
 
-def parse_gll(sentence):
-    global latitude_str, longitude_str, current_ship_lat_deg, current_ship_lon_deg
+def parse_nmea_sentence(line):
+    """Splits one validated '$...' line and returns its record (or None if not handled)."""
+    star = line.find('*')
+    fields = (line[1:star] if star >= 0 else line[1:]).split(',')
+    address = fields[0]
+    if address[:1] == 'P':
+        parser = NMEA_PARSERS.get(f"{address},{fields[1]}" if len(fields) > 1 else address)
+    else:
+        parser = NMEA_PARSERS.get(address[2:])
+    if parser is None:
+        return None
     try:
-        parts = sentence.split(',')
-        if len(parts) > 6 and parts[6].upper() == 'V': 
-            return
-        if len(parts) > 4 and parts[1] and parts[2] and parts[3] and parts[4]:
-            lat_nmea_val = parts[1]
-            lat_hemisphere = parts[2]
-            lon_nmea_val = parts[3]
-            lon_hemisphere = parts[4]
-            if len(lat_nmea_val) >= 4:
-                degrees = lat_nmea_val[:2]
-                raw_minutes = lat_nmea_val[2:]
-                formatted_minutes = format_minutes_to_3dp(raw_minutes)
-                latitude_str = f"{degrees}° {formatted_minutes}{lat_hemisphere}"
-            else:
-                latitude_str = f"{lat_nmea_val} {lat_hemisphere}"
-            if len(lon_nmea_val) >= 5:
-                degrees = lon_nmea_val[:3]
-                raw_minutes = lon_nmea_val[3:]
-                formatted_minutes = format_minutes_to_3dp(raw_minutes)
-                longitude_str = f"{degrees}° {formatted_minutes}{lon_hemisphere}"
-            else:
-                longitude_str = f"{lon_nmea_val} {lon_hemisphere}"
-            current_ship_lat_deg = nmea_to_decimal_degrees(lat_nmea_val, lat_hemisphere)
-            current_ship_lon_deg = nmea_to_decimal_degrees(lon_nmea_val, lon_hemisphere)
-            if current_ship_lat_deg is None: latitude_str = "N/A (Parse Err)"
-            if current_ship_lon_deg is None: longitude_str = "N/A (Parse Err)"
+        record = parser(fields)
     except (IndexError, ValueError) as e:
-        print(f"Error parsing GLL sentence: {sentence} - {e}")
-        latitude_str = "N/A (Exception)"
-        longitude_str = "N/A (Exception)"
-        current_ship_lat_deg = None
-        current_ship_lon_deg = None
-
-def parse_gga(sentence):
-    global latitude_str, longitude_str, current_ship_lat_deg, current_ship_lon_deg
-    try:
-        parts = sentence.split(',')
-        if len(parts) > 6 and parts[6] == '0': 
+        print(f"Error parsing NMEA sentence: {line} - {e}")
+        if parser not in (parse_gll, parse_gga, parse_rmc):
+            return None
+        record = Fix(None, None, None, None, None, None) # Position no longer trusted
+    if record is not None:
+        record.source = address
+    return record
+
+def _format_nmea_coordinate(field, hemisphere, degree_digits):
+    # 'ddmm.mmmm' + 'N' -> "dd° mm.mmmN" (three decimals in the minutes)
+    if len(field) >= degree_digits + 2:
+        return f"{field[:degree_digits]}° {format_minutes_to_3dp(field[degree_digits:])}{hemisphere}"
+    return f"{field} {hemisphere}"
+
+# --- Sensor Selection ---
+# Several instruments often report the same quantity (GPS and a second GNSS, gyro and compass,
+# log and GPS speed). Each (quantity, sentence address) is tracked as a source and only the
+# records of the best live source reach NmeaState.
+SENSOR_STALE_S = 3.0              # A selected source silent for longer than this is failed over
+SENSOR_MIN_COG_SPEED_KN = 1.0     # Below this the VTG course is too noisy to use as heading
+SENSOR_RATE_SMOOTHING = 0.2
+SENSOR_QUANTITY_NAMES = {'position': 'posición', 'heading': 'rumbo', 'speed': 'velocidad', 'attitude': 'actitud'}
+
+# SISTEMA > DATOS NAV: position talkers in order of preference ('*' = any other talker).
+# ESTIMA prefers integrated navigation systems (dead reckoning) over the raw receivers.
+GNSS_TALKERS = ('GP', 'GN', 'GL', 'GA', 'GB', 'BD')
+SENSOR_POSITION_TALKERS = {
+    'GPS': GNSS_TALKERS + ('*',),
+    'LC': ('LC',) + GNSS_TALKERS + ('*',),
+    'ESTIMA': ('IN', 'II') + GNSS_TALKERS + ('*',),
+    'TODOS': ('*',),
+}
+SENSOR_POSITION_SENTENCES = ('GGA', 'RMC', 'GLL')
+# SISTEMA > VELOC/RUMBO: sentence types in order of preference for heading and speed.
+# No current indicator sentence is parsed, so CORRNTE falls back to log and gyro.
+# The PPI is head-up, so the true heading (gyro/compass) always ranks ahead of the GPS
+# course over ground, which is only used when no heading sensor reports.
+SENSOR_HEADING_SENTENCES = {
+    'LOG/GIRO': ('HDT', 'HDG', 'VTG'),
+    'CORRNTE': ('HDT', 'HDG', 'VTG'),
+    'DATO NAV': ('HDT', 'HDG', 'VTG'),
+    'GIRO+NAV': ('HDT', 'HDG', 'VTG'),
+}
+SENSOR_SPEED_SENTENCES = {
+    'LOG/GIRO': ('VHW', 'VTG'),
+    'CORRNTE': ('VHW', 'VTG'),
+    'DATO NAV': ('VTG', 'VHW'),
+    'GIRO+NAV': ('VTG', 'VHW'),
+}
+
+class SensorSource:
+    """Timestamp, rate and last quality of one (quantity, sentence address) source."""
+    __slots__ = ('quantity', 'address', 'rank', 'quality', 'last_time', 'rate_hz', 'count')
+    def __init__(self, quantity, address, rank):
+        self.quantity = quantity
+        self.address = address
+        self.rank = rank # Lower is preferred
+        self.quality = None
+        self.last_time = None
+        self.rate_hz = 0.0
+        self.count = 0
+
+    def note(self, now, quality):
+        if self.last_time is not None and now > self.last_time:
+            rate = 1.0 / (now - self.last_time)
+            self.rate_hz += SENSOR_RATE_SMOOTHING * (rate - self.rate_hz) if self.rate_hz else rate
+        self.last_time = now
+        self.quality = quality
+        self.count += 1
+
+class SensorManager:
+    """
+    Picks the source of each quantity (position, heading, speed, attitude). An update is
+    compared with the currently selected source only, so selection is O(1): it takes over if
+    it ranks better (priority scheme, then quality), or if the selected one went stale or
+    reported an invalid fix.
+    """
+    def __init__(self):
+        self.sources = {} # (quantity, address) -> SensorSource
+        self.selected = {}
+        self.scheme = None
+        self.ranks = {} # No preference until set_scheme() applies the menu options
+
+    def set_scheme(self, speed_course, nav_data):
+        """Applies the VELOC/RUMBO and DATOS NAV menu choices (cheap if unchanged)."""
+        scheme = (speed_course, nav_data)
+        if self.scheme == scheme:
             return
-        if len(parts) > 5 and parts[2] and parts[3] and parts[4] and parts[5]:
-            lat_nmea_val = parts[2]
-            lat_hemisphere = parts[3]
-            lon_nmea_val = parts[4]
-            lon_hemisphere = parts[5]
-            if len(lat_nmea_val) >= 4:
-                degrees = lat_nmea_val[:2]
-                raw_minutes = lat_nmea_val[2:]
-                formatted_minutes = format_minutes_to_3dp(raw_minutes)
-                latitude_str = f"{degrees}° {formatted_minutes}{lat_hemisphere}"
-            else:
-                latitude_str = f"{lat_nmea_val} {lat_hemisphere}"
-            if len(lon_nmea_val) >= 5:
-                degrees = lon_nmea_val[:3]
-                raw_minutes = lon_nmea_val[3:]
-                formatted_minutes = format_minutes_to_3dp(raw_minutes)
-                longitude_str = f"{degrees}° {formatted_minutes}{lon_hemisphere}"
-            else:
-                longitude_str = f"{lon_nmea_val} {lon_hemisphere}"
-            current_ship_lat_deg = nmea_to_decimal_degrees(lat_nmea_val, lat_hemisphere)
-            current_ship_lon_deg = nmea_to_decimal_degrees(lon_nmea_val, lon_hemisphere)
-            if current_ship_lat_deg is None: latitude_str = "N/A (Parse Err)"
-            if current_ship_lon_deg is None: longitude_str = "N/A (Parse Err)"
-    except (IndexError, ValueError) as e:
-        print(f"Error parsing GGA sentence: {sentence} - {e}")
-        latitude_str = "N/A (Exception)"
-        longitude_str = "N/A (Exception)"
-        current_ship_lat_deg = None
-        current_ship_lon_deg = None
-
-def parse_rmc(sentence):
-    global latitude_str, longitude_str, current_ship_lat_deg, current_ship_lon_deg
+        self.scheme = scheme
+        talkers = SENSOR_POSITION_TALKERS.get(nav_data, SENSOR_POSITION_TALKERS['TODOS'])
+        self.ranks = {
+            'position': ({t: i for i, t in enumerate(talkers)}, {s: i for i, s in enumerate(SENSOR_POSITION_SENTENCES)}),
+            'heading': ({}, {s: i for i, s in enumerate(SENSOR_HEADING_SENTENCES.get(speed_course, ()))}),
+            'speed': ({}, {s: i for i, s in enumerate(SENSOR_SPEED_SENTENCES.get(speed_course, ()))}),
+        }
+        for source in self.sources.values():
+            source.rank = self._rank(source.quantity, source.address)
+        self.selected = {} # Re-elected by the next update of each quantity
+
+    def _rank(self, quantity, address):
+        talker_ranks, sentence_ranks = self.ranks.get(quantity, ({}, {}))
+        sentence_rank = sentence_ranks.get(address[2:], len(sentence_ranks))
+        if not talker_ranks:
+            return sentence_rank
+        talker_rank = talker_ranks.get(address[:2], talker_ranks.get('*', len(talker_ranks)))
+        return talker_rank * (len(sentence_ranks) + 1) + sentence_rank
+
+    def offer(self, quantity, address, quality, now):
+        """Records an update and returns True if it comes from the source to use."""
+        key = (quantity, address)
+        source = self.sources.get(key)
+        if source is None:
+            source = self.sources[key] = SensorSource(quantity, address, self._rank(quantity, address))
+        source.note(now, quality)
+        current = self.selected.get(quantity)
+        if quality == 0: # The instrument itself flags the data as invalid
+            if current is source:
+                del self.selected[quantity]
+            return False
+        if current is source:
+            return True
+        if current is None or now - current.last_time > SENSOR_STALE_S or \
+           (source.rank, -(quality or 0)) < (current.rank, -(current.quality or 0)):
+            if current is not None:
+                print(f"INFO: Fuente de {SENSOR_QUANTITY_NAMES[quantity]}: {current.address} -> {address}")
+            self.selected[quantity] = source
+            return True
+        return False
+
+    def age(self, quantity, now):
+        """Seconds since the selected source of a quantity last reported (None if there is none)."""
+        source = self.selected.get(quantity)
+        return None if source is None else now - source.last_time
+
+    def ages(self, now):
+        return {quantity: now - source.last_time for quantity, source in self.selected.items()}
+# --- End Sensor Selection ---
+
+class NmeaState:
+    """
+    Latest navigation data applied from NMEA records. Numeric values are read directly;
+    display strings are only formatted when the data panel asks for them.
+    Records of a quantity reported by several instruments only apply if their source is the
+    one selected by 'sensors' (SensorManager).
+    """
+    _RECORD_SLOTS = {Fix: 'fix', Heading: 'heading', Speed: 'speed', Time: 'time', Attitude: 'attitude'}
+    _QUANTITIES = {Fix: 'position', Heading: 'heading', Speed: 'speed', Attitude: 'attitude'}
+
+    def __init__(self):
+        self.sensors = SensorManager()
+        self.reset()
+
+    def reset(self):
+        self.fix = None
+        self.heading = None
+        self.speed = None
+        self.time = None
+        self.attitude = None # Source statistics and selection survive a reset (see SensorManager)
+
+    def apply(self, record, now=None):
+        record_type = type(record)
+        quantity = self._QUANTITIES.get(record_type)
+        if quantity is None or record.source is None: # Time, or a record not from a sentence
+            setattr(self, self._RECORD_SLOTS[record_type], record)
+            return
+        if now is None:
+            now = time.monotonic()
+        quality = record.quality if record_type is Fix else None
+        if self.sensors.offer(quantity, record.source, quality, now):
+            setattr(self, self._RECORD_SLOTS[record_type], record)
+        if record_type is Speed and record.course is not None:
+            # Course over ground as a heading source (VELOC/RUMBO decides whether it is used)
+            usable = record.knots is not None and record.knots >= SENSOR_MIN_COG_SPEED_KN
+            if self.sensors.offer('heading', record.source, None if usable else 0, now):
+                course = Heading(record.course, 'C')
+                course.source = record.source
+                self.heading = course
+
+    @property
+    def lat(self):
+        return self.fix.lat if self.fix is not None else None
+
+    @property
+    def lon(self):
+        return self.fix.lon if self.fix is not None else None
+
+    @property
+    def heading_deg(self):
+        return self.heading.degrees if self.heading is not None else 0.0
+
+    @property
+    def speed_knots(self):
+        return self.speed.knots if self.speed is not None else None
+
+    def latitude_str(self):
+        if self.fix is None:
+            return "N/A"
+        if self.fix.lat_field is None:
+            return "N/A (Exception)"
+        if self.fix.lat is None:
+            return "N/A (Parse Err)"
+        return _format_nmea_coordinate(self.fix.lat_field, self.fix.lat_hemisphere, 2)
+
+    def longitude_str(self):
+        if self.fix is None:
+            return "N/A"
+        if self.fix.lon_field is None:
+            return "N/A (Exception)"
+        if self.fix.lon is None:
+            return "N/A (Parse Err)"
+        return _format_nmea_coordinate(self.fix.lon_field, self.fix.lon_hemisphere, 3)
+
+    def speed_str(self):
+        return f"{self.speed.field} kn" if self.speed is not None else "N/A"
+
+    def heading_str(self):
+        return f"{int(self.heading.degrees)}°" if self.heading is not None else "N/A"
+
+    def time_str(self):
+        t = self.time
+        if t is None or len(t.hhmmss) < 6:
+            return "N/A"
+        return f"{t.hhmmss[0:2]}:{t.hhmmss[2:4]}:{t.hhmmss[4:6]}"
+
+    def date_str(self):
+        t = self.time
+        if t is None or not (t.day and t.month and t.year):
+            return "N/A"
+        return f"{t.day}/{t.month}/{t.year}"
+
+    def pitch_str(self):
+        a = self.attitude
+        return f"{a.pitch}°" if a is not None and a.pitch is not None else "N/A"
+
+    def roll_str(self):
+        a = self.attitude
+        return f"{a.roll}°" if a is not None and a.roll is not None else "N/A"
+
+nmea_state = NmeaState()
+
+def dispatch_nmea_sentence(line, state=None):
+    """Parses one already validated NMEA line and applies its record to the state store."""
+    record = parse_nmea_sentence(line)
+    if record is not None:
+        apply_nmea_record(record, state)
+
+def apply_nmea_record(record, state=None):
+    """Applies one parsed record (from parse_nmea_sentence, possibly in a reader thread)."""
+    if type(record) is AisReport:
+        if not record.own: # Our own transponder (VDO) is the centre of the PPI already
+            ais_vessels.update(record, time.monotonic())
+    else:
+        (nmea_state if state is None else state).apply(record)
+
+def process_nmea_sentence(line, state=None):
+    """Validates one NMEA line and hands it to the dispatcher."""
+    if line and is_valid_nmea_checksum(line):
+        dispatch_nmea_sentence(line, state)
+    elif line:
+        # Optional: Print discarded sentences for debugging
+        print(f"Discarding corrupt NMEA sentence: {line}")
+
+# --- NMEA Throughput Benchmark (--bench-nmea) ---
+NMEA_BENCH_TARGET_PER_S = 50000
+
+def benchmark_nmea(num_sentences):
+    """Validates, parses and applies a typical mix of sentences and reports the throughput."""
+    bodies = [
+        "GPGGA,120000.00,4321.6000,N,00824.0000,W,1,08,0.9,10.0,M,50.0,M,,",
+        "GNRMC,120000.00,A,4321.6000,N,00824.0000,W,8.5,045.0,191026,,,A",
+        "GPVTG,045.0,T,,M,8.5,N,15.7,K,A",
+        "HEHDT,045.0,T",
+        "GPZDA,120000.00,19,10,2026,00,00",
+        "GLGLL,4321.6000,N,00824.0000,W,120000.00,A,A",
+        "HCHDG,044.0,,,1.0,W",
+        "PFEC,GPatt,045.0,+1.5,-2.0",
+    ]
+    lines = [build_nmea_sentence(b) for b in bodies]
+    lines = (lines * (num_sentences // len(lines) + 1))[:num_sentences]
+    state = NmeaState()
+    t0 = time.perf_counter()
+    for line in lines:
+        process_nmea_sentence(line, state)
+    elapsed = time.perf_counter() - t0
+    rate = num_sentences / elapsed if elapsed > 0 else float('inf')
+    verdict = "OK" if rate >= NMEA_BENCH_TARGET_PER_S else "POR DEBAJO DEL OBJETIVO"
+    print(f"INFO: NMEA: {num_sentences} sentencias en {elapsed * 1000:.0f} ms "
+          f"({rate:,.0f}/s, objetivo {NMEA_BENCH_TARGET_PER_S:,}/s: {verdict}). "
+          f"Última posición {state.latitude_str()} {state.longitude_str()}, rumbo {state.heading_str()}")
+    return rate
+
+if cli_args.bench_nmea:
+    benchmark_nmea(cli_args.bench_nmea)
+    raise SystemExit(0)
+# --- End NMEA Throughput Benchmark ---
+
+# --- NMEA Serial Reader Thread ---
+NMEA_QUEUE_MAXLEN = 2000      # Records kept while the UI is busy (oldest are dropped first)
+NMEA_READ_TIMEOUT_S = 0.1     # Serial read timeout, bounds how long stop() waits for the thread
+NMEA_MAX_PENDING_BYTES = 4096 # A partial line longer than this is garbage (NMEA lines are <= 82 chars)
+
+def queue_nmea_line(reader, line):
+    """
+    Checksum test and parsing of one received line, in the reader's own thread; the record
+    (if the sentence is handled) goes to reader.queue for apply_nmea_record() in the main loop.
+    Returns True for a good sentence, handled or not.
+    """
+    if not is_valid_nmea_checksum(line):
+        reader.corrupt += 1
+        return False
     try:
-        parts = sentence.split(',')
-        if len(parts) > 2 and parts[2].upper() == 'V':
+        record = parse_nmea_sentence(line)
+    except Exception as e: # A bad sentence must not end the reader thread
+        print(f"Error parsing NMEA sentence: {line} - {e}")
+        reader.corrupt += 1
+        return False
+    if record is None:
+        return True
+    if len(reader.queue) == reader.queue.maxlen:
+        reader.dropped += 1
+    reader.queue.append(record)
+    return True
+
+class NmeaSerialReader:
+    """
+    Background thread that drains a serial port continuously, splits it into lines,
+    validates and parses them and pushes the records into a bounded deque.
+    The main loop calls drain() once per frame, which never blocks.
+    """
+    def __init__(self, connection, maxlen=NMEA_QUEUE_MAXLEN):
+        self.connection = connection
+        self.queue = collections.deque(maxlen=maxlen) # append/popleft are thread-safe
+        self.dropped = 0   # Sentences lost because the queue was full
+        self.corrupt = 0   # Sentences discarded by the checksum test
+        self.error = None  # Exception that ended the thread (port unplugged...)
+        self.recorder = None # NmeaRecorder receiving every raw line, if recording is on
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="nmea-serial-reader", daemon=True)
+        self._thread.start()
+
+    @property
+    def alive(self):
+        return self._thread.is_alive()
+
+    def _run(self):
+        pending = b""
+        try:
+            while not self._stop_event.is_set():
+                chunk = self.connection.read(self.connection.in_waiting or 1)
+                if not chunk:
+                    continue
+                pending += chunk
+                if b"\n" not in chunk:
+                    if len(pending) > NMEA_MAX_PENDING_BYTES: # No line breaks: wrong baud rate or not NMEA
+                        self.corrupt += 1
+                        pending = b""
+                    continue
+                lines = pending.split(b"\n")
+                pending = lines.pop() # Incomplete last line waits for the next chunk
+                if len(pending) > NMEA_MAX_PENDING_BYTES:
+                    self.corrupt += 1
+                    pending = b""
+                now = time.monotonic()
+                recorder = self.recorder
+                for raw in lines:
+                    line = raw.decode('ascii', errors='replace').strip()
+                    if not line:
+                        continue
+                    if recorder is not None:
+                        recorder.record(now, line) # Raw, before the checksum test
+                    queue_nmea_line(self, line)
+        except Exception as e: # serial.SerialException, OSError, port closed under us...
+            if not self._stop_event.is_set():
+                self.error = e
+
+    def drain(self):
+        """Returns every record received since the last call."""
+        records = []
+        try:
+            while True:
+                records.append(self.queue.popleft())
+        except IndexError:
+            pass
+        return records
+
+    def stop(self):
+        self._stop_event.set()
+        cancel_read = getattr(self.connection, 'cancel_read', None)
+        if cancel_read is not None:
+            try:
+                cancel_read()
+            except Exception:
+                pass
+        self._thread.join(timeout=2 * NMEA_READ_TIMEOUT_S + 0.5)
+
+def open_nmea_serial(port, baud):
+    """
+    Opens the serial port and starts its reader thread. Raises serial.SerialException.
+    Besides device names, pyserial URLs such as 'loop://' or 'socket://host:port' work too.
+    """
+    connection = serial.serial_for_url(port, baud, timeout=NMEA_READ_TIMEOUT_S)
+    return connection, NmeaSerialReader(connection)
+
+def close_nmea_serial(connection, reader):
+    """Stops the reader thread (if any) and closes the port, ignoring errors."""
+    if reader is not None:
+        reader.stop()
+    if connection is not None and connection.is_open:
+        try:
+            connection.close()
+        except Exception as close_ex:
+            print(f"Error closing COM port: {close_ex}")
+
+# Connection states published by SerialConnectionManager.status
+SERIAL_STATUS_IDLE = "SIN PUERTO"
+SERIAL_STATUS_CONNECTING = "CONECTANDO"
+SERIAL_STATUS_CONNECTED = "CONECTADO"
+SERIAL_STATUS_RETRYING = "REINTENTANDO"
+SERIAL_BACKOFF_INITIAL_S = 1.0
+SERIAL_BACKOFF_MAX_S = 30.0
+
+class SerialConnectionManager:
+    """
+    Opens, watches and reopens the NMEA serial port in a background worker, so a
+    slow or missing USB adapter never stalls the render loop. Failed opens and lost
+    ports are retried with exponential backoff (1 s doubling up to 30 s). The main
+    loop only reads 'connected', 'status' and 'reader'; request() hot-swaps the port.
+    """
+    def __init__(self):
+        self.status = SERIAL_STATUS_IDLE
+        self.connected = False   # Plain bool: assignments are atomic, safe to read every frame
+        self.connection = None
+        self.reader = None
+        self._lock = threading.Lock()
+        self._target = None      # (port, baud) wanted, or None
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="nmea-serial-manager", daemon=True)
+        self._thread.start()
+
+    def request(self, port, baud):
+        """Connect to port@baud (None or 'Ninguno' disconnects). Returns immediately."""
+        target = (port, baud) if port and port != "Ninguno" else None
+        with self._lock:
+            self._target = target
+        self._wake.set()
+
+    def _publish(self, connection, reader, status):
+        self.connection = connection
+        self.reader = reader
+        self.connected = reader is not None
+        self.status = status
+
+    def _run(self):
+        current = None # Target of the open connection
+        backoff = SERIAL_BACKOFF_INITIAL_S
+        retry_at = 0.0
+        while not self._stop_event.is_set():
+            with self._lock:
+                target = self._target
+            if target != current or (self.reader is not None and not self.reader.alive):
+                if self.reader is not None and not self.reader.alive and target == current:
+                    print(f"COM port error/disconnected: {self.reader.error}")
+                    retry_at = time.monotonic() + backoff
+                else:
+                    backoff = SERIAL_BACKOFF_INITIAL_S # New port chosen: try straight away
+                    retry_at = 0.0
+                old_connection, old_reader = self.connection, self.reader
+                self._publish(None, None, SERIAL_STATUS_IDLE if target is None else SERIAL_STATUS_RETRYING)
+                close_nmea_serial(old_connection, old_reader)
+                current = target
+            if current is not None and self.reader is None and time.monotonic() >= retry_at:
+                self.status = SERIAL_STATUS_CONNECTING
+                port, baud = current
+                try:
+                    connection, reader = open_nmea_serial(port, baud)
+                except (serial.SerialException, OSError, ValueError) as e:
+                    self.status = SERIAL_STATUS_RETRYING
+                    if backoff == SERIAL_BACKOFF_INITIAL_S: # Later retries stay silent
+                        print(f"ADVERTENCIA: No se pudo conectar al puerto {port}: {e} (reintentando)")
+                    retry_at = time.monotonic() + backoff
+                    backoff = min(backoff * 2, SERIAL_BACKOFF_MAX_S)
+                else:
+                    with self._lock:
+                        still_wanted = self._target == current
+                    if still_wanted:
+                        self._publish(connection, reader, SERIAL_STATUS_CONNECTED)
+                        backoff = SERIAL_BACKOFF_INITIAL_S
+                        print(f"INFO: Conectado al puerto {port} a {baud} baudios.")
+                    else: # The port changed while this one was opening
+                        close_nmea_serial(connection, reader)
+            # Sleep until the next retry, a new request, or a periodic check of the reader
+            timeout = 0.5
+            if current is not None and self.reader is None:
+                timeout = max(0.05, min(timeout, retry_at - time.monotonic()))
+            self._wake.wait(timeout)
+            self._wake.clear()
+        close_nmea_serial(self.connection, self.reader)
+        self._publish(None, None, SERIAL_STATUS_IDLE)
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+        self._thread.join(timeout=3.0)
+# --- End NMEA Serial Reader Thread ---
+
+# --- NMEA Network Input (asyncio) ---
+# UDP broadcast (NMEA 0183 over IP, port 10110 by default) and TCP multiplexer clients.
+# The serial port keeps its own reader thread (NmeaSerialReader) as its adapter; the
+# main loop drains both the same way and feeds the same parsers.
+NMEA_UDP_PORTS = ['OFF', 10110, 10111, 2000]
+NMEA_TCP_DEFAULT_DEST = "localhost:10110" # Menu option 'nmea_tcp_destino' (editable in config.json)
+NMEA_TCP_RETRY_S = 5.0
+NMEA_SOURCE_RETRY_S = 5.0 # A source that failed (port in use, bad host...) is started again after this
+NMEA_NETWORK_IDLE_S = 5.0 # Network input counts as available while a sentence arrived this recently
+
+def nmea_network_sources(options):
+    """Source specs ('udp:PORT', 'tcp:HOST:PORT') selected in the SISTEMA menu."""
+    sources = []
+    udp_port = options.get('nmea_udp', 'OFF')
+    if udp_port != 'OFF':
+        sources.append(f"udp:{udp_port}")
+    if options.get('nmea_tcp', 'OFF') == 'ON':
+        sources.append(f"tcp:{options.get('nmea_tcp_destino', NMEA_TCP_DEFAULT_DEST)}")
+    return sources
+
+class _NmeaDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, hub, source):
+        self.hub = hub
+        self.source = source
+
+    def datagram_received(self, data, addr):
+        # A datagram may carry several sentences
+        for raw in data.split(b"\n"):
+            self.hub.push_line(self.source, raw.decode('ascii', errors='replace').strip())
+
+class NmeaInputHub:
+    """
+    asyncio event loop in a background thread running any number of network NMEA
+    sources at once. Every good sentence is parsed there and its record ends up in one
+    bounded deque that the main loop drains each frame, exactly like NmeaSerialReader.
+    """
+    def __init__(self, maxlen=NMEA_QUEUE_MAXLEN):
+        self.queue = collections.deque(maxlen=maxlen)
+        self.dropped = 0
+        self.corrupt = 0
+        self.counts = {} # Sentences received per source spec
+        self.recorder = None # NmeaRecorder receiving every raw line, if recording is on
+        self.last_line_time = None # time.monotonic() of the last good sentence
+        self.loop = asyncio.new_event_loop()
+        self._sources = {} # spec -> concurrent.futures.Future of the source coroutine
+        self._failed = {} # spec -> time.monotonic() when its source stopped with an error
+        self._lock = threading.RLock() # _sources/_failed are changed from the loop thread too
+        self._thread = threading.Thread(target=self._run_loop, name="nmea-input-hub", daemon=True)
+        self._thread.start()
+
+    @property
+    def active(self):
+        """True while sentences are actually arriving, not just while sources are registered."""
+        last = self.last_line_time
+        return last is not None and time.monotonic() - last < NMEA_NETWORK_IDLE_S
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def push_line(self, source, line):
+        if not line:
             return
-        if len(parts) > 6 and parts[3] and parts[4] and parts[5] and parts[6]:
-            lat_nmea_val = parts[3]
-            lat_hemisphere = parts[4]
-            lon_nmea_val = parts[5]
-            lon_hemisphere = parts[6]
-            if len(lat_nmea_val) >= 4:
-                degrees = lat_nmea_val[:2]
-                raw_minutes = lat_nmea_val[2:]
-                formatted_minutes = format_minutes_to_3dp(raw_minutes)
-                latitude_str = f"{degrees}° {formatted_minutes}{lat_hemisphere}"
-            else:
-                latitude_str = f"{lat_nmea_val} {lat_hemisphere}"
-            if len(lon_nmea_val) >= 5:
-                degrees = lon_nmea_val[:3]
-                raw_minutes = lon_nmea_val[3:]
-                formatted_minutes = format_minutes_to_3dp(raw_minutes)
-                longitude_str = f"{degrees}° {formatted_minutes}{lon_hemisphere}"
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.record(time.monotonic(), line)
+        if not queue_nmea_line(self, line):
+            return
+        self.counts[source] = self.counts.get(source, 0) + 1
+        self.last_line_time = time.monotonic()
+
+    async def _udp_source(self, spec, port):
+        transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: _NmeaDatagramProtocol(self, spec),
+            local_addr=('0.0.0.0', port), allow_broadcast=True)
+        print(f"INFO: Escuchando NMEA por UDP en el puerto {port}.")
+        try:
+            await asyncio.Future() # Until cancelled
+        finally:
+            transport.close()
+
+    async def _tcp_source(self, spec, host, port):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+            except OSError as e:
+                print(f"ADVERTENCIA: No se pudo conectar a NMEA TCP {host}:{port}: {e}")
             else:
-                longitude_str = f"{lon_nmea_val} {lon_hemisphere}"
-            current_ship_lat_deg = nmea_to_decimal_degrees(lat_nmea_val, lat_hemisphere)
-            current_ship_lon_deg = nmea_to_decimal_degrees(lon_nmea_val, lon_hemisphere)
-            if current_ship_lat_deg is None: latitude_str = "N/A (Parse Err)"
-            if current_ship_lon_deg is None: longitude_str = "N/A (Parse Err)"
-    except (IndexError, ValueError) as e:
-        print(f"Error parsing RMC sentence: {sentence} - {e}")
-        latitude_str = "N/A (Exception)"
-        longitude_str = "N/A (Exception)"
-        current_ship_lat_deg = None
-        current_ship_lon_deg = None
-
-def parse_vtg(sentence):
-    global speed_str
+                print(f"INFO: Conectado a NMEA TCP {host}:{port}.")
+                try:
+                    while True:
+                        raw = await reader.readline()
+                        if not raw:
+                            break
+                        self.push_line(spec, raw.decode('ascii', errors='replace').strip())
+                except OSError as e:
+                    print(f"ADVERTENCIA: Conexión NMEA TCP {host}:{port} perdida: {e}")
+                finally:
+                    writer.close()
+            await asyncio.sleep(NMEA_TCP_RETRY_S)
+
+    def _make_source(self, spec):
+        kind, _, address = spec.partition(':')
+        try:
+            if kind == 'udp':
+                return self._udp_source(spec, int(address))
+            if kind == 'tcp':
+                host, _, port = address.rpartition(':')
+                return self._tcp_source(spec, host or 'localhost', int(port))
+        except ValueError:
+            pass
+        print(f"ADVERTENCIA: Fuente NMEA no válida: '{spec}'")
+        return None
+
+    def _source_finished(self, spec, future):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            print(f"ADVERTENCIA: La fuente NMEA {spec} se detuvo: {future.exception()}")
+        with self._lock: # Forget it, so set_sources() retries it after NMEA_SOURCE_RETRY_S
+            if self._sources.get(spec) is future:
+                del self._sources[spec]
+                self._failed[spec] = time.monotonic()
+
+    def set_sources(self, specs):
+        """Starts and stops sources so that exactly 'specs' are running (failed ones are retried)."""
+        with self._lock:
+            for spec in list(self._sources):
+                if spec not in specs:
+                    self._sources.pop(spec).cancel()
+            now = time.monotonic()
+            for spec in specs:
+                if spec in self._sources or now - self._failed.get(spec, -NMEA_SOURCE_RETRY_S) < NMEA_SOURCE_RETRY_S:
+                    continue
+                coro = self._make_source(spec)
+                if coro is None:
+                    self._failed[spec] = now # Not retried before NMEA_SOURCE_RETRY_S either
+                    continue
+                self._failed.pop(spec, None)
+                future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+                self._sources[spec] = future
+                future.add_done_callback(functools.partial(self._source_finished, spec))
+
+    def drain(self):
+        """Returns every record received since the last call."""
+        records = []
+        try:
+            while True:
+                records.append(self.queue.popleft())
+        except IndexError:
+            pass
+        return records
+
+    async def _cancel_all(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        with self._lock:
+            self._sources.clear()
+        try: # Let the sources close their sockets before the loop stops
+            asyncio.run_coroutine_threadsafe(self._cancel_all(), self.loop).result(timeout=1.0)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=1.0)
+# --- End NMEA Network Input ---
+
+# --- NMEA Recorder ---
+# Every raw sentence is written as '<monotonic receive time>\t<sentence>' to
+# NMEA_LOG_DIR/nmea_<date>_<time>.log, rotating when a file reaches NMEA_LOG_MAX_BYTES.
+# Each log has a side index '.idx': an int64 with the first whole second, then one
+# uint64 byte offset per second, so seeking to a time is a single read.
+NMEA_LOG_DIR = "nmea_logs"
+NMEA_LOG_MAX_BYTES = 32 * 1024 * 1024
+NMEA_LOG_FLUSH_S = 0.5 # The writer thread wakes at least this often
+NMEA_INDEX_HEADER = struct.Struct('<q')
+NMEA_INDEX_ENTRY = struct.Struct('<Q')
+
+class NmeaRecorder:
+    """
+    Records raw NMEA lines with their receive timestamp. record() only appends to a
+    deque; a background writer thread does all the file I/O in batches.
+    """
+    def __init__(self, directory=NMEA_LOG_DIR, max_bytes=NMEA_LOG_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.pending = collections.deque()
+        self.lines_written = 0
+        self.files = [] # Log files created so far
+        self.error = None
+        self._log = None
+        self._index = None
+        self._offset = 0
+        self._first_second = None
+        self._next_second = None
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="nmea-recorder", daemon=True)
+        self._thread.start()
+
+    def record(self, t_s, line):
+        self.pending.append((t_s, line))
+
+    def _open_files(self):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d_%H%M%S")
+        base = os.path.join(self.directory, f"nmea_{stamp}")
+        path = f"{base}.log"
+        n = 1
+        while os.path.exists(path): # Several rotations within the same second
+            path = f"{base}_{n}.log"
+            n += 1
+        self._log = open(path, 'wb', buffering=256 * 1024)
+        self._index = open(path[:-4] + ".idx", 'wb', buffering=64 * 1024)
+        self._offset = 0
+        self._first_second = None
+        self.files.append(path)
+        print(f"INFO: Grabando NMEA en '{path}'.")
+
+    def _close_files(self):
+        for f in (self._log, self._index):
+            if f is not None:
+                f.close()
+        self._log = None
+        self._index = None
+
+    def _write_batch(self, batch):
+        for t_s, line in batch:
+            if self._log is None or self._offset >= self.max_bytes:
+                self._close_files()
+                self._open_files()
+            second = int(t_s)
+            if self._first_second is None:
+                self._first_second = second
+                self._next_second = second
+                self._index.write(NMEA_INDEX_HEADER.pack(second))
+            if second >= self._next_second:
+                # One entry per elapsed second (dense, so seconds without data repeat the offset)
+                entry = NMEA_INDEX_ENTRY.pack(self._offset)
+                self._index.write(entry * (second - self._next_second + 1))
+                self._next_second = second + 1
+            data = f"{t_s:.3f}\t{line}\n".encode('ascii', errors='replace')
+            self._log.write(data)
+            self._offset += len(data)
+        self.lines_written += len(batch)
+
+    def _run(self):
+        try:
+            while True:
+                stopping = self._stop_event.is_set()
+                batch = []
+                try:
+                    while True:
+                        batch.append(self.pending.popleft())
+                except IndexError:
+                    pass
+                if batch:
+                    self._write_batch(batch)
+                if stopping:
+                    break
+                self._wake.wait(NMEA_LOG_FLUSH_S)
+                self._wake.clear()
+        except OSError as e:
+            self.error = e
+            print(f"ADVERTENCIA: Grabación NMEA detenida: {e}")
+        finally:
+            self._close_files()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+        self._thread.join(timeout=5.0)
+
+def nmea_log_offset(log_path, t_s):
+    """Byte offset of the first line received at or after time t_s, using the side index."""
+    with open(log_path[:-4] + ".idx", 'rb') as index:
+        header = index.read(NMEA_INDEX_HEADER.size)
+        if len(header) < NMEA_INDEX_HEADER.size:
+            return 0
+        first_second, = NMEA_INDEX_HEADER.unpack(header)
+        slot = max(0, int(t_s) - first_second)
+        index.seek(NMEA_INDEX_HEADER.size + slot * NMEA_INDEX_ENTRY.size)
+        entry = index.read(NMEA_INDEX_ENTRY.size)
+        if len(entry) < NMEA_INDEX_ENTRY.size:
+            return os.path.getsize(log_path) # Past the end of the recording
+        return NMEA_INDEX_ENTRY.unpack(entry)[0]
+# --- End NMEA Recorder ---
+
+# --- NMEA Replay ---
+NMEA_REPLAY_FRAME_BUDGET_S = 0.05 # Max time per frame spent replaying in 'max' mode
+NMEA_REPLAY_REPORT_S = 5.0
+
+def _nmea_time_of_day_s(line):
+    # Seconds since midnight from the UTC field of GGA/RMC/GLL/ZDA, for plain (untimed) logs
+    fields = line.split(',')
+    kind = fields[0][3:6]
+    field = fields[5] if kind == 'GLL' and len(fields) > 5 else (fields[1] if len(fields) > 1 else '')
+    if kind not in ('GGA', 'RMC', 'GLL', 'ZDA') or len(field) < 6:
+        return None
     try:
-        parts = sentence.split(',')
-        if len(parts) > 5 and parts[5]:
-            speed_str = f"{parts[5]} Knots"
-    except (IndexError, ValueError) as e:
-        print(f"Error parsing VTG sentence: {sentence} - {e}")
+        return int(field[0:2]) * 3600 + int(field[2:4]) * 60 + float(field[4:])
+    except ValueError:
+        return None
 
-def parse_hdt(sentence):
-    global heading_str, current_ship_heading
+class NmeaReplay:
+    """
+    Replays an NMEA log through the normal parser pipeline. Logs written by
+    NmeaRecorder carry their receive times; plain logs are timed from the UTC
+    field of their position/time sentences. speed is a factor (1 = real time)
+    or None for as fast as possible.
+    """
+    def __init__(self, path, speed=1.0, start_s=0.0):
+        self.path = path
+        self.speed = speed
+        self.finished = False
+        self.sentences = 0
+        self.parse_time_s = 0.0
+        self._file = open(path, 'rb')
+        self._read_t = None # Log clock of the last timed sentence read (plain logs)
+        self._held = [] # Untimed sentences read ahead of the first timed one, already stamped
+        self._day_offset = 0.0
+        self._next = self._read_next()
+        self.t_first = self._next[0] if self._next is not None else 0.0
+        if start_s > 0 and os.path.exists(path[:-4] + ".idx"):
+            # Recorded log: jump straight to the requested second with the side index
+            self._file.seek(nmea_log_offset(path, self.t_first + start_s))
+            self._next = self._read_next()
+        while start_s > 0 and self._next is not None and self._next[0] < self.t_first + start_s:
+            self._next = self._read_next()
+        self.t_start = self._next[0] if self._next is not None else self.t_first
+        self._last_t = self.t_start
+        self.wall_start = time.monotonic()
+        self._report_wall = self.wall_start
+        self._report_sentences = 0
+        self._report_parse_s = 0.0
+
+    def _read_next(self):
+        if self._held:
+            return self._held.pop(0)
+        untimed = [] # Plain log lines before its first time field
+        for raw in self._file:
+            text = raw.decode('ascii', errors='replace').strip()
+            stamp, tab, line = text.partition('\t')
+            if tab:
+                try:
+                    return float(stamp), line
+                except ValueError:
+                    continue
+            if not text:
+                continue
+            t = _nmea_time_of_day_s(text)
+            if t is None:
+                if self._read_t is None: # Logs often open with HDT/VTG/DBT: they get the first time found
+                    untimed.append(text)
+                    continue
+                return self._read_t, text
+            if self._read_t is not None and t + self._day_offset < self._read_t - 43200: # Crossed midnight UTC
+                self._day_offset += 86400
+            self._read_t = t + self._day_offset
+            if untimed:
+                self._held = [(self._read_t, line) for line in untimed[1:]] + [(self._read_t, text)]
+                return self._read_t, untimed[0]
+            return self._read_t, text
+        if untimed: # No time field in the whole log
+            self._held = [(0.0, line) for line in untimed[1:]]
+            return 0.0, untimed[0]
+        return None
+
+    @property
+    def clock_s(self):
+        """Time of the last replayed sentence, on the log's own clock."""
+        return self._last_t
+
+    def due(self, now_s):
+        """Yields (t, sentence) for every sentence due at wall time now_s."""
+        if self.speed is None:
+            limit = float('inf')
+        else:
+            limit = self.t_start + (now_s - self.wall_start) * self.speed
+        while self._next is not None and self._next[0] <= limit:
+            item = self._next
+            self._last_t = item[0]
+            self._next = self._read_next()
+            yield item
+        if self._next is None and not self.finished:
+            self.finished = True
+            self._file.close()
+
+    def note_parse(self, elapsed_s):
+        self.sentences += 1
+        self.parse_time_s += elapsed_s
+
+    def report(self, now_s, force=False):
+        elapsed = now_s - self._report_wall
+        if not force and elapsed < NMEA_REPLAY_REPORT_S:
+            return
+        count = self.sentences - self._report_sentences
+        parse_s = self.parse_time_s - self._report_parse_s
+        rate = count / elapsed if elapsed > 0 else 0.0
+        latency_us = parse_s / count * 1e6 if count else 0.0
+        print(f"INFO: Replay NMEA: {rate:,.0f} sentencias/s, latencia de procesado {latency_us:.1f} µs/sentencia, "
+              f"{self.clock_s - self.t_first:.0f} s del registro reproducidos")
+        self._report_wall = now_s
+        self._report_sentences = self.sentences
+        self._report_parse_s = self.parse_time_s
+
+def open_nmea_replay(path, speed_text, start_s):
+    """Builds the replay source from the command line options, or None on error."""
     try:
-        parts = sentence.split(',')
-        if len(parts) > 1 and parts[1]:
-            raw_heading = parts[1]
-            heading_str = f"{raw_heading} T"
-            try:
-                current_ship_heading = float(raw_heading)
-            except ValueError:
-                print(f"Error converting HDT heading to float: {raw_heading} in {sentence}")
-    except Exception as e:
-        print(f"Error parsing HDT sentence: {sentence} - {e}")
+        speed = None if str(speed_text).lower() == 'max' else float(speed_text)
+        replay = NmeaReplay(path, speed, start_s)
+    except (OSError, ValueError) as e:
+        print(f"ADVERTENCIA: No se pudo abrir el registro NMEA '{path}': {e}")
+        return None
+    print(f"INFO: Reproduciendo '{path}' a velocidad {'máxima' if speed is None else f'x{speed:g}'}.")
+    return replay
+# --- End NMEA Replay ---
+
+# --- Navigation History Store ---
+# Own-ship track and fishing marks kept across sessions in an SQLite file. Both tables have an
+# R-tree over (time, lat, lon), so "points in this box and time window" is an index lookup and
+# the PPI can show days of history at the current range without loading the whole file.
+# R-tree coordinates are 32-bit floats rounded outwards, so results are refined on the exact columns.
+HISTORY_DB_FILE = "sonar_history.db"
+HISTORY_MIN_STEP_M = 10.0         # Track points closer than this to the last stored one are skipped
+HISTORY_COMMIT_INTERVAL_S = 10.0  # Track points are written to disk in batches
+HISTORY_MAX_POINTS = 200000       # Most track points one query returns (the newest ones)
+HISTORY_SPANS_H = {'OFF': 0, '24 H': 24, '3 D': 72, '7 D': 168, '30 D': 720} # SISTEMA > HISTORIAL DERROTA
+
+class NavHistoryStore:
+    """
+    Track history and marks on disk. Track points carry a segment number that changes
+    with every session and every loss of position, so separate passages are not joined.
+    Writes happen in the main thread; the open transaction is committed every
+    HISTORY_COMMIT_INTERVAL_S and 'version' changes with every commit.
+    """
+    def __init__(self, path=HISTORY_DB_FILE):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS track (id INTEGER PRIMARY KEY, t REAL, lat REAL, lon REAL, segment INTEGER);
+            CREATE VIRTUAL TABLE IF NOT EXISTS track_idx USING rtree(id, t0, t1, lat0, lat1, lon0, lon1);
+            CREATE TABLE IF NOT EXISTS marks (id INTEGER PRIMARY KEY, t REAL, lat REAL, lon REAL, kind TEXT);
+            CREATE VIRTUAL TABLE IF NOT EXISTS marks_idx USING rtree(id, t0, t1, lat0, lat1, lon0, lon1);
+        """)
+        last_segment = self.conn.execute("SELECT MAX(segment) FROM track").fetchone()[0]
+        self.segment = 0 if last_segment is None else last_segment + 1
+        self.last_track_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM track").fetchone()[0]
+        self.last_point = None # (lat, lon) of the last stored track point of this segment
+        self.last_commit = time.monotonic()
+        self.version = 0
+
+    def _insert(self, table, extra_column, t, lat, lon, extra):
+        row_id = self.conn.execute(f"INSERT INTO {table} (t, lat, lon, {extra_column}) VALUES (?, ?, ?, ?)",
+                                   (t, lat, lon, extra)).lastrowid
+        self.conn.execute(f"INSERT INTO {table}_idx VALUES (?, ?, ?, ?, ?, ?, ?)", (row_id, t, t, lat, lat, lon, lon))
+        return row_id
+
+    def add_track_point(self, t, lat, lon):
+        if self.last_point is None or math.hypot(*geo_to_local_xy(lat, lon, *self.last_point)) >= HISTORY_MIN_STEP_M:
+            self.last_track_id = self._insert('track', 'segment', t, lat, lon, self.segment)
+            self.last_point = (lat, lon)
+        if time.monotonic() - self.last_commit >= HISTORY_COMMIT_INTERVAL_S:
+            self.commit()
+
+    def break_track(self):
+        """The next track point starts a new segment (position lost, replay...)."""
+        if self.last_point is not None:
+            self.segment += 1
+            self.last_point = None
+
+    def add_mark(self, t, lat, lon, kind):
+        """Stores a mark ('target' or 'triangle') and returns its id."""
+        mark_id = self._insert('marks', 'kind', t, lat, lon, kind)
+        self.commit()
+        return mark_id
+
+    def add_marks(self, t, lats, lons, kind):
+        """Stores several marks of one kind in a single transaction and returns their ids."""
+        mark_ids = [self._insert('marks', 'kind', t, lat, lon, kind) for lat, lon in zip(lats, lons)]
+        self.commit()
+        return mark_ids
+
+    def delete_marks(self, mark_ids):
+        rows = [(mark_id,) for mark_id in mark_ids if mark_id is not None]
+        if rows:
+            self.conn.executemany("DELETE FROM marks WHERE id = ?", rows)
+            self.conn.executemany("DELETE FROM marks_idx WHERE id = ?", rows)
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.last_commit = time.monotonic()
+        self.version += 1
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def _query(self, table, columns, box, t0, t1, limit=-1, after_id=None):
+        lat0, lat1, lon0, lon1 = box
+        if after_id is None:
+            candidates, args = (f"id IN (SELECT id FROM {table}_idx WHERE t1 >= ? AND t0 <= ? "
+                                "AND lat1 >= ? AND lat0 <= ? AND lon1 >= ? AND lon0 <= ?)"), (t0, t1, lat0, lat1, lon0, lon1)
+        else: # Only the newest rows: a range of the primary key is cheaper than the R-tree
+            candidates, args = "id > ?", (after_id,)
+        return self.conn.execute(
+            f"SELECT {columns} FROM {table} WHERE {candidates} "
+            "AND t BETWEEN ? AND ? AND lat BETWEEN ? AND ? AND lon BETWEEN ? AND ? ORDER BY id DESC LIMIT ?",
+            args + (t0, t1, lat0, lat1, lon0, lon1, limit)).fetchall()
+
+    def track_in_box(self, box, t0, t1, after_id=None):
+        """
+        Track points inside box = (lat0, lat1, lon0, lon1) stored between t0 and t1 (epoch seconds),
+        oldest first, as arrays (id, t, lat, lon, segment); at most the newest HISTORY_MAX_POINTS.
+        With after_id, only points stored after that row.
+        """
+        rows = self._query('track', 'id, t, lat, lon, segment', box, t0, t1, HISTORY_MAX_POINTS, after_id)
+        table = np.array(rows[::-1], dtype=float).reshape(-1, 5)
+        return table[:, 0].astype(np.int64), table[:, 1], table[:, 2], table[:, 3], table[:, 4].astype(np.int64)
+
+    def marks_in_box(self, box, t0, t1):
+        """Marks inside the box stored between t0 and t1, oldest first, as (id, t, lat, lon, kind) tuples."""
+        return self._query('marks', 'id, t, lat, lon, kind', box, t0, t1)[::-1]
 
-def parse_hdg(sentence):
-    global heading_str, current_ship_heading
+def open_nav_history(path=HISTORY_DB_FILE):
+    """Opens the history store, or None (history disabled) if the file cannot be used."""
     try:
-        parts = sentence.split(',')
-        if len(parts) > 1 and parts[1]:  
-            raw_hdg_value = parts[1]
-            try:
-                current_ship_heading = float(raw_hdg_value)
-                heading_display_text = f"{raw_hdg_value}"
-                if len(parts) > 4 and parts[3] and parts[4]:  
-                    heading_display_text += f" (Mag Var: {parts[3]} {parts[4]})"
-                else:
-                    heading_display_text += " (No Mag Var)"
-                heading_str = heading_display_text
-            except ValueError:
-                print(f"Error converting HDG heading to float: {raw_hdg_value} in {sentence}")
-                heading_display_text = f"{raw_hdg_value}"
-                if len(parts) > 4 and parts[3] and parts[4]:
-                    heading_display_text += f" (Mag Var: {parts[3]} {parts[4]})"
-                else:
-                    heading_display_text += " (No Mag Var)"
-                heading_str = heading_display_text
-    except Exception as e:
-        print(f"Error parsing HDG sentence: {sentence} - {e}")
+        store = NavHistoryStore(path)
+    except sqlite3.Error as e:
+        print(f"ADVERTENCIA: No se pudo abrir el historial de navegación '{path}': {e}")
+        return None
+    print(f"INFO: Historial de navegación en '{path}' (segmento {store.segment}).")
+    return store
+# --- End Navigation History Store ---
+
 try:
     display_info = pygame.display.Info()
     # initial_width = display_info.current_w
@@ -405,6 +1767,7 @@ TRANSLATIONS = {
         'LBL_COLOR_RESPONSE': 'RSPUESTA COLOR',
         'LBL_COLOR_ERASE': 'ANULAR COLOR',
         'LBL_ECHO_AVG': 'PROMEDIO ECO',
+        'LBL_ECHO_TRAIL': 'ESTELA ECO',
         'LBL_INTERF_REJECT': 'RECHAZ INTERF',
         'LBL_HORIZ_BEAM': 'ANGULO HAZ HOR',
         'LBL_VERT_BEAM': 'ANGULO HAZ VER',
@@ -450,6 +1813,11 @@ TRANSLATIONS = {
         'LBL_COM_PORT': 'PUERTO COM',
         'LBL_PORT_FORMAT': 'PORT FORMATO',
         'LBL_PORT_BAUD': 'PORT BAUDIOS',
+        'LBL_NMEA_UDP': 'NMEA UDP',
+        'LBL_NMEA_TCP': 'NMEA TCP',
+        'LBL_NMEA_RECORD': 'GRABAR NMEA',
+        'LBL_AIS': 'BLANCOS AIS',
+        'LBL_HISTORY': 'HISTORIAL DERROTA',
         'LBL_NAV_DATA': 'DATOS NAV',
         'LBL_COMBI_SCALE': 'ESCALA COMBI',
         'LBL_SUBTEXT_IND': 'INDI SUBTEXTO',
@@ -540,6 +1908,7 @@ TRANSLATIONS = {
         'LBL_COLOR_RESPONSE': 'COLOR RESPONSE',
         'LBL_COLOR_ERASE': 'COLOR ERASE',
         'LBL_ECHO_AVG': 'ECHO AVERAGE',
+        'LBL_ECHO_TRAIL': 'ECHO TRAIL',
         'LBL_INTERF_REJECT': 'INT REJECT',
         'LBL_HORIZ_BEAM': 'HORIZ BEAM',
         'LBL_VERT_BEAM': 'VERT BEAM',
@@ -585,6 +1954,11 @@ TRANSLATIONS = {
         'LBL_COM_PORT': 'COM PORT',
         'LBL_PORT_FORMAT': 'PORT FORMAT',
         'LBL_PORT_BAUD': 'PORT BAUD',
+        'LBL_NMEA_UDP': 'NMEA UDP',
+        'LBL_NMEA_TCP': 'NMEA TCP',
+        'LBL_NMEA_RECORD': 'NMEA RECORD',
+        'LBL_AIS': 'AIS TARGETS',
+        'LBL_HISTORY': 'TRACK HISTORY',
         'LBL_NAV_DATA': 'NAV DATA',
         'LBL_COMBI_SCALE': 'COMBI SCALE',
         'LBL_SUBTEXT_IND': 'SUBTEXT IND',
@@ -675,6 +2049,7 @@ TRANSLATIONS = {
         'LBL_COLOR_RESPONSE': 'FARVERESPONS',
         'LBL_COLOR_ERASE': 'SLET FARVE',
         'LBL_ECHO_AVG': 'EKKOGNMSNIT',
+        'LBL_ECHO_TRAIL': 'EKKOSPOR',
         'LBL_INTERF_REJECT': 'INTERF AFVIS',
         'LBL_HORIZ_BEAM': 'HORIZ STRÅLE',
         'LBL_VERT_BEAM': 'VERT STRÅLE',
@@ -720,6 +2095,11 @@ TRANSLATIONS = {
         'LBL_COM_PORT': 'COM PORT',
         'LBL_PORT_FORMAT': 'PORT FORMAT',
         'LBL_PORT_BAUD': 'PORT BAUD',
+        'LBL_NMEA_UDP': 'NMEA UDP',
+        'LBL_NMEA_TCP': 'NMEA TCP',
+        'LBL_NMEA_RECORD': 'OPTAG NMEA',
+        'LBL_AIS': 'AIS MÅL',
+        'LBL_HISTORY': 'SPORHISTORIK',
         'LBL_NAV_DATA': 'NAV DATA',
         'LBL_COMBI_SCALE': 'COMBI SKALA',
         'LBL_SUBTEXT_IND': 'UNDERTEKST IND',
@@ -787,6 +2167,7 @@ TRANSLATIONS = {
         'LBL_COLOR_RESPONSE': '色調レスポンス',
         'LBL_COLOR_ERASE': '色消去',
         'LBL_ECHO_AVG': 'エコー平均',
+        'LBL_ECHO_TRAIL': 'エコー残像',
         'LBL_INTERF_REJECT': '干渉除去',
         'LBL_HORIZ_BEAM': '水平ビーム幅',
         'LBL_VERT_BEAM': '垂直ビーム幅',
@@ -832,6 +2213,11 @@ TRANSLATIONS = {
         'LBL_COM_PORT': 'COMポート',
         'LBL_PORT_FORMAT': 'ポートフォーマット',
         'LBL_PORT_BAUD': 'ボーレート',
+        'LBL_NMEA_UDP': 'NMEA UDP',
+        'LBL_NMEA_TCP': 'NMEA TCP',
+        'LBL_NMEA_RECORD': 'NMEA記録',
+        'LBL_AIS': 'AIS物標',
+        'LBL_HISTORY': '航跡履歴',
         'LBL_NAV_DATA': '航法データ',
         'LBL_COMBI_SCALE': 'コンビスケール',
         'LBL_SUBTEXT_IND': 'サブテキスト表示',
@@ -887,6 +2273,7 @@ TRANSLATIONS = {
         'LBL_COLOR_RESPONSE': 'KLEURRESPONS',
         'LBL_COLOR_ERASE': 'KLEUR WISSEN',
         'LBL_ECHO_AVG': 'ECHO GEMIDD',
+        'LBL_ECHO_TRAIL': 'ECHO SPOOR',
         'LBL_INTERF_REJECT': 'INTERF ONDER',
         'LBL_HORIZ_BEAM': 'HORIZ BUNDEL',
         'LBL_VERT_BEAM': 'VERT BUNDEL',
@@ -932,6 +2319,11 @@ TRANSLATIONS = {
         'LBL_COM_PORT': 'COM POORT',
         'LBL_PORT_FORMAT': 'POORT FORM',
         'LBL_PORT_BAUD': 'POORT BAUD',
+        'LBL_NMEA_UDP': 'NMEA UDP',
+        'LBL_NMEA_TCP': 'NMEA TCP',
+        'LBL_NMEA_RECORD': 'NMEA OPNEMEN',
+        'LBL_AIS': 'AIS DOELEN',
+        'LBL_HISTORY': 'KOERSHISTORIE',
         'LBL_NAV_DATA': 'NAV DATA',
         'LBL_COMBI_SCALE': 'COMBI SCHAAL',
         'LBL_SUBTEXT_IND': 'SUBTEKST IND',
@@ -987,6 +2379,7 @@ TRANSLATIONS = {
         'LBL_COLOR_RESPONSE': 'REPONSE COUL',
         'LBL_COLOR_ERASE': 'EFFAC COULEUR',
         'LBL_ECHO_AVG': 'MOYEN ECHO',
+        'LBL_ECHO_TRAIL': 'REMANENCE ECHO',
         'LBL_INTERF_REJECT': 'REJET INTERF',
         'LBL_HORIZ_BEAM': 'FAISCEAU HOR',
         'LBL_VERT_BEAM': 'FAISCEAU VER',
@@ -1032,6 +2425,11 @@ TRANSLATIONS = {
         'LBL_COM_PORT': 'PORT COM',
         'LBL_PORT_FORMAT': 'FORMAT PORT',
         'LBL_PORT_BAUD': 'BAUD PORT',
+        'LBL_NMEA_UDP': 'NMEA UDP',
+        'LBL_NMEA_TCP': 'NMEA TCP',
+        'LBL_NMEA_RECORD': 'ENREG NMEA',
+        'LBL_AIS': 'CIBLES AIS',
+        'LBL_HISTORY': 'HISTORIQUE ROUTE',
         'LBL_NAV_DATA': 'DONNEES NAV',
         'LBL_COMBI_SCALE': 'ECHELLE COMBI',
         'LBL_SUBTEXT_IND': 'IND SOUS-TEXT',
@@ -1088,6 +2486,7 @@ TRANSLATIONS = {
         'LBL_COLOR_RESPONSE': 'RISPOST COLORE',
         'LBL_COLOR_ERASE': 'CANCELL COLORE',
         'LBL_ECHO_AVG': 'MEDIA ECO',
+        'LBL_ECHO_TRAIL': 'SCIA ECO',
         'LBL_INTERF_REJECT': 'REIEZ INTERF',
         'LBL_HORIZ_BEAM': 'FASCIO ORIZ',
         'LBL_VERT_BEAM': 'FASCIO VERT',
@@ -1133,6 +2532,11 @@ TRANSLATIONS = {
         'LBL_COM_PORT': 'PORTA COM',
         'LBL_PORT_FORMAT': 'FORMATO PORTA',
         'LBL_PORT_BAUD': 'BAUD PORTA',
+        'LBL_NMEA_UDP': 'NMEA UDP',
+        'LBL_NMEA_TCP': 'NMEA TCP',
+        'LBL_NMEA_RECORD': 'REGISTRA NMEA',
+        'LBL_AIS': 'BERSAGLI AIS',
+        'LBL_HISTORY': 'STORICO ROTTA',
         'LBL_NAV_DATA': 'DATI NAV',
         'LBL_COMBI_SCALE': 'SCALA COMBI',
         'LBL_SUBTEXT_IND': 'IND SOTTOTESTO',
@@ -1188,6 +2592,7 @@ TRANSLATIONS = {
         'LBL_COLOR_RESPONSE': '색상 반응',
         'LBL_COLOR_ERASE': '색상 삭제',
         'LBL_ECHO_AVG': '에코 평균',
+        'LBL_ECHO_TRAIL': '에코 잔상',
         'LBL_INTERF_REJECT': '간섭 제거',
         'LBL_HORIZ_BEAM': '수평 빔 폭',
         'LBL_VERT_BEAM': '수직 빔 폭',
@@ -1233,6 +2638,11 @@ TRANSLATIONS = {
         'LBL_COM_PORT': 'COM 포트',
         'LBL_PORT_FORMAT': '포트 포맷',
         'LBL_PORT_BAUD': '전송 속도',
+        'LBL_NMEA_UDP': 'NMEA UDP',
+        'LBL_NMEA_TCP': 'NMEA TCP',
+        'LBL_NMEA_RECORD': 'NMEA 기록',
+        'LBL_AIS': 'AIS 물표',
+        'LBL_HISTORY': '항적 기록',
         'LBL_NAV_DATA': '항법 데이터',
         'LBL_COMBI_SCALE': '콤비 스케일',
         'LBL_SUBTEXT_IND': '서브 텍스트 표시',
@@ -1288,6 +2698,7 @@ TRANSLATIONS = {
         'LBL_COLOR_RESPONSE': 'FARGERESPONS',
         'LBL_COLOR_ERASE': 'SLETT FARGE',
         'LBL_ECHO_AVG': 'EKKOGJSNITT',
+        'LBL_ECHO_TRAIL': 'EKKOSPOR',
         'LBL_INTERF_REJECT': 'INTERF AVVIS',
         'LBL_HORIZ_BEAM': 'HORIZ STRÅLE',
         'LBL_VERT_BEAM': 'VERT STRÅLE',
@@ -1333,6 +2744,11 @@ TRANSLATIONS = {
         'LBL_COM_PORT': 'COM PORT',
         'LBL_PORT_FORMAT': 'PORT FORMAT',
         'LBL_PORT_BAUD': 'PORT BAUD',
+        'LBL_NMEA_UDP': 'NMEA UDP',
+        'LBL_NMEA_TCP': 'NMEA TCP',
+        'LBL_NMEA_RECORD': 'TA OPP NMEA',
+        'LBL_AIS': 'AIS MÅL',
+        'LBL_HISTORY': 'SPORHISTORIKK',
         'LBL_NAV_DATA': 'NAV DATA',
         'LBL_COMBI_SCALE': 'COMBI SKALA',
         'LBL_SUBTEXT_IND': 'UNDERTEKST IND',
@@ -1511,6 +2927,7 @@ class MenuSystem:
             'respuesta_color': 1,
             'anular_color': 0,
             'promedio_eco': 1,
+            'estela_eco': 'OFF',
             'rechazo_interf': 1,
             'angulo_haz_hor': 'ANCHO',
             'angulo_haz_ver': 'ANCHO',
@@ -1566,6 +2983,12 @@ class MenuSystem:
             'puerto_com': 'Ninguno',
             'port_formato': 'NMEA',
             'port_baudios': 9600,
+            'nmea_udp': 'OFF',
+            'nmea_tcp': 'OFF',
+            'nmea_tcp_destino': NMEA_TCP_DEFAULT_DEST,
+            'grabar_nmea': 'OFF',
+            'ais': 'ON',
+            'historial': 'OFF', # Opt-in, like grabar_nmea: nothing is written to disk until enabled
             'datos_nav': 'GPS',
             'escala_combi': 'DERECHA',
             'indi_subtexto': 'ON',
@@ -1600,6 +3023,11 @@ class MenuSystem:
             {'label_key': 'LBL_COM_PORT', 'key': 'puerto_com', 'type': 'dropdown'},
             {'label_key': 'LBL_PORT_FORMAT', 'key': 'port_formato', 'type': 'selector', 'values': ['NMEA', 'CIF']},
             {'label_key': 'LBL_PORT_BAUD', 'key': 'port_baudios', 'type': 'selector', 'values': [19200, 9600, 4800, 2400]},
+            {'label_key': 'LBL_NMEA_UDP', 'key': 'nmea_udp', 'type': 'selector', 'values': NMEA_UDP_PORTS},
+            {'label_key': 'LBL_NMEA_TCP', 'key': 'nmea_tcp', 'type': 'selector', 'values': ['OFF', 'ON']},
+            {'label_key': 'LBL_NMEA_RECORD', 'key': 'grabar_nmea', 'type': 'selector', 'values': ['OFF', 'ON']},
+            {'label_key': 'LBL_AIS', 'key': 'ais', 'type': 'selector', 'values': ['OFF', 'ON']},
+            {'label_key': 'LBL_HISTORY', 'key': 'historial', 'type': 'selector', 'values': list(HISTORY_SPANS_H)},
             {'label_key': 'LBL_NAV_DATA', 'key': 'datos_nav', 'type': 'selector', 'values': ['GPS', 'LC', 'ESTIMA', 'TODOS']},
             {'label_key': 'LBL_COMBI_SCALE', 'key': 'escala_combi', 'type': 'selector', 'values': ['DERECHA', 'IZQUIERDA']},
             {'label_key': 'LBL_SUBTEXT_IND', 'key': 'indi_subtexto', 'type': 'selector', 'values': ['OFF', 'ON']},
@@ -1623,6 +3051,7 @@ class MenuSystem:
             {'label_key': 'LBL_COLOR_RESPONSE', 'key': 'respuesta_color', 'type': 'selector', 'values': [1, 2, 3, 4]},
             {'label_key': 'LBL_COLOR_ERASE', 'key': 'anular_color', 'type': 'numeric_adjustable', 'range': (0, 10)},
             {'label_key': 'LBL_ECHO_AVG', 'key': 'promedio_eco', 'type': 'numeric_adjustable', 'range': (0, 3)},
+            {'label_key': 'LBL_ECHO_TRAIL', 'key': 'estela_eco', 'type': 'selector', 'values': ['OFF', 'ON']},
             {'label_key': 'LBL_INTERF_REJECT', 'key': 'rechazo_interf', 'type': 'numeric_adjustable', 'range': (0, 3)},
             {'label_key': 'LBL_HORIZ_BEAM', 'key': 'angulo_haz_hor', 'type': 'selector', 'values': ['ANCHO', 'ESTRECHO']},
             {'label_key': 'LBL_VERT_BEAM', 'key': 'angulo_haz_ver', 'type': 'selector', 'values': ['ANCHO', 'ESTRECHO']},
@@ -1672,7 +3101,8 @@ class MenuSystem:
         self.active = not self.active
         if self.active:
             self.focused_item_index = 0
-            self.com_ports_list = get_available_com_ports() 
+            self.com_ports_list = com_port_scanner.ports() # Cached; a fresh scan runs in the background
+            com_port_scanner.rescan()
 
     def handle_event(self, event):
         if not self.active:
@@ -1818,6 +3248,8 @@ class MenuSystem:
             if 'puerto_com' in self.item_rects and 'main_box' in self.item_rects['puerto_com']:
                 if self.item_rects['puerto_com']['main_box'].collidepoint(event.pos):
                     self.puerto_com_dropdown_open = not self.puerto_com_dropdown_open
+                    if self.puerto_com_dropdown_open:
+                        self.com_ports_list = com_port_scanner.ports()
                     self.focused_item_index = active_layout.index(next(item for item in active_layout if item['key'] == 'puerto_com'))
                     return None # Event handled
                 elif self.puerto_com_dropdown_open:
@@ -2137,6 +3569,7 @@ color_schemes = {
         "CURSOR_CROSS": (188, 238, 104),
         "RANGE_RINGS": (107, 142, 35),      # Verde oliva para los anillos
         "SHIP_TRACK": (152, 251, 152),      # Verde pálido para la estela
+        "HISTORY_TRACK": (107, 142, 35),   # Verde oliva para la derrota de días anteriores
         "CENTER_ICON": (188, 238, 104),
         "MENU_ITEM_HIGHLIGHT": DEFAULT_VERDE_CLARO, # Mantener este por ahora o definir uno específico
         "MENU_ITEM_RED_HIGHLIGHT": DEFAULT_ROJO, # Mantener este por ahora o definir uno específico
@@ -2156,6 +3589,7 @@ color_schemes = {
         "CURSOR_CROSS": (0, 100, 0),
         "RANGE_RINGS": (34, 139, 34),      # Verde bosque para los anillos
         "SHIP_TRACK": (60, 179, 113),      # Verde mar medio para la estela
+        "HISTORY_TRACK": (34, 139, 34),    # Verde bosque para la derrota de días anteriores
         "CENTER_ICON": (0, 100, 0),
         "MENU_ITEM_HIGHLIGHT": DEFAULT_VERDE_CLARO,
         "MENU_ITEM_RED_HIGHLIGHT": DEFAULT_ROJO,
@@ -2175,6 +3609,7 @@ color_schemes = {
         "CURSOR_CROSS": DEFAULT_BLANCO,
         "RANGE_RINGS": DEFAULT_GRIS_MUY_CLARO,
         "SHIP_TRACK": DEFAULT_GRIS_MUY_CLARO,
+        "HISTORY_TRACK": DEFAULT_GRIS_MEDIO,
         "CENTER_ICON": DEFAULT_BLANCO,
         "MENU_ITEM_HIGHLIGHT": DEFAULT_VERDE_CLARO,
         "MENU_ITEM_RED_HIGHLIGHT": DEFAULT_ROJO,
@@ -2194,6 +3629,7 @@ color_schemes = {
         "CURSOR_CROSS": (0, 0, 128),
         "RANGE_RINGS": (70, 130, 180),      # Azul acero para los anillos
         "SHIP_TRACK": (135, 206, 250),      # Azul cielo claro para la estela
+        "HISTORY_TRACK": (70, 130, 180),    # Azul acero para la derrota de días anteriores
         "CENTER_ICON": (0, 0, 128),
         "MENU_ITEM_HIGHLIGHT": DEFAULT_VERDE_CLARO, # Podrían ser azules también
         "MENU_ITEM_RED_HIGHLIGHT": DEFAULT_ROJO,
@@ -2249,6 +3685,59 @@ pantalla = screen # Restaurar la asignación de pantalla para que sea la misma s
 # Resolución alta para el simulador de eco
 NUM_ANGULOS = 1440  
 NUM_RANGOS = 500    
+PASO_ANCHO_ECO = 1.06 # Escalera de anchos de mancha (ver inject_echo)
+
+# Promedio de eco (menú promedio_eco 0-3): peso del ping nuevo en la media entre pings
+ALFA_PROMEDIO_ECO = (1.0, 0.5, 0.25, 0.125)
+
+# Rechazo de interferencias: pings guardados (uint8) para el filtro entre pings,
+# escala de cuantificación del buffer (0..15 -> 0..255) y frecuencia de la
+# interferencia simulada de otros sonares (rayas radiales de un solo ping, sólo
+# con --sim-interference)
+PINGS_HISTORIAL_INTERF = 3
+ESCALA_ANILLO_PINGS = 17.0
+PROB_INTERFERENCIA_PING = 0.3
+
+# Respuesta de color (menú respuesta_color 1-4): ganancia adicional
+FACTORES_RESPUESTA_COLOR = {1: 1.0, 2: 1.2, 3: 1.5, 4: 1.9}
+
+def ganancia_tx_tvg(menu_options, dist_norm):
+    """
+    Ganancia por potencia TX y TVG próximo/lejano en función de la distancia
+    normalizada al alcance (0..1). Acepta un escalar o un array de distancias.
+    """
+    ganancia = menu_options.get('potencia_tx', 8) / 10.0
+    tvg_near = menu_options.get('tvg_proximo', 6)
+    if tvg_near > 0:
+        ganancia = ganancia * (1.0 - (tvg_near / 12.0) * np.exp(-dist_norm * 8))
+    tvg_far = menu_options.get('tvg_lejano', 7)
+    if tvg_far > 0:
+        ganancia = ganancia * (1.0 + (tvg_far / 5.0) * dist_norm * dist_norm)
+    return ganancia
+
+def comprimir_cag(buf, nivel_cag, temporal=None):
+    """
+    CAG en sitio sobre buf: buf / (1 + k * buf / 15) con k = nivel_cag / 10. Para ecos
+    débiles equivale a buf - (k / 15) * buf^2, pero es monótona: un eco más fuerte nunca
+    sale más débil, por mucho que lo haya subido el TVG. temporal evita reservar memoria.
+    """
+    if nivel_cag <= 0:
+        return buf
+    np.maximum(buf, 0.0, out=buf)
+    divisor = np.multiply(buf, (nivel_cag / 10.0) / 15.0, out=temporal)
+    divisor += 1.0
+    buf /= divisor
+    return buf
+
+def comprimir_cag_escalar(intensidad, nivel_cag):
+    """
+    comprimir_cag para la intensidad de un solo eco en escala 0..1 (el buffer va de 0 a 15):
+    intensidad / (1 + k * intensidad).
+    """
+    if nivel_cag <= 0:
+        return intensidad
+    intensidad = max(intensidad, 0.0)
+    return intensidad / (1.0 + (nivel_cag / 10.0) * intensidad)
 
 # --- PALETA FURUNO CSH-5L (16 Colores) ---
 COLORES_PALETTE = np.array([
@@ -2309,7 +3798,10 @@ def value_noise_2d(width, height, scale_x, scale_y, seed):
     
     return noise
 
+@functools.lru_cache(maxsize=256)
 def generar_eco_irregular(ancho_a, ancho_r, seed):
+    # Resultado determinista para (ancho_a, ancho_r, seed): se cachea porque con varios
+    # cardúmenes en pantalla se pide cada frame. El array devuelto es de sólo lectura.
     np.random.seed(seed)
     
     # Márgenes más amplios para permitir la deformación
@@ -2326,7 +3818,9 @@ def generar_eco_irregular(ancho_a, ancho_r, seed):
     h, w = aa.shape
     
     if h < 2 or w < 2: # Fallback para dimensiones muy pequeñas
-        return np.zeros((w, h))
+        eco = np.zeros((w, h))
+        eco.setflags(write=False)
+        return eco
 
     # 1. DEFORMACIÓN DE DOMINIO (Warping)
     warp_scale = min(ancho_a, ancho_r) * 0.7
@@ -2366,14 +3860,33 @@ def generar_eco_irregular(ancho_a, ancho_r, seed):
     eco *= 35.0
     eco[densidad_base > 0.65] += 6.0
     
-    return np.clip(eco, 0, 15).T
+    eco = np.clip(eco, 0, 15).T
+    eco.setflags(write=False)
+    return eco
 
 class SonarEchoSimulator:
-    def __init__(self, radius_pixels):
+    def __init__(self, radius_pixels, pings_historial=PINGS_HISTORIAL_INTERF):
         self.radius_pixels = radius_pixels
         self.diameter = 2 * radius_pixels
         self.buffer_polar = np.zeros((NUM_ANGULOS, NUM_RANGOS), dtype=float)
         self.background_noise = np.random.uniform(0, 2.0, (NUM_ANGULOS, NUM_RANGOS))
+        # Buffers preasignados: ruido nuevo de cada ping e historial del promedio de eco
+        self.rng = np.random.default_rng()
+        self.ruido_nuevo = np.empty_like(self.buffer_polar)
+        self.historial_promedio = np.zeros_like(self.buffer_polar)
+        self.historial_valido = False
+        self.rango_historial_m = None
+        # Etapa de ganancia: curva por celda de rango y temporal para el CAG
+        self.curva_ganancia = np.ones(NUM_RANGOS)
+        self.clave_curva_ganancia = None
+        self.temporal = np.empty_like(self.buffer_polar)
+        # Rechazo de interferencias: anillo con los últimos pings cuantificados a uint8
+        self.anillo_pings = np.zeros((max(3, pings_historial), NUM_ANGULOS, NUM_RANGOS), dtype=np.uint8)
+        self.indice_anillo = 0
+        self.pings_en_anillo = 0
+        self.rango_anillo_m = None
+        self.filtrado_u8 = np.empty((NUM_ANGULOS, NUM_RANGOS), dtype=np.uint8)
+        self.auxiliar_u8 = np.empty_like(self.filtrado_u8)
         
         # Superficie persistente para el eco
         self.surface = pygame.Surface((self.diameter, self.diameter))
@@ -2410,9 +3923,115 @@ class SonarEchoSimulator:
             self.init_maps()
             
     def update_background_noise(self):
-        fresh_noise = np.random.uniform(0, 2.5, (NUM_ANGULOS, NUM_RANGOS))
-        self.background_noise = self.background_noise * 0.5 + fresh_noise * 0.5
-        self.buffer_polar = self.background_noise.copy()
+        # Mezcla 50/50 con ruido uniforme nuevo en [0, 2.5), todo sobre buffers preasignados
+        self.rng.random(out=self.ruido_nuevo)
+        self.ruido_nuevo *= 2.5 * 0.5
+        self.background_noise *= 0.5
+        self.background_noise += self.ruido_nuevo
+        np.copyto(self.buffer_polar, self.background_noise)
+
+    def actualizar_curva_ganancia(self, menu_options, rango_actual_m):
+        # La curva (potencia TX + TVG) sólo depende de estos ajustes y de la escala
+        clave = (menu_options.get('potencia_tx', 8), menu_options.get('tvg_proximo', 6),
+                 menu_options.get('tvg_lejano', 7), rango_actual_m)
+        if clave == self.clave_curva_ganancia:
+            return
+        self.clave_curva_ganancia = clave
+        dist_norm = (np.arange(NUM_RANGOS) + 0.5) / NUM_RANGOS
+        self.curva_ganancia = ganancia_tx_tvg(menu_options, dist_norm)
+
+    def aplicar_ganancia(self, menu_options, rango_actual_m):
+        # Etapa de recepción sobre todo el ping (ruido incluido):
+        # potencia TX y TVG (curva por rango), CAG y 2do CAG (compresión de señales
+        # fuertes, ver comprimir_cag) y respuesta de color. Todo en sitio sobre buffer_polar.
+        self.actualizar_curva_ganancia(menu_options, rango_actual_m)
+        buf = self.buffer_polar
+        buf *= self.curva_ganancia # Broadcast por filas (rumbos)
+
+        for nivel_cag in (menu_options.get('cag', 2), menu_options.get('cag_2', 1)):
+            comprimir_cag(buf, nivel_cag, self.temporal)
+
+        factor_respuesta = FACTORES_RESPUESTA_COLOR.get(menu_options.get('respuesta_color', 1), 1.0)
+        if factor_respuesta != 1.0:
+            buf *= factor_respuesta
+
+    def inyectar_interferencia(self):
+        # Interferencia de otro sonar: rayas radiales intensas que sólo aparecen en un ping
+        if self.rng.random() >= PROB_INTERFERENCIA_PING:
+            return
+        for _ in range(int(self.rng.integers(1, 4))):
+            idx_a = int(self.rng.integers(NUM_ANGULOS))
+            r0 = int(self.rng.integers(NUM_RANGOS // 4))
+            r1 = int(self.rng.integers(r0 + NUM_RANGOS // 4, NUM_RANGOS + 1))
+            raya = self.buffer_polar[idx_a:idx_a + 2, r0:r1] # Vista
+            raya[:, ::3] = 12.0 # Trazo discontinuo a lo largo del rango
+
+    def aplicar_rechazo_interferencia(self, nivel, rango_actual_m=None):
+        # Filtro entre pings sobre el anillo de pings cuantificados (uint8), de menos a
+        # más agresivo:
+        #   nivel 1: mediana de 3 (se descarta lo que sólo aparece en 1 de 3 pings)
+        #   nivel 2: mínimo de 2 (el eco debe repetirse en el ping anterior)
+        #   nivel 3: prueba de correlación de 3 pings (mínimo de 3: presente en los 3)
+        if nivel <= 0 or rango_actual_m != self.rango_anillo_m:
+            # Sin filtro o tras un cambio de escala: el historial deja de ser válido
+            self.rango_anillo_m = rango_actual_m
+            self.pings_en_anillo = 0
+            if nivel <= 0:
+                return
+
+        buf = self.buffer_polar
+        n = len(self.anillo_pings)
+        self.indice_anillo = (self.indice_anillo + 1) % n
+        actual = self.anillo_pings[self.indice_anillo]
+        np.multiply(buf, ESCALA_ANILLO_PINGS, out=self.temporal)
+        np.clip(self.temporal, 0, 255, out=self.temporal)
+        actual[...] = self.temporal # Conversión a uint8 en sitio
+        self.pings_en_anillo = min(self.pings_en_anillo + 1, n)
+
+        pings_necesarios = 2 if nivel == 2 else 3
+        if self.pings_en_anillo < pings_necesarios:
+            return
+        anterior = self.anillo_pings[(self.indice_anillo - 1) % n]
+        salida = self.filtrado_u8
+        if nivel == 2:
+            np.minimum(actual, anterior, out=salida)
+        else:
+            previo = self.anillo_pings[(self.indice_anillo - 2) % n]
+            if nivel == 1:
+                # mediana(a, b, c) = max(min(a, b), min(max(a, b), c))
+                np.minimum(actual, anterior, out=salida)
+                np.maximum(actual, anterior, out=self.auxiliar_u8)
+                np.minimum(self.auxiliar_u8, previo, out=self.auxiliar_u8)
+                np.maximum(salida, self.auxiliar_u8, out=salida)
+            else:
+                np.minimum(actual, anterior, out=salida)
+                np.minimum(salida, previo, out=salida)
+        np.multiply(salida, 1.0 / ESCALA_ANILLO_PINGS, out=buf)
+
+    def aplicar_promedio(self, nivel_promedio, estela=False, rango_actual_m=None):
+        # Promedio de eco entre pings consecutivos sobre todo el buffer polar.
+        # nivel_promedio 0-3 -> alpha 1, 1/2, 1/4, 1/8 (peso del ping nuevo).
+        # estela=False: media exponencial  hist = hist + alpha * (ping - hist)
+        # estela=True:  persistencia       hist = max(ping, hist * (1 - alpha))
+        alpha = ALFA_PROMEDIO_ECO[max(0, min(nivel_promedio, len(ALFA_PROMEDIO_ECO) - 1))]
+        hist = self.historial_promedio
+        if rango_actual_m != self.rango_historial_m:
+            # Tras un cambio de escala el historial ya no corresponde a las mismas distancias
+            self.rango_historial_m = rango_actual_m
+            self.historial_valido = False
+        if not self.historial_valido or alpha >= 1.0:
+            np.copyto(hist, self.buffer_polar)
+            self.historial_valido = True
+            return
+        if estela:
+            hist *= (1.0 - alpha)
+            np.maximum(hist, self.buffer_polar, out=hist)
+        else:
+            # buffer_polar se usa como temporal para (ping - hist) * alpha
+            np.subtract(self.buffer_polar, hist, out=self.buffer_polar)
+            self.buffer_polar *= alpha
+            hist += self.buffer_polar
+        np.copyto(self.buffer_polar, hist)
 
     def inject_echo(self, dist_px, angulo_deg, grosor_fisico_m, ancho_fisico_m, rango_actual_m, intensity_factor=1.0, seed=123):
         # dist_px: Distancia en pixeles desde el centro
@@ -2451,6 +4070,9 @@ class SonarEchoSimulator:
         # Asegurar minimos
         ancho_r_buffer = max(5, ancho_r_buffer)
         ancho_a_buffer = max(5, ancho_a_buffer)
+        # El ancho angular cambia con la distancia en cada frame (pose extrapolada): se redondea
+        # a una escalera de ~6% para que la caché de manchas siga acertando.
+        ancho_a_buffer = int(round(PASO_ANCHO_ECO ** round(math.log(ancho_a_buffer, PASO_ANCHO_ECO))))
         
         # Indices angulares
         # angulo_deg es 0..360. Buffer es 0..NUM_ANGULOS
@@ -2460,7 +4082,7 @@ class SonarEchoSimulator:
         mancha = generar_eco_irregular(ancho_a_buffer, ancho_r_buffer, seed)
         
         # Aplicar factor de intensidad calculado externamente (AGC, Gain, etc.)
-        mancha *= intensity_factor
+        mancha = mancha * intensity_factor
         
         w_a, w_r = mancha.shape
         start_a = idx_ang_center - w_a // 2
@@ -2482,6 +4104,59 @@ class SonarEchoSimulator:
             mancha_crop = mancha[:, src_r_start:src_r_end]
             self.buffer_polar[idx_a_target[:, None], np.arange(r_min, r_max)] = np.maximum(zona, mancha_crop)
 
+    def inject_scatterers(self, rumbos_deg, dists_slant_m, amplitudes, rango_actual_m,
+                          intensity_factor=1.0, longitud_impulso_m=0.0):
+        # Eco de un cardumen de partículas: cada pez es un dispersor puntual.
+        # rumbos_deg / dists_slant_m / amplitudes: arrays (un elemento por pez en el haz)
+        # Las amplitudes se acumulan por celda (rumbo, rango) con bincount y se saturan,
+        # de modo que la densidad de peces, no un ruido sintético, da la textura del eco.
+        if rango_actual_m <= 0 or len(amplitudes) == 0: return
+
+        idx_a = np.minimum((rumbos_deg * (NUM_ANGULOS / 360.0)).astype(np.int32), NUM_ANGULOS - 1)
+        idx_r = (dists_slant_m * (NUM_RANGOS / rango_actual_m)).astype(np.int32)
+        dentro = idx_r < NUM_RANGOS
+        if not dentro.all():
+            idx_a, idx_r, amplitudes = idx_a[dentro], idx_r[dentro], amplitudes[dentro]
+            if len(amplitudes) == 0: return
+
+        # Se trabaja sobre el bloque (rumbos x rangos) que ocupa el cardumen, no sobre
+        # las 1440x500 celdas del buffer. La longitud de impulso extiende cada pez
+        # celdas_impulso celdas de rango hacia fuera.
+        celdas_impulso = max(1, int(longitud_impulso_m * NUM_RANGOS / rango_actual_m))
+        desfase = 0
+        if int(idx_a.max()) - int(idx_a.min()) >= NUM_ANGULOS // 2:
+            # Cardumen que cruza 0°/360°: un solo bloque abarcaría las 1440 filas de rumbo.
+            # Girando media vuelta los índices el cardumen queda contiguo, y el bloque se
+            # escribe luego en dos tramos de filas, uno a cada lado del corte.
+            desfase = NUM_ANGULOS // 2
+            idx_a = idx_a + desfase
+            idx_a -= (idx_a >= NUM_ANGULOS) * np.int32(NUM_ANGULOS) # Sin máscara: mitad de los peces a cada lado
+        a0, a1 = int(idx_a.min()), int(idx_a.max())
+        r0, r1 = int(idx_r.min()), int(idx_r.max())
+        filas = a1 - a0 + 1
+        ancho = r1 - r0 + celdas_impulso
+        bloque = np.bincount((idx_a - a0) * ancho + (idx_r - r0), weights=amplitudes,
+                             minlength=filas * ancho).reshape(filas, ancho)
+
+        if celdas_impulso > 1:
+            # Suma móvil a lo largo del rango con cumsum
+            suma = np.cumsum(bloque, axis=1)
+            bloque = suma.copy()
+            bloque[:, celdas_impulso:] -= suma[:, :-celdas_impulso]
+
+        ancho_util = min(ancho, NUM_RANGOS - r0)
+        bloque = bloque[:, :ancho_util]
+        np.multiply(bloque, -1.0 / PECES_SATURACION, out=bloque)
+        np.exp(bloque, out=bloque)
+        valores = (1.0 - bloque) * (15.0 * intensity_factor)
+        fila0 = (a0 + desfase) % NUM_ANGULOS # Fila del buffer de la primera fila del bloque
+        tramo = min(filas, NUM_ANGULOS - fila0)
+        zona = self.buffer_polar[fila0:fila0 + tramo, r0:r0 + ancho_util] # Vista
+        np.maximum(zona, valores[:tramo], out=zona)
+        if tramo < filas:
+            zona = self.buffer_polar[:filas - tramo, r0:r0 + ancho_util]
+            np.maximum(zona, valores[tramo:], out=zona)
+
     def render_sweep(self, current_sweep_radius_px, sweep_speed_px_per_frame, noise_limit_level=0, color_erase_level=0):
         # Simular el barrido radial actualizando solo la banda correspondiente en la imagen final
         
@@ -2611,17 +4286,17 @@ active_sonar_rose_unit_surface = None # Will be rendered in main loop or when co
 # --- END REMOVED UI ELEMENT DEFINITIONS ---
 
 # --- NMEA Transition State ---
-prev_serial_port_available = False # Tracks if NMEA was available in the previous frame for conversion logic
-
-# --- Automatic COM Port Reconnection State ---
-last_reconnect_attempt_time = 0
-RECONNECT_INTERVAL_MS = 5000 # 5 seconds
+marker_fix_pose = None # Last pose with a fix (lat, lon, heading), None while there is none, for the marker conversions
 
 # --- Ship Track Variables ---
-ship_track_points = [] 
 MAX_TRACK_DISTANCE_METERS = 5 * 1852  # 5 Nautical Miles in meters
+TRACK_BUFFER_CAPACITY = 1 << 14     # Points kept at most (about 4.5 h at one point per second)
+TRACK_LOD_BASE_M = 2.0              # Tolerance of the finest simplified level; doubles per level
+TRACK_LOD_LEVELS = 12               # 2 m ... 4 km
+TRACK_LOD_TOLERANCE_PX = 1.0        # Drawn level: the coarsest whose tolerance is under this many pixels
 TRACK_POINT_INTERVAL_MS = 1000      # Add a track point every 1 second
 last_track_point_add_time = 0       # Timestamp of the last added track point
+track_clock_ms = None               # Log clock while replaying NMEA; None = pygame ticks
     # COLOR_TRACK = GRIS_MUY_CLARO        # Color for the track line - Will use current_colors["SHIP_TRACK"]
 # --- End Ship Track Variables ---
 
@@ -2683,11 +4358,240 @@ gain_display_timer = 0
 GAIN_DISPLAY_DURATION_FRAMES = 60 # Approx 1 second at 60 FPS
 
 # --- Target Management System ---
-target_markers = [] # List to store target dictionaries
-triangle_markers = [] # List for independent triangle markers
-TARGET_TYPE_RHOMBUS = "rhombus"
-TARGET_TYPE_X = "x"
-TARGET_TYPE_TRIANGLE = "triangle"
+TARGET_TYPE_RHOMBUS = 0
+TARGET_TYPE_X = 1
+TARGET_TYPE_TRIANGLE = 2
+MARKER_MODE_SCREEN = 0 # Placed without a fix: polar position from the PPI centre
+MARKER_MODE_GEO = 1    # Locked to lat/lon
+MARKER_FLAG_HOVERED = 1
+MARKER_ICON_SIZE = 18  # Rhombus / X / triangle size in pixels (also the hover box)
+MARKER_STORE_INITIAL_CAPACITY = 64
+MARKER_GRID_CELL_PX = MARKER_ICON_SIZE # Hover boxes span at most 2x2 cells of the pick grid
+MARKER_GRID_STRIDE = 1 << 20           # Cell key = cell_y * stride + cell_x
+
+class MarkerStore:
+    """
+    Markers of one kind (targets or triangles) in creation order, one row per marker in parallel
+    NumPy columns so the whole set is reprojected, culled and drawn at once. 'geo' rows keep
+    lat/lon; 'screen' rows keep distance_m and angle_rad (atan2(dy, dx)) from the PPI centre,
+    bearing_rad (from screen up, for the later conversion to 'geo') and the initial screen point
+    (and their lat/lon too when they were 'geo' before the fix was lost, see to_screen()).
+    'version' changes whenever a marker is added, removed or changes mode; reproject() fills
+    x/y (NaN = unknown), on_screen and the rounded screen_x/screen_y.
+
+    Picking uses a uniform screen grid rebuilt by reproject(): the on-screen rows sorted by the
+    key of the cell holding their centre, so hit() only looks at the cells a hover box around
+    the cursor can come from, however many markers there are.
+    """
+    FLOAT_COLUMNS = ('lat', 'lon', 'distance_m', 'angle_rad', 'bearing_rad', 'initial_x', 'initial_y',
+                     'timestamp', 'x', 'y')
+    INT_COLUMNS = (('mode', np.int8), ('type', np.int8), ('flags', np.uint8), ('store_id', np.int64),
+                   ('screen_x', np.int32), ('screen_y', np.int32), ('on_screen', bool))
+
+    def __init__(self, capacity=MARKER_STORE_INITIAL_CAPACITY):
+        self.count = 0
+        self.version = 0
+        for name in self.FLOAT_COLUMNS:
+            setattr(self, name, np.full(capacity, np.nan))
+        for name, dtype in self.INT_COLUMNS:
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+        self.grid_keys = np.empty(0, dtype=np.int64) # Sorted cell keys of the on-screen rows
+        self.grid_rows = np.empty(0, dtype=np.int64) # Row for each key
+        self.grid_x = self.grid_y = np.empty(0, dtype=np.int32) # Screen position for each key
+
+    def __len__(self):
+        return self.count
+
+    def _grow(self):
+        for name in self.FLOAT_COLUMNS + tuple(name for name, _ in self.INT_COLUMNS):
+            column = getattr(self, name)
+            grown = np.full(2 * len(column), np.nan) if column.dtype == float else np.zeros(2 * len(column), column.dtype)
+            grown[:self.count] = column[:self.count]
+            setattr(self, name, grown)
+
+    def add(self, mode, marker_type, timestamp, store_id=None, **values):
+        """Appends a marker; values are float columns (lat/lon or the screen polar data). Returns its row."""
+        if self.count == len(self.mode):
+            self._grow()
+        row = self.count
+        self.count += 1
+        for name in self.FLOAT_COLUMNS:
+            getattr(self, name)[row] = values.get(name, np.nan)
+        self.mode[row], self.type[row], self.timestamp[row] = mode, marker_type, timestamp
+        self.store_id[row] = -1 if store_id is None else store_id
+        self.flags[row] = 0
+        self.on_screen[row] = False
+        self.version += 1
+        return row
+
+    def insert_geo_first(self, marker_type, timestamps, store_ids, lats, lons):
+        """Puts 'geo' markers (older ones, from nav_history) before the existing ones, in the given order."""
+        k = len(timestamps)
+        while self.count + k > len(self.mode):
+            self._grow()
+        for name in self.FLOAT_COLUMNS + tuple(name for name, _ in self.INT_COLUMNS):
+            column = getattr(self, name)
+            column[k:self.count + k] = column[:self.count]
+            column[:k] = np.nan if column.dtype == float else 0
+        self.mode[:k], self.type[:k], self.timestamp[:k] = MARKER_MODE_GEO, marker_type, timestamps
+        self.store_id[:k], self.lat[:k], self.lon[:k] = store_ids, lats, lons
+        self.count += k
+        self.version += 1
+        self._build_grid()
+
+    def remove(self, row):
+        """Deletes a marker, keeping the order of the rest. Returns its nav_history id (or None)."""
+        store_id = int(self.store_id[row])
+        for name in self.FLOAT_COLUMNS + tuple(name for name, _ in self.INT_COLUMNS):
+            column = getattr(self, name)
+            column[row:self.count - 1] = column[row + 1:self.count]
+        self.count -= 1
+        self.version += 1
+        self._build_grid()
+        return None if store_id < 0 else store_id
+
+    def clear(self):
+        self.count = 0
+        self.version += 1
+        self._build_grid()
+
+    def store_ids(self):
+        ids = self.store_id[:self.count]
+        return ids[ids >= 0].tolist()
+
+    def geo_pos(self, row):
+        """(lat, lon) of a 'geo' marker, None otherwise."""
+        if self.mode[row] != MARKER_MODE_GEO or np.isnan(self.lat[row]):
+            return None
+        return float(self.lat[row]), float(self.lon[row])
+
+    def initial_pos(self, row):
+        """Screen point where a 'screen' marker was placed, None if unknown."""
+        if self.mode[row] != MARKER_MODE_SCREEN or np.isnan(self.initial_x[row]):
+            return None
+        return float(self.initial_x[row]), float(self.initial_y[row])
+
+    def to_geo(self, ship_lat, ship_lon, ship_hdg_deg):
+        """
+        Locks every 'screen' marker to lat/lon in one array call. Those that were 'geo' before
+        the fix was lost get their position back; the others are placed from their polar data
+        around the own ship with the local projection. Returns the rows placed from polar data.
+        """
+        n = self.count
+        screen = self.mode[:n] == MARKER_MODE_SCREEN
+        rows = np.flatnonzero(screen & np.isnan(self.lat[:n]) &
+                              ~np.isnan(self.distance_m[:n]) & ~np.isnan(self.bearing_rad[:n]))
+        if len(rows):
+            true_bearing = self.bearing_rad[rows] + math.radians(ship_hdg_deg)
+            self.lat[rows], self.lon[rows] = local_xy_to_geo(self.distance_m[rows] * np.sin(true_bearing),
+                                                             self.distance_m[rows] * np.cos(true_bearing),
+                                                             ship_lat, ship_lon)
+        locked = screen & ~np.isnan(self.lat[:n])
+        if locked.any():
+            self.mode[:n][locked] = MARKER_MODE_GEO
+            self.version += 1
+        return rows
+
+    def to_screen(self, ship_lat, ship_lon, ship_hdg_deg, cc_x, cc_y, px_per_m):
+        """
+        Reverse of to_geo() when the fix is lost: 'geo' markers become 'screen' ones at their
+        polar position from the last known pose (lat/lon are kept for to_geo()), so they stay
+        on the PPI and usable for the target data.
+        """
+        n = self.count
+        rows = np.flatnonzero((self.mode[:n] == MARKER_MODE_GEO) & ~np.isnan(self.lat[:n]))
+        if not len(rows):
+            return
+        x_east, y_north = geo_to_local_xy(self.lat[rows], self.lon[rows], ship_lat, ship_lon)
+        distance_m = np.hypot(x_east, y_north)
+        bearing = np.arctan2(x_east, y_north) - math.radians(ship_hdg_deg) # From screen up, clockwise
+        self.distance_m[rows], self.bearing_rad[rows] = distance_m, bearing
+        self.angle_rad[rows] = np.arctan2(-np.cos(bearing), np.sin(bearing))
+        self.initial_x[rows] = cc_x + distance_m * px_per_m * np.sin(bearing)
+        self.initial_y[rows] = cc_y - distance_m * px_per_m * np.cos(bearing)
+        self.mode[rows] = MARKER_MODE_SCREEN
+        self.version += 1
+
+    def set_hovered(self, row):
+        """Flags one marker (or none, row=None) as hovered."""
+        self.flags[:self.count] &= ~np.uint8(MARKER_FLAG_HOVERED)
+        if row is not None:
+            self.flags[row] |= MARKER_FLAG_HOVERED
+
+    def reproject(self, ship_lat, ship_lon, ship_hdg_deg, cc_x, cc_y, disp_radius_px, range_m):
+        """
+        Screen position of every marker for this pose and view. 'geo' rows are projected head-up
+        around the own ship, 'screen' rows rescaled from their distance in metres; on_screen is
+        set for those within range_m. x/y are also kept beyond the range so the lines towards
+        them can be clipped at the ring. Without polar data a 'screen' row stays where it was placed.
+        """
+        n = self.count
+        x, y, on_screen = self.x[:n], self.y[:n], self.on_screen[:n]
+        x[:] = np.nan
+        y[:] = np.nan
+        on_screen[:] = False
+        geo = self.mode[:n] == MARKER_MODE_GEO
+        polar = ~geo & ~np.isnan(self.distance_m[:n]) & ~np.isnan(self.angle_rad[:n])
+        if range_m > 0 and disp_radius_px > 0:
+            px_per_m = disp_radius_px / range_m
+            if ship_lat is not None and ship_lon is not None and geo.any():
+                x_px, y_px = geo_to_ppi_xy(self.lat[:n][geo], self.lon[:n][geo], ship_lat, ship_lon,
+                                           ship_hdg_deg, px_per_m)
+                x[geo], y[geo] = cc_x + x_px, cc_y + y_px
+                on_screen[geo] = x_px * x_px + y_px * y_px <= disp_radius_px * disp_radius_px
+            r_px = self.distance_m[:n][polar] * px_per_m
+            x[polar] = cc_x + r_px * np.cos(self.angle_rad[:n][polar])
+            y[polar] = cc_y + r_px * np.sin(self.angle_rad[:n][polar])
+            on_screen[polar] = self.distance_m[:n][polar] <= range_m
+        else:
+            polar[:] = False
+        placed = ~geo & ~polar & ~np.isnan(self.initial_x[:n])
+        x[placed], y[placed] = self.initial_x[:n][placed], self.initial_y[:n][placed]
+        on_screen[placed] = True
+        self.screen_x[:n] = np.where(on_screen, np.rint(np.nan_to_num(x)), 0)
+        self.screen_y[:n] = np.where(on_screen, np.rint(np.nan_to_num(y)), 0)
+        self._build_grid()
+
+    def _build_grid(self):
+        rows = np.flatnonzero(self.on_screen[:self.count])
+        keys = ((self.screen_y[rows] // MARKER_GRID_CELL_PX).astype(np.int64) * MARKER_GRID_STRIDE +
+                self.screen_x[rows] // MARKER_GRID_CELL_PX)
+        order = np.argsort(keys, kind='stable')
+        self.grid_keys, self.grid_rows = keys[order], rows[order]
+        self.grid_x, self.grid_y = self.screen_x[self.grid_rows], self.screen_y[self.grid_rows]
+
+    def hit(self, px, py):
+        """First on-screen marker (in creation order) whose hover box contains the point (px, py), or None."""
+        half = MARKER_ICON_SIZE // 2
+        # The box of a marker at (x, y) is [x - half, x - half + size) on each axis, so only
+        # centres in (p + half - size, p + half] can contain p: at most 2x2 cells
+        low_x, high_x = px + half - MARKER_ICON_SIZE + 1, px + half
+        low_y, high_y = py + half - MARKER_ICON_SIZE + 1, py + half
+        cells_x = (low_x // MARKER_GRID_CELL_PX, high_x // MARKER_GRID_CELL_PX)
+        slices = []
+        for cell_y in range(low_y // MARKER_GRID_CELL_PX, high_y // MARKER_GRID_CELL_PX + 1):
+            # Neighbouring cells of one grid row have consecutive keys
+            first, last = np.searchsorted(self.grid_keys, (cell_y * MARKER_GRID_STRIDE + cells_x[0],
+                                                           cell_y * MARKER_GRID_STRIDE + cells_x[1] + 1))
+            if first < last:
+                slices.append(slice(first, last))
+        best = None
+        for cell_slice in slices:
+            xs, ys = self.grid_x[cell_slice], self.grid_y[cell_slice]
+            rows = self.grid_rows[cell_slice][(xs >= low_x) & (xs <= high_x) & (ys >= low_y) & (ys <= high_y)]
+            if len(rows) and (best is None or rows.min() < best):
+                best = int(rows.min())
+        return best
+
+target_markers = MarkerStore() # Rhombus / X markers; the newest two are T1 and T2
+triangle_markers = MarkerStore() # Independent triangle markers
+last_marker_view_key = None # Pose/view the marker screen positions were last computed for
+last_cursor_readout_key = None # Mouse/pose/view the cursor readout in ui_state was computed for
+last_target_data_key = None # Targets version/pose/view the T1-T2 values in ui_state were computed for
+target_panel_cache = {'key': None, 'lines': None} # Rendered T1-T2 panel text (see the main loop)
+target_line_runs = [] # Lines between consecutive targets, clipped at the ring
+last_ais_view_key = None # Same for the AIS vessel projection
+ais_projection = None
 # All markers will be initially white. Hovering will make them red.
 # COLOR_TARGET_BASE = BLANCO # Base color for all markers - Will use current_colors["TARGET_BASE"]
 # COLOR_TARGET_HOVER = ROJO    # Color when hovered or selected - Will use current_colors["TARGET_HOVER"]
@@ -2750,172 +4654,117 @@ def handle_key_events(event_key, circle_center_x_param, circle_center_y_param, d
         gain_display_timer = GAIN_DISPLAY_DURATION_FRAMES
     elif event_key == pygame.K_a:
         if ui_state["show_plus_cursor"]:
-            mouse_cursor_x, mouse_cursor_y = ui_state["mouse_cursor_pos"]
-            current_time = pygame.time.get_ticks()
-
-            new_marker = {
-                'mode': None, # Will be 'geo' or 'screen'
-                'geo_pos': None, # For 'geo' mode
-                'initial_screen_pos': None, # For 'screen' mode: (abs_x, abs_y) at creation, less critical now
-                'initial_distance_meters': None, # For 'screen' mode: conceptual distance from center, in METERS
-                'original_angle_rad': None, # For 'screen' mode: standard math angle (atan2(dy,dx)) from center
-                'screen_bearing_rad': None, # For 'screen' mode: visual angle from screen up (atan2(dx,-dy)) for NMEA conversion
-                'type': TARGET_TYPE_TRIANGLE,
-                'timestamp': current_time,
-                'current_screen_pos': None,
-                'is_hovered': False
-            }
-
-            if current_ship_lat_deg is not None and current_ship_lon_deg is not None:
-                new_marker['mode'] = 'geo'
-                pixel_dist_from_center = math.sqrt((mouse_cursor_x - circle_center_x_param)**2 + (mouse_cursor_y - circle_center_y_param)**2)
-                distance_m_from_ship = (pixel_dist_from_center / display_radius_pixels_param) * s_max_current_range_param if display_radius_pixels_param > 0 else 0
-                if current_unit == "BRAZAS":
-                    distance_m_from_ship *= 1.8288
-                
-                dx = mouse_cursor_x - circle_center_x_param
-                dy = mouse_cursor_y - circle_center_y_param
-                visual_angle_rad = math.atan2(dx, -dy)
-                visual_bearing_deg = (math.degrees(visual_angle_rad) + 360) % 360
-                # Use current_ship_heading instead of effective_heading to avoid incorporating bow adjustment into marker creation
-                true_bearing_deg = (visual_bearing_deg + current_ship_heading) % 360
-
-                start_point = Point(latitude=current_ship_lat_deg, longitude=current_ship_lon_deg)
-                if distance_m_from_ship < 0: distance_m_from_ship = 0
-                destination = geodesic(meters=distance_m_from_ship).destination(point=start_point, bearing=true_bearing_deg)
-                new_marker['geo_pos'] = {'lat': destination.latitude, 'lon': destination.longitude}
-            else:
-                new_marker['mode'] = 'screen'
-                new_marker['initial_screen_pos'] = (mouse_cursor_x, mouse_cursor_y)
-                new_marker['initial_S_max'] = s_max_current_range_param
-                new_marker['initial_display_radius_pixels'] = display_radius_pixels_param
-                
-                pixel_dist_from_center = math.sqrt((mouse_cursor_x - circle_center_x_param)**2 + (mouse_cursor_y - circle_center_y_param)**2)
-                if display_radius_pixels_param > 0:
-                    conceptual_distance_in_current_units = (pixel_dist_from_center / display_radius_pixels_param) * s_max_current_range_param
-                else:
-                    conceptual_distance_in_current_units = 0
-                
-                if current_unit == "BRAZAS":
-                    new_marker['initial_distance_meters'] = conceptual_distance_in_current_units * 1.8288
-                else:
-                    new_marker['initial_distance_meters'] = conceptual_distance_in_current_units
-                
-                dx_orig = mouse_cursor_x - circle_center_x_param
-                dy_orig = mouse_cursor_y - circle_center_y_param
-                new_marker['original_angle_rad'] = math.atan2(dy_orig, dx_orig)
-                new_marker['screen_bearing_rad'] = math.atan2(dx_orig, -dy_orig) 
-
-                new_marker['geo_pos'] = None
-            
-            triangle_markers.append(new_marker)
+            add_marker_at_cursor(triangle_markers, TARGET_TYPE_TRIANGLE, 'triangle', *ui_state["mouse_cursor_pos"],
+                                 circle_center_x_param, circle_center_y_param,
+                                 display_radius_pixels_param, s_max_current_range_param)
 
     elif event_key == pygame.K_f:
         if ui_state["show_plus_cursor"]: # Only add marker if cursor is active in sonar circle
-            mouse_cursor_x, mouse_cursor_y = ui_state["mouse_cursor_pos"]
-            current_time = pygame.time.get_ticks()
-
-            new_marker = {
-                'mode': None, # Will be 'geo' or 'screen'
-                'geo_pos': None, # For 'geo' mode
-                'initial_screen_pos': None, # For 'screen' mode: (abs_x, abs_y) at creation, less critical now
-                'initial_distance_meters': None, # For 'screen' mode: conceptual distance from center, in METERS
-                'original_angle_rad': None, # For 'screen' mode: standard math angle (atan2(dy,dx)) from center
-                'screen_bearing_rad': None, # For 'screen' mode: visual angle from screen up (atan2(dx,-dy)) for NMEA conversion
-                'type': TARGET_TYPE_RHOMBUS,
-                # 'color': COLOR_TARGET_BASE, # Color will be determined by current_colors and hover state
-                'timestamp': current_time,
-                'current_screen_pos': None,
-                'is_hovered': False
-            }
-
-            if current_ship_lat_deg is not None and current_ship_lon_deg is not None:
-                new_marker['mode'] = 'geo'
-                # Calculate and store geo_pos for GEO marker
-                pixel_dist_from_center = math.sqrt((mouse_cursor_x - circle_center_x_param)**2 + (mouse_cursor_y - circle_center_y_param)**2)
-                # distance_m_from_ship is the true slant distance in meters
-                distance_m_from_ship = (pixel_dist_from_center / display_radius_pixels_param) * s_max_current_range_param if display_radius_pixels_param > 0 else 0
-                if current_unit == "BRAZAS": # s_max_current_range_param is in brazas, convert to meters for geo calc
-                    distance_m_from_ship *= 1.8288
-                
-                dx = mouse_cursor_x - circle_center_x_param
-                dy = mouse_cursor_y - circle_center_y_param # Pygame y is inverted for visual angle
-                visual_angle_rad = math.atan2(dx, -dy) # atan2(x,y) for bearing from North axis
-                visual_bearing_deg = (math.degrees(visual_angle_rad) + 360) % 360
-                # Use current_ship_heading instead of effective_heading to avoid incorporating bow adjustment into marker creation
-                true_bearing_deg = (visual_bearing_deg + current_ship_heading) % 360
-
-                start_point = Point(latitude=current_ship_lat_deg, longitude=current_ship_lon_deg)
-                if distance_m_from_ship < 0: distance_m_from_ship = 0 # Should not happen with sqrt
-                destination = geodesic(meters=distance_m_from_ship).destination(point=start_point, bearing=true_bearing_deg)
-                new_marker['geo_pos'] = {'lat': destination.latitude, 'lon': destination.longitude}
-            else:
-                # SCREEN marker: No NMEA data
-                new_marker['mode'] = 'screen'
-                new_marker['initial_screen_pos'] = (mouse_cursor_x, mouse_cursor_y) # Absolute screen pixels
-                new_marker['initial_S_max'] = s_max_current_range_param # Sonar range (units) at creation
-                new_marker['initial_display_radius_pixels'] = display_radius_pixels_param # Sonar radius (pixels) at creation
-                
-                # Calculate conceptual distance in current display units
-                pixel_dist_from_center = math.sqrt((mouse_cursor_x - circle_center_x_param)**2 + (mouse_cursor_y - circle_center_y_param)**2)
-                if display_radius_pixels_param > 0:
-                    conceptual_distance_in_current_units = (pixel_dist_from_center / display_radius_pixels_param) * s_max_current_range_param
-                else:
-                    conceptual_distance_in_current_units = 0
-                
-                # Convert to meters and store
-                if current_unit == "BRAZAS": # current_unit is global, reflects unit at marker creation
-                    new_marker['initial_distance_meters'] = conceptual_distance_in_current_units * 1.8288
-                else: # Assumed METERS
-                    new_marker['initial_distance_meters'] = conceptual_distance_in_current_units
-                
-                # Calculate and store the original angle from center
-                dx_orig = mouse_cursor_x - circle_center_x_param
-                dy_orig = mouse_cursor_y - circle_center_y_param
-                new_marker['original_angle_rad'] = math.atan2(dy_orig, dx_orig) # Standard math angle (0 rad = screen right)
-                # Calculate and store screen bearing (0 rad = screen up, positive clockwise)
-                new_marker['screen_bearing_rad'] = math.atan2(dx_orig, -dy_orig) 
-
-                new_marker['geo_pos'] = None
-            
-            # Common logic for adding marker and updating previous ones
-            # Type (shape) update remains.
-            if len(target_markers) > 0: # If there's at least one marker already
-                # The one just about to become "previous" (currently the last one)
-                # should retain its shape (Rhombus) but will be COLOR_TARGET_BASE.
-                # Its color will only change if hovered.
-                if len(target_markers) >= 2: # If there are at least two markers already
-                    # The one that was T1 (target_markers[-2]) now becomes T0 (the oldest displayable X)
-                    older_marker = target_markers[-2]
-                    older_marker['type'] = TARGET_TYPE_X
-                    # Its color is already COLOR_TARGET_BASE or will be set by hover.
-            
-            target_markers.append(new_marker)
+            add_marker_at_cursor(target_markers, TARGET_TYPE_RHOMBUS, 'target', *ui_state["mouse_cursor_pos"],
+                                 circle_center_x_param, circle_center_y_param,
+                                 display_radius_pixels_param, s_max_current_range_param)
+            # The previous T1 becomes T0 (the oldest displayable X)
+            refresh_target_types()
     
     elif event_key == pygame.K_d:
-        if ui_state['hovered_marker_index'] is not None:
-            if ui_state['hovered_marker_list'] == 'target' and ui_state['hovered_marker_index'] < len(target_markers):
-                target_markers.pop(ui_state['hovered_marker_index'])
-                
-                # Re-evaluate T0, T1, T2 shapes after deletion
-                if len(target_markers) >= 1:
-                    target_markers[-1]['type'] = TARGET_TYPE_RHOMBUS
-                if len(target_markers) >= 2:
-                    target_markers[-2]['type'] = TARGET_TYPE_RHOMBUS
-                if len(target_markers) >= 3:
-                    for i in range(len(target_markers) - 2):
-                        target_markers[i]['type'] = TARGET_TYPE_X
-                if len(target_markers) == 1:
-                    target_markers[0]['type'] = TARGET_TYPE_RHOMBUS
-                elif len(target_markers) == 2:
-                    target_markers[0]['type'] = TARGET_TYPE_RHOMBUS
-                    target_markers[1]['type'] = TARGET_TYPE_RHOMBUS
-
-            elif ui_state['hovered_marker_list'] == 'triangle' and ui_state['hovered_marker_index'] < len(triangle_markers):
-                triangle_markers.pop(ui_state['hovered_marker_index'])
-
-            ui_state['hovered_marker_index'] = None
-            ui_state['hovered_marker_list'] = None
+        hovered_row = ui_state['hovered_marker_index']
+        markers = {'target': target_markers, 'triangle': triangle_markers}.get(ui_state['hovered_marker_list'])
+        if hovered_row is not None and markers is not None and hovered_row < len(markers):
+            store_id = markers.remove(hovered_row)
+            if markers is target_markers:
+                refresh_target_types() # Re-evaluate T0, T1, T2 shapes after deletion
+            if store_id is not None and nav_history is not None:
+                nav_history.delete_marks([store_id])
+        ui_state['hovered_marker_index'] = None
+        ui_state['hovered_marker_list'] = None
+
+def add_marker_at_cursor(markers, marker_type, kind, mouse_cursor_x, mouse_cursor_y,
+                         circle_center_x_param, circle_center_y_param,
+                         display_radius_pixels_param, s_max_current_range_param):
+    """
+    Adds a marker under the cursor: 'geo' (also stored in nav_history as kind) when the ship
+    position is known, otherwise 'screen' with its distance in metres and angles from the centre.
+    """
+    current_time = pygame.time.get_ticks()
+    dx = mouse_cursor_x - circle_center_x_param
+    dy = mouse_cursor_y - circle_center_y_param # Pygame y is inverted for visual angle
+    pixel_dist_from_center = math.sqrt(dx**2 + dy**2)
+    distance_m = (pixel_dist_from_center / display_radius_pixels_param) * s_max_current_range_param if display_radius_pixels_param > 0 else 0
+    if current_unit == "BRAZAS": # s_max_current_range_param is in brazas
+        distance_m *= 1.8288
+
+    if current_ship_lat_deg is not None and current_ship_lon_deg is not None:
+        visual_bearing_deg = (math.degrees(math.atan2(dx, -dy)) + 360) % 360 # atan2(x,y) for bearing from North axis
+        # Use current_ship_heading instead of effective_heading to avoid incorporating bow adjustment into marker creation
+        true_bearing_deg = (visual_bearing_deg + current_ship_heading) % 360
+        start_point = Point(latitude=current_ship_lat_deg, longitude=current_ship_lon_deg)
+        destination = geodesic(meters=distance_m).destination(point=start_point, bearing=true_bearing_deg)
+        store_id = None
+        if nav_history is not None:
+            store_id = nav_history.add_mark(time.time(), destination.latitude, destination.longitude, kind)
+        return markers.add(MARKER_MODE_GEO, marker_type, current_time, store_id,
+                           lat=destination.latitude, lon=destination.longitude)
+
+    # SCREEN marker: No NMEA data. angle_rad is the standard math angle (0 rad = screen right),
+    # bearing_rad the visual one (0 rad = screen up, positive clockwise) for the NMEA conversion.
+    return markers.add(MARKER_MODE_SCREEN, marker_type, current_time,
+                       distance_m=distance_m, angle_rad=math.atan2(dy, dx), bearing_rad=math.atan2(dx, -dy),
+                       initial_x=mouse_cursor_x, initial_y=mouse_cursor_y)
+
+def refresh_target_types():
+    """The newest two targets (T1 and T2) are rhombuses, the older ones X marks."""
+    n = len(target_markers)
+    target_markers.type[:n] = TARGET_TYPE_X
+    target_markers.type[max(n - 2, 0):n] = TARGET_TYPE_RHOMBUS
+
+def lock_screen_markers(ship_lat, ship_lon, ship_hdg_deg):
+    """'screen' markers of both stores become 'geo' with a fix; the newly placed ones are stored in nav_history."""
+    for markers, kind in ((target_markers, 'target'), (triangle_markers, 'triangle')):
+        rows = markers.to_geo(ship_lat, ship_lon, ship_hdg_deg)
+        if len(rows) and nav_history is not None:
+            markers.store_id[rows] = nav_history.add_marks(time.time(), markers.lat[rows].tolist(),
+                                                           markers.lon[rows].tolist(), kind)
+        if len(rows):
+            print(f"INFO: {len(rows)} marca(s) de pantalla fijadas en posición geográfica.")
+
+def restore_stored_marks(store, span_h):
+    """
+    Puts the marks stored in the last span_h hours back on the PPI as 'geo' markers, before
+    the ones placed in this session (which stay T1 and T2). Marks already shown are skipped.
+    """
+    now_s, now_ms = time.time(), pygame.time.get_ticks()
+    shown = set(target_markers.store_ids()) | set(triangle_markers.store_ids())
+    restored = {'target': [], 'triangle': []}
+    for mark_id, t, lat, lon, kind in store.marks_in_box((-90.0, 90.0, -180.0, 180.0), now_s - span_h * 3600.0, now_s):
+        if mark_id not in shown: # Same tick scale as new markers, for the T1-T2 speed
+            restored['triangle' if kind == 'triangle' else 'target'].append((now_ms - (now_s - t) * 1000.0, mark_id, lat, lon))
+    for markers, marker_type, kind in ((target_markers, TARGET_TYPE_X, 'target'),
+                                       (triangle_markers, TARGET_TYPE_TRIANGLE, 'triangle')):
+        if restored[kind]:
+            markers.insert_geo_first(marker_type, *(np.array(column) for column in zip(*restored[kind])))
+    refresh_target_types()
+    if restored['target'] or restored['triangle']:
+        print(f"INFO: Restauradas {len(restored['target'])} marcas de blanco y {len(restored['triangle'])} triángulos del historial.")
+
+def update_nav_history(span_h, have_fix):
+    """
+    Opens the history store (restoring its marks) the first time it is enabled with a fix, and
+    closes it when SISTEMA > HISTORIAL DERROTA is switched OFF, so nothing is written then.
+    """
+    global nav_history, nav_history_failed
+    if span_h <= 0:
+        if nav_history is not None:
+            nav_history.close()
+            nav_history = None
+            _history_cache['query_key'] = None # Queried again if it is enabled later
+            print("INFO: Historial de navegación desactivado.")
+        nav_history_failed = False
+    elif nav_history is None and have_fix and not nav_history_failed:
+        nav_history = open_nav_history()
+        if nav_history is None:
+            nav_history_failed = True # Not retried every frame; switching the option OFF/ON retries
+        else:
+            restore_stored_marks(nav_history, span_h)
 
 
 # --- End Key Event Handling Function ---
@@ -2954,44 +4803,287 @@ def draw_triangle(surface, color, center_x, center_y, size):
     ]
     pygame.draw.polygon(surface, color, points, 2) # Border only
 
+def draw_markers(surface, markers, cc_x, cc_y, disp_radius_px, base_color, hover_color):
+    """
+    Draws every visible marker with its shape in one pass over the store. 'geo' markers are
+    culled when their icon would fall outside the sonar circle.
+    """
+    n = len(markers)
+    xs, ys = markers.screen_x[:n], markers.screen_y[:n]
+    reach = disp_radius_px + MARKER_ICON_SIZE / 2
+    visible = markers.on_screen[:n] & ((markers.mode[:n] == MARKER_MODE_SCREEN) |
+                                       ((xs - cc_x) ** 2 + (ys - cc_y) ** 2 <= reach * reach))
+    rows = np.flatnonzero(visible)
+    hovered = (markers.flags[rows] & MARKER_FLAG_HOVERED).tolist()
+    for x, y, marker_type, is_hovered in zip(xs[rows].tolist(), ys[rows].tolist(), markers.type[rows].tolist(), hovered):
+        MARKER_SHAPES[marker_type](surface, hover_color if is_hovered else base_color, x, y, MARKER_ICON_SIZE)
+
+MARKER_SHAPES = {TARGET_TYPE_RHOMBUS: draw_rhombus, TARGET_TYPE_X: draw_x_mark, TARGET_TYPE_TRIANGLE: draw_triangle}
+
 # --- Ship Track Logic ---
+class ShipTrack:
+    """
+    Own-ship track in preallocated ring arrays (lat, lon, time and cumulative distance).
+    Appending measures one segment; trimming to max_length_m only advances the start index.
+    'start' and 'end' count points ever appended, so the ring slot of point i is i % capacity.
+
+    'lod' is a pyramid of simplified tracks (point numbers per level), built as points arrive:
+    a point enters level k once the ship has sailed TRACK_LOD_BASE_M * 2**k since the last point
+    kept there, so every skipped point lies within that tolerance of the kept point before it.
+    points() starts every level at the oldest point, which may be skipped after a trim.
+    """
+    def __init__(self, capacity=TRACK_BUFFER_CAPACITY, max_length_m=MAX_TRACK_DISTANCE_METERS):
+        self.capacity = capacity
+        self.max_length_m = max_length_m
+        self.lat = np.zeros(capacity)
+        self.lon = np.zeros(capacity)
+        self.time = np.zeros(capacity)
+        self.cumdist = np.zeros(capacity) # Metres sailed since the first point ever appended
+        self.start = 0
+        self.end = 0
+        self.version = 0 # Changes with every append or clear
+        self.lod = [collections.deque() for _ in range(TRACK_LOD_LEVELS)]
+
+    def __len__(self):
+        return self.end - self.start
+
+    def clear(self):
+        self.start = self.end = 0
+        for level in self.lod:
+            level.clear()
+        self.version += 1
+
+    def append(self, lat, lon, t):
+        slot = self.end % self.capacity
+        if self.end > self.start:
+            last = (self.end - 1) % self.capacity
+            dx, dy = geo_to_local_xy(lat, lon, self.lat[last], self.lon[last])
+            self.cumdist[slot] = self.cumdist[last] + math.hypot(dx, dy)
+        else:
+            self.cumdist[slot] = 0.0
+        self.lat[slot], self.lon[slot], self.time[slot] = lat, lon, t
+        self.end += 1
+        if self.end - self.start > self.capacity: # Full: the oldest slot was just overwritten
+            self.start += 1
+        newest = self.cumdist[slot]
+        while self.end - self.start > 1 and newest - self.cumdist[self.start % self.capacity] > self.max_length_m:
+            self.start += 1
+
+        for level in self.lod:
+            while level and level[0] < self.start:
+                level.popleft()
+        tolerance = TRACK_LOD_BASE_M
+        for level in self.lod:
+            # Every level is checked: a point skipped by a finer level may be due in a coarser one
+            if not level or newest - self.cumdist[level[-1] % self.capacity] >= tolerance:
+                level.append(self.end - 1)
+            tolerance *= 2.0
+        self.version += 1
+
+    def length_m(self):
+        if self.end - self.start < 2:
+            return 0.0
+        return self.cumdist[(self.end - 1) % self.capacity] - self.cumdist[self.start % self.capacity]
+
+    def _ordered(self, column):
+        first, last = self.start % self.capacity, self.end % self.capacity
+        if len(self) == 0:
+            return column[:0]
+        if first < last:
+            return column[first:last]
+        return np.concatenate((column[first:], column[:last]))
+
+    def points(self, tolerance_m=0.0):
+        """
+        (lat, lon) arrays from oldest to newest: every point, or the coarsest simplified level
+        whose tolerance does not exceed tolerance_m.
+        """
+        if tolerance_m < TRACK_LOD_BASE_M:
+            return self._ordered(self.lat), self._ordered(self.lon)
+        level = self.lod[min(int(math.log2(tolerance_m / TRACK_LOD_BASE_M)), len(self.lod) - 1)]
+        numbers = np.fromiter(level, dtype=np.int64, count=len(level))
+        if len(self) and (not len(numbers) or numbers[0] != self.start):
+            numbers = np.concatenate(([self.start], numbers)) # Its kept point before was trimmed
+        slots = numbers % self.capacity
+        return self.lat[slots], self.lon[slots]
+
+ship_track = ShipTrack()
+
 def update_ship_track():
-    global last_track_point_add_time, ship_track_points, current_ship_lat_deg, current_ship_lon_deg
+    global last_track_point_add_time, current_ship_lat_deg, current_ship_lon_deg
 
     if current_ship_lat_deg is None or current_ship_lon_deg is None:
-        if len(ship_track_points) > 0: # Clear track if we lose position
+        if len(ship_track) > 0: # Clear track if we lose position
             # print("Lost ship position, clearing track.") # Debug
-            ship_track_points.clear()
+            ship_track.clear()
+            if nav_history is not None:
+                nav_history.break_track()
         return
 
-    current_time = pygame.time.get_ticks()
+    current_time = pygame.time.get_ticks() if track_clock_ms is None else track_clock_ms
     if current_time - last_track_point_add_time >= TRACK_POINT_INTERVAL_MS:
-        new_point = {'lat': current_ship_lat_deg, 'lon': current_ship_lon_deg}
-        ship_track_points.append(new_point)
+        ship_track.append(current_ship_lat_deg, current_ship_lon_deg, current_time / 1000.0)
         last_track_point_add_time = current_time
-        # print(f"Added track point: {new_point}, Total points: {len(ship_track_points)}") # Debug
-
-        # Manage track length
-        current_track_length_meters = 0
-        points_to_keep = []
-        if len(ship_track_points) >= 2:
-            # Iterate in reverse to sum distances from newest to oldest
-            # and keep points that fall within the MAX_TRACK_DISTANCE_METERS
-            temp_points_in_range = [ship_track_points[-1]] # Always keep the last point
-            for i in range(len(ship_track_points) - 2, -1, -1):
-                p1 = Point(latitude=ship_track_points[i+1]['lat'], longitude=ship_track_points[i+1]['lon'])
-                p2 = Point(latitude=ship_track_points[i]['lat'], longitude=ship_track_points[i]['lon'])
-                segment_distance = geodesic(p1, p2).meters
-                if current_track_length_meters + segment_distance <= MAX_TRACK_DISTANCE_METERS:
-                    current_track_length_meters += segment_distance
-                    temp_points_in_range.insert(0, ship_track_points[i]) # Insert at beginning to maintain order
-                else:
-                    break # Stop adding older points
-            ship_track_points = temp_points_in_range
-            # print(f"Track managed. Points: {len(ship_track_points)}, Length: {current_track_length_meters:.2f}m") # Debug
+        if nav_history is not None and track_clock_ms is None: # Replayed logs are not stored
+            nav_history.add_track_point(time.time(), current_ship_lat_deg, current_ship_lon_deg)
+        # print(f"Track: {len(ship_track)} points, {ship_track.length_m():.2f}m") # Debug
 
 # --- End Ship Track Logic ---
 
+# --- Own-Ship Motion Estimator ---
+MOTION_HISTORY_SIZE = 16          # Timestamped fixes kept in the ring buffer
+MOTION_ALPHA = 0.5                # Alpha-beta gains: position correction...
+MOTION_BETA = 0.2                 # ...and velocity / turn-rate correction
+MOTION_MAX_EXTRAPOLATION_S = 2.0  # Hold the pose if no new fix arrives for longer than this
+MOTION_MAX_JUMP_M = 500.0         # A fix this far from the prediction restarts the filter
+MOTION_MAX_TURN_RATE_DPS = 30.0
+KNOTS_TO_MPS = 1852.0 / 3600.0
+
+class ShipMotionEstimator:
+    """
+    Smooth own-ship pose between NMEA fixes (typically 1-10 Hz) for 60 FPS rendering.
+    Every new fix goes into a ring buffer of (t, lat, lon, sog, cog) and an alpha-beta filter
+    working in local metres; predict() extrapolates position and heading to the frame time.
+    Speed and course over ground come from the fix itself (RMC) or from VTG; without them the
+    velocity is seeded from the two newest fixes. The heading only rotates the picture.
+    """
+    def __init__(self, size=MOTION_HISTORY_SIZE, alpha=MOTION_ALPHA, beta=MOTION_BETA):
+        self.history = np.zeros((size, 5)) # t, lat, lon, sog_mps, cog_deg
+        self.alpha = alpha
+        self.beta = beta
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.head = 0
+        self.ref_lat = self.ref_lon = None # Local plane origin (re-centred on every fix)
+        self.t_fix = None
+        self.x = self.y = 0.0
+        self.vx = self.vy = 0.0
+        self.velocity_known = False # False until SOG/COG or two fixes gave the velocity
+        self.hdg = None
+        self.hdg_rate = 0.0
+        self.t_hdg = None
+        self.last_fix = self.last_heading = None
+        self.published = None
+        self.version = 0 # Bumped every time render_pose() publishes a new pose
+
+    def observe(self, t, state):
+        """Feeds the fix and heading records that changed since the last call (compared by identity)."""
+        if state.fix is not self.last_fix:
+            self.last_fix = state.fix
+            if state.fix is None or state.fix.lat is None or state.fix.lon is None:
+                self.reset()
+            else:
+                sog_knots, cog_deg = state.fix.sog_knots, state.fix.cog_deg
+                if cog_deg is None and state.speed is not None and state.speed.course is not None:
+                    sog_knots, cog_deg = state.speed.knots, state.speed.course # VTG (over ground)
+                self._add_fix(t, state.fix.lat, state.fix.lon, sog_knots if cog_deg is not None else None, cog_deg)
+        if state.heading is not self.last_heading:
+            self.last_heading = state.heading
+            if state.heading is not None:
+                self._add_heading(t, state.heading.degrees)
+
+    def _seed_velocity(self, sog_mps, cog_deg):
+        self.velocity_known = True
+        if sog_mps is not None and cog_deg is not None:
+            cog_rad = math.radians(cog_deg)
+            self.vx, self.vy = sog_mps * math.sin(cog_rad), sog_mps * math.cos(cog_rad)
+            return
+        self.vx = self.vy = 0.0
+        self.velocity_known = False # Held still until a second fix gives the direction
+        if self.count >= 2:
+            # No speed/course over ground: straight line through the two newest buffered fixes
+            n = len(self.history)
+            t1, lat1, lon1 = self.history[(self.head - 1) % n, :3]
+            t0, lat0, lon0 = self.history[(self.head - 2) % n, :3]
+            if t1 > t0:
+                dx, dy = geo_to_local_xy(lat1, lon1, lat0, lon0)
+                self.vx, self.vy = dx / (t1 - t0), dy / (t1 - t0)
+                self.velocity_known = True
+
+    def _add_fix(self, t, lat, lon, sog_knots, cog_deg):
+        """sog_knots/cog_deg: speed and course over ground, None if unknown."""
+        sog_mps = sog_knots * KNOTS_TO_MPS if sog_knots is not None else None
+        self.history[self.head] = (t, lat, lon, np.nan if sog_mps is None else sog_mps,
+                                   np.nan if cog_deg is None else cog_deg)
+        self.head = (self.head + 1) % len(self.history)
+        self.count = min(self.count + 1, len(self.history))
+
+        if self.ref_lat is None:
+            self.ref_lat, self.ref_lon = lat, lon
+            self.x = self.y = 0.0
+            self._seed_velocity(sog_mps, cog_deg)
+            self.t_fix = t
+            return
+
+        mx, my = geo_to_local_xy(lat, lon, self.ref_lat, self.ref_lon)
+        dt = t - self.t_fix
+        if dt <= 0: # Several fixes drained in the same frame: take the newest as is
+            self.x, self.y = mx, my
+        else:
+            px, py = self.x + self.vx * dt, self.y + self.vy * dt
+            rx, ry = mx - px, my - py
+            if dt > MOTION_MAX_EXTRAPOLATION_S or math.hypot(rx, ry) > MOTION_MAX_JUMP_M or not self.velocity_known:
+                self.x, self.y = mx, my
+                self._seed_velocity(sog_mps, cog_deg)
+            else:
+                self.x, self.y = px + self.alpha * rx, py + self.alpha * ry
+                self.vx += self.beta * rx / dt
+                self.vy += self.beta * ry / dt
+        self.t_fix = t
+        # Re-centre the local plane on the filtered position so the flat projection stays exact
+        self.ref_lat, self.ref_lon = local_xy_to_geo(self.x, self.y, self.ref_lat, self.ref_lon)
+        self.x = self.y = 0.0
+
+    def _add_heading(self, t, degrees):
+        if self.hdg is None or t - self.t_hdg > MOTION_MAX_EXTRAPOLATION_S:
+            self.hdg, self.hdg_rate = degrees, 0.0
+        elif t > self.t_hdg:
+            dt = t - self.t_hdg
+            predicted = self.hdg + self.hdg_rate * dt
+            r = (degrees - predicted + 180.0) % 360.0 - 180.0
+            self.hdg = (predicted + self.alpha * r) % 360.0
+            self.hdg_rate = max(-MOTION_MAX_TURN_RATE_DPS,
+                                min(MOTION_MAX_TURN_RATE_DPS, self.hdg_rate + self.beta * r / dt))
+        else:
+            self.hdg = degrees
+        self.t_hdg = t
+
+    def predict(self, t):
+        """Extrapolated (lat, lon, heading_deg) at time t, or None without a valid fix."""
+        if self.ref_lat is None:
+            return None
+        dt = min(max(t - self.t_fix, 0.0), MOTION_MAX_EXTRAPOLATION_S)
+        lat, lon = local_xy_to_geo(self.x + self.vx * dt, self.y + self.vy * dt, self.ref_lat, self.ref_lon)
+        if self.hdg is None:
+            return lat, lon, 0.0
+        dt_hdg = min(max(t - self.t_hdg, 0.0), MOTION_MAX_EXTRAPOLATION_S)
+        return lat, lon, (self.hdg + self.hdg_rate * dt_hdg) % 360.0
+
+    def render_pose(self, t, metres_per_px, radius_px):
+        """
+        Predicted pose for this frame. The previous pose is kept (same object, same version)
+        while the change would move the picture by less than one pixel, so the callers can
+        skip reprojecting markers and track.
+        """
+        pose = self.predict(t)
+        if pose is None:
+            self.published = None
+            return None
+        if self.published is not None:
+            lat0, lon0, hdg0 = self.published
+            dx, dy = geo_to_local_xy(pose[0], pose[1], lat0, lon0)
+            dh = abs((pose[2] - hdg0 + 180.0) % 360.0 - 180.0)
+            if math.hypot(dx, dy) < metres_per_px and math.radians(dh) * radius_px < 1.0:
+                return self.published
+        self.published = pose
+        self.version += 1
+        return pose
+
+ship_motion = ShipMotionEstimator()
+# --- End Own-Ship Motion Estimator ---
+
 # --- Track Drawing Logic ---
 def get_geo_line_circle_intersection(p1_geo, p2_geo, center_geo, radius_m):
     """
@@ -3036,93 +5128,6 @@ def get_geo_line_circle_intersection(p1_geo, p2_geo, center_geo, radius_m):
         return Point(latitude=intersect_lat, longitude=intersect_lon)
     return None
 
-# --- Screen Coordinate Line-Circle Intersection for Target Markers ---
-def get_screen_line_circle_intersection(p1_screen, p2_screen, circle_center_x, circle_center_y, circle_radius_pixels):
-    # p1 is assumed to be inside or on the circle, p2 is used for direction and assumed to be outside.
-    # Calculates intersection of the ray p1->p2 with the circle.
-    # Uses normalized direction vector for better numerical stability.
-
-    x1, y1 = p1_screen
-    x2, y2 = p2_screen # p2 is used for direction; can be far outside
-    cx, cy = circle_center_x, circle_center_y
-    r = circle_radius_pixels
-
-    # Translate points so circle is at origin for easier math
-    x1_trans, y1_trans = x1 - cx, y1 - cy
-    
-    # Direction vector from p1 to p2
-    dx = x2 - x1
-    dy = y2 - y1
-
-    len_d = math.sqrt(dx*dx + dy*dy)
-    if len_d < 1e-9: # p1 and p2 are essentially the same point
-        # If p1 is on the circle, it's the "intersection"
-        if abs((x1_trans**2 + y1_trans**2) - r**2) < 1e-6:
-            return p1_screen
-        return None # Otherwise, no line segment to intersect from p1
-
-    udx, udy = dx/len_d, dy/len_d # Unit direction vector from p1 towards p2
-
-    # Line is P_trans = P1_trans + k * U_dir, where k is distance along unit vector
-    # Substitute into circle equation: (x1_trans + k*udx)^2 + (y1_trans + k*udy)^2 = r^2
-    # Expands to: k^2*(udx^2+udy^2) + k*(2*x1_trans*udx + 2*y1_trans*udy) + (x1_trans^2+y1_trans^2-r^2) = 0
-    # Since (udx^2+udy^2) = 1 (it's a unit vector):
-    # k^2 + k*(2 * (x1_trans*udx + y1_trans*udy)) + (x1_trans^2+y1_trans^2-r^2) = 0
-    
-    # Quadratic equation Ak^2 + Bk_coeff*k + Ck_coeff = 0 for k
-    A_k = 1.0
-    B_k_coeff = 2 * (x1_trans * udx + y1_trans * udy)
-    C_k_coeff = (x1_trans**2 + y1_trans**2) - r**2
-
-    discriminant_k = B_k_coeff**2 - 4*A_k*C_k_coeff
-
-    if discriminant_k < -1e-9: # Allow for small negative due to precision
-        return None # No real intersection (line misses the circle)
-    
-    # Clamp if slightly negative due to floating point math
-    if discriminant_k < 0: discriminant_k = 0 
-
-    sqrt_discriminant_k = math.sqrt(discriminant_k)
-    
-    # Two solutions for k (distance from p1_trans along unit vector)
-    k1 = (-B_k_coeff + sqrt_discriminant_k) / (2*A_k)
-    k2 = (-B_k_coeff - sqrt_discriminant_k) / (2*A_k)
-
-    # We want the smallest non-negative k.
-    # This represents the first intersection point *forward* from p1 along the ray towards p2.
-    # If p1 is inside the circle (C_k_coeff < 0), one k will be positive (exit) and one negative.
-    # If p1 is on the circle (C_k_coeff ~ 0), one k is ~0, other is positive/negative.
-    # If p1 is outside (C_k_coeff > 0, though this function assumes p1 is inside/on),
-    #    both k could be positive (entry and exit) or complex (miss).
-    
-    intersect_k = -1.0 # Initialize with an invalid value
-
-    if k1 >= -1e-9: # k1 is a potential forward intersection (allowing for precision around 0)
-        intersect_k = k1
-    
-    if k2 >= -1e-9: # k2 is also a potential forward intersection
-        if intersect_k == -1.0 or k2 < intersect_k: # If k1 was not valid or k2 is smaller
-            intersect_k = k2
-            
-    if intersect_k == -1.0: # No valid non-negative k found
-        return None
-
-    # The intersection point must be on the segment defined by p1 and extending towards p2,
-    # up to the conceptual location of p2.
-    # intersect_k is the distance from p1. If intersect_k > len_d, it means p2 was *inside*
-    # the circle, and the intersection is beyond p2 (on the ray).
-    # This function is for when p1 is inside and we are looking for the exit towards an outside p2.
-    # So, intersect_k should generally be <= len_d if p2 defines the actual segment end.
-    # However, p2_screen is often a "far point" for direction, so len_d can be huge.
-    # The crucial part is that intersect_k is the distance from p1 to the circle edge.
-
-    # Calculate the intersection point in original screen coordinates
-    final_intersect_x = x1 + intersect_k * udx
-    final_intersect_y = y1 + intersect_k * udy
-    
-    return (int(round(final_intersect_x)), int(round(final_intersect_y)))
-# --- End Screen Coordinate Line-Circle Intersection ---
-
 # --- Menu Drawing Helper Function ---
 def draw_single_dropdown_option(surface, option_key_name, label_text, current_opt_value,
                                  is_dropdown_open, y_pos, parent_panel_rect, font_obj,
@@ -3389,95 +5394,52 @@ def handle_action_button_click(event_pos, button_rect_to_check, action_key_name)
     return False
 # --- End Action Button Click Handling Helper ---
 
+_track_screen_cache = {'key': None, 'runs': None} # Last projected track (see draw_ship_track)
 
-def get_screen_line_circle_intersection(p1_screen, p2_screen, circle_center_x, circle_center_y, circle_radius_pixels):
-    # p1 is assumed to be inside or on the circle, p2 is used for direction and assumed to be outside.
-    # Calculates intersection of the ray p1->p2 with the circle.
-    # Uses normalized direction vector for better numerical stability.
-
-    x1, y1 = p1_screen
-    x2, y2 = p2_screen # p2 is used for direction; can be far outside
-    cx, cy = circle_center_x, circle_center_y
-    r = circle_radius_pixels
-
-    # Translate points so circle is at origin for easier math
-    x1_trans, y1_trans = x1 - cx, y1 - cy
-    
-    # Direction vector from p1 to p2
-    dx = x2 - x1
-    dy = y2 - y1
-
-    len_d = math.sqrt(dx*dx + dy*dy)
-    if len_d < 1e-9: # p1 and p2 are essentially the same point
-        # If p1 is on the circle, it's the "intersection"
-        if abs((x1_trans**2 + y1_trans**2) - r**2) < 1e-6:
-            return p1_screen
-        return None # Otherwise, no line segment to intersect from p1
-
-    udx, udy = dx/len_d, dy/len_d # Unit direction vector from p1 towards p2
-
-    # Line is P_trans = P1_trans + k * U_dir, where k is distance along unit vector
-    # Substitute into circle equation: (x1_trans + k*udx)^2 + (y1_trans + k*udy)^2 = r^2
-    # Expands to: k^2*(udx^2+udy^2) + k*(2*x1_trans*udx + 2*y1_trans*udy) + (x1_trans^2+y1_trans^2-r^2) = 0
-    # Since (udx^2+udy^2) = 1 (it's a unit vector):
-    # k^2 + k*(2 * (x1_trans*udx + y1_trans*udy)) + (x1_trans^2+y1_trans^2-r^2) = 0
-    
-    # Quadratic equation Ak^2 + Bk_coeff*k + Ck_coeff = 0 for k
-    A_k = 1.0
-    B_k_coeff = 2 * (x1_trans * udx + y1_trans * udy)
-    C_k_coeff = (x1_trans**2 + y1_trans**2) - r**2
-
-    discriminant_k = B_k_coeff**2 - 4*A_k*C_k_coeff
-
-    if discriminant_k < -1e-9: # Allow for small negative due to precision
-        return None # No real intersection (line misses the circle)
-    
-    # Clamp if slightly negative due to floating point math
-    if discriminant_k < 0: discriminant_k = 0 
-
-    sqrt_discriminant_k = math.sqrt(discriminant_k)
-    
-    # Two solutions for k (distance from p1_trans along unit vector)
-    k1 = (-B_k_coeff + sqrt_discriminant_k) / (2*A_k)
-    k2 = (-B_k_coeff - sqrt_discriminant_k) / (2*A_k)
-
-    # We want the smallest non-negative k.
-    # This represents the first intersection point *forward* from p1 along the ray towards p2.
-    # If p1 is inside the circle (C_k_coeff < 0), one k will be positive (exit) and one negative.
-    # If p1 is on the circle (C_k_coeff ~ 0), one k is ~0, other is positive/negative.
-    # If p1 is outside (C_k_coeff > 0, though this function assumes p1 is inside/on),
-    #    both k could be positive (entry and exit) or complex (miss).
-    
-    intersect_k = -1.0 # Initialize with an invalid value
-
-    if k1 >= -1e-9: # k1 is a potential forward intersection (allowing for precision around 0)
-        intersect_k = k1
-    
-    if k2 >= -1e-9: # k2 is also a potential forward intersection
-        if intersect_k == -1.0 or k2 < intersect_k: # If k1 was not valid or k2 is smaller
-            intersect_k = k2
-            
-    if intersect_k == -1.0: # No valid non-negative k found
-        return None
-
-    # The intersection point must be on the segment defined by p1 and extending towards p2,
-    # up to the conceptual location of p2.
-    # intersect_k is the distance from p1. If intersect_k > len_d, it means p2 was *inside*
-    # the circle, and the intersection is beyond p2 (on the ray).
-    # This function is for when p1 is inside and we are looking for the exit towards an outside p2.
-    # So, intersect_k should generally be <= len_d if p2 defines the actual segment end.
-    # However, p2_screen is often a "far point" for direction, so len_d can be huge.
-    # The crucial part is that intersect_k is the distance from p1 to the circle edge.
-
-    # Calculate the intersection point in original screen coordinates
-    final_intersect_x = x1 + intersect_k * udx
-    final_intersect_y = y1 + intersect_k * udy
-    
-    return (int(round(final_intersect_x)), int(round(final_intersect_y)))
-
-def draw_ship_track(surface, track_points_geo, ship_lat, ship_lon, ship_hdg_deg,
+def clip_polyline_to_circle(xs, ys, cc_x, cc_y, radius):
+    """
+    Clips the polyline (xs, ys) to a circle, all segments at once. Returns the visible runs
+    as lists of (x, y) points, each ready for one pygame.draw.lines call.
+    """
+    if len(xs) < 2:
+        return []
+    x0, y0 = xs[:-1] - cc_x, ys[:-1] - cc_y
+    dx, dy = np.diff(xs), np.diff(ys)
+    # |p0 + t*d|^2 = r^2 for every segment; keep the part of [0, 1] inside the circle
+    a = dx * dx + dy * dy
+    b = x0 * dx + y0 * dy
+    c = x0 * x0 + y0 * y0 - radius * radius
+    disc = b * b - a * c
+    with np.errstate(divide='ignore', invalid='ignore'):
+        root = np.sqrt(np.maximum(disc, 0.0))
+        t_in = np.where(a > 0, (-b - root) / a, 0.0)
+        t_out = np.where(a > 0, (-b + root) / a, 1.0)
+    t_in = np.maximum(t_in, 0.0)
+    t_out = np.minimum(t_out, 1.0)
+    visible = (disc >= 0) & (t_in <= t_out) & ((a > 0) | (c <= 0))
+    if not visible.any():
+        return []
+    start_x, start_y = x0 + t_in * dx + cc_x, y0 + t_in * dy + cc_y
+    end_x, end_y = x0 + t_out * dx + cc_x, y0 + t_out * dy + cc_y
+    # Consecutive visible segments form one run while the vertex they share is inside
+    joined = visible[:-1] & visible[1:] & (t_out[:-1] >= 1.0) & (t_in[1:] <= 0.0)
+    run_starts = np.flatnonzero(visible & np.concatenate(([True], ~joined)))
+    run_ends = np.flatnonzero(visible & np.concatenate((~joined, [True])))
+    runs = []
+    for first, last in zip(run_starts, run_ends):
+        points = [(float(start_x[first]), float(start_y[first]))]
+        points.extend(zip(xs[first + 1:last + 1].tolist(), ys[first + 1:last + 1].tolist()))
+        points.append((float(end_x[last]), float(end_y[last])))
+        runs.append(points)
+    return runs
+
+def draw_ship_track(surface, track, ship_lat, ship_lon, ship_hdg_deg,
                     cc_x, cc_y, disp_radius_px, s_max_on_disp, current_disp_unit, track_color):
-    # This is the new, optimized version of the function.
+    """
+    Draws the track head-up around the own ship. All points are projected and clipped in
+    array operations and each visible run is a single polyline; the runs are reused until
+    the render pose (which only moves in whole pixels), the view or the track change.
+    """
     if ship_lat is None or ship_lon is None:
         return
 
@@ -3486,105 +5448,122 @@ def draw_ship_track(surface, track_points_geo, ship_lat, ship_lon, ship_hdg_deg,
         print(f"DEBUG: Invalid coordinate in draw_ship_track. Lat: {ship_lat}, Lon: {ship_lon}. Skipping draw.")
         return
 
-    # --- Step 1: Pre-calculation and Geo-to-Screen Conversion ---
     s_max_meters_on_display = s_max_on_disp
     if current_disp_unit == "BRAZAS":
         s_max_meters_on_display *= 1.8288
-
-    current_ship_geo = Point(latitude=ship_lat, longitude=ship_lon)
-    
-    # Helper function to convert a single geo point to screen coords
-    # This is where the expensive geodesic calls are contained.
-    def geo_to_screen_coords(geo_pt, ref_ship_geo, ref_ship_hdg_deg, 
-                             center_x, center_y, display_radius_pixels, 
-                             max_dist_meters_for_display_edge):
-        # This function calculates distance and bearing from ship to the point
-        # and returns screen (x,y) or None if it's way off.
-        dist_m = geodesic(ref_ship_geo, geo_pt).meters
-        
-        # A simple optimization: if a point is more than twice the sonar range,
-        # it's definitely not going to be part of a visible segment.
-        # This reduces the number of bearing calculations.
-        if dist_m > max_dist_meters_for_display_edge * 2:
-            return None, dist_m # Return distance for visibility checks
-
-        # Calculate true bearing from ship to geo_pt
-        delta_lon_rad = math.radians(geo_pt.longitude - ref_ship_geo.longitude)
-        lat1_rad = math.radians(ref_ship_geo.latitude)
-        lat2_rad = math.radians(geo_pt.latitude)
-        y_brg = math.sin(delta_lon_rad) * math.cos(lat2_rad)
-        x_brg = math.cos(lat1_rad) * math.sin(lat2_rad) - \
-                math.sin(lat1_rad) * math.cos(lat2_rad) * math.cos(delta_lon_rad)
-        true_bearing_rad = math.atan2(y_brg, x_brg)
-        true_bearing_deg = (math.degrees(true_bearing_rad) + 360) % 360
-        
-        relative_bearing_deg = (true_bearing_deg - ref_ship_hdg_deg + 360) % 360
-        
-        pixel_dist = (dist_m / max_dist_meters_for_display_edge) * display_radius_pixels \
-                     if max_dist_meters_for_display_edge > 0 else 0
-        
-        angle_rad_draw = math.radians(relative_bearing_deg)
-        
-        scr_x = center_x + pixel_dist * math.sin(angle_rad_draw)
-        scr_y = center_y - pixel_dist * math.cos(angle_rad_draw) # Pygame Y is inverted
-        return (int(round(scr_x)), int(round(scr_y))), dist_m
-
-    # Process all points at once
-    full_track_geo_points = track_points_geo + [{'lat': ship_lat, 'lon': ship_lon}]
-    
-    processed_points = []
-    for geo_data in full_track_geo_points:
-        geo_point = Point(latitude=geo_data['lat'], longitude=geo_data['lon'])
-        screen_pos, dist_m = geo_to_screen_coords(geo_point, current_ship_geo, ship_hdg_deg,
-                                                  cc_x, cc_y, disp_radius_px, s_max_meters_on_display)
-        
-        is_visible = dist_m <= s_max_meters_on_display
-        processed_points.append({'screen_pos': screen_pos, 'is_visible': is_visible})
-
-    # --- Step 2: Draw segments using only screen coordinates and 2D math ---
-    if len(processed_points) < 2:
+    if s_max_meters_on_display <= 0:
         return
 
-    for i in range(len(processed_points) - 1):
-        p1_info = processed_points[i]
-        p2_info = processed_points[i+1]
+    cache_key = (ship_lat, ship_lon, ship_hdg_deg, cc_x, cc_y, disp_radius_px, s_max_meters_on_display,
+                 track.version)
+    if _track_screen_cache['key'] != cache_key:
+        # Simplified level matching the metres per pixel of this range
+        track_lats, track_lons = track.points(TRACK_LOD_TOLERANCE_PX * s_max_meters_on_display / disp_radius_px)
+        # The track ends at the own ship (the centre of the PPI)
+        xs, ys = geo_to_ppi_xy(np.append(track_lats, ship_lat), np.append(track_lons, ship_lon),
+                               ship_lat, ship_lon, ship_hdg_deg, disp_radius_px / s_max_meters_on_display)
+        _track_screen_cache['runs'] = clip_polyline_to_circle(xs + cc_x, ys + cc_y, cc_x, cc_y,
+                                                              disp_radius_px - 0.5) # a bit of inset
+        _track_screen_cache['key'] = cache_key
+
+    for run in _track_screen_cache['runs']:
+        pygame.draw.lines(surface, track_color, False, run, 1)
+
+_history_cache = {'query_key': None, 'box': None, 'centre': None, 'version': None, 'last_id': 0,
+                  'raw': None, 'lat': None, 'lon': None, 'key': None, 'runs': None}
+
+def _thin_history(lats, lons, segments, ref_lat, ref_lon, cell_m):
+    """
+    Keeps a point when it enters a new cell_m grid cell, plus both ends of every segment, and puts
+    a NaN vertex between segments (clip_polyline_to_circle ends the run there).
+    """
+    xs, ys = geo_to_local_xy(lats, lons, ref_lat, ref_lon)
+    cell_x, cell_y = np.floor(xs / cell_m), np.floor(ys / cell_m)
+    segment_change = np.diff(segments) != 0
+    keep = np.ones(len(lats), dtype=bool)
+    keep[1:] = (np.diff(cell_x) != 0) | (np.diff(cell_y) != 0) | segment_change
+    keep[:-1] |= segment_change
+    lats, lons, segments = lats[keep], lons[keep], segments[keep]
+    breaks = np.flatnonzero(np.diff(segments) != 0) + 1
+    return np.insert(lats, breaks, np.nan), np.insert(lons, breaks, np.nan)
+
+def draw_history_track(surface, store, span_h, ship_lat, ship_lon, ship_hdg_deg,
+                       cc_x, cc_y, disp_radius_px, s_max_on_disp, current_disp_unit, track_color):
+    """
+    Draws the stored track of the last span_h hours (under the live one). The store is queried
+    for a box of twice the range around the ship, again only when the ship leaves the inner half
+    of that box or the range or span change; points committed since are fetched by row id.
+    The points are thinned to one per pixel cell before being projected.
+    """
+    if store is None or span_h <= 0 or ship_lat is None or ship_lon is None:
+        return
+    s_max_meters_on_display = s_max_on_disp * (1.8288 if current_disp_unit == "BRAZAS" else 1.0)
+    if s_max_meters_on_display <= 0:
+        return
 
-        p1_screen = p1_info['screen_pos']
-        p2_screen = p2_info['screen_pos']
-        
-        # Case 1: Both points are visible on screen. Draw the line.
-        if p1_info['is_visible'] and p2_info['is_visible']:
-            if p1_screen and p2_screen: # Should always be true if visible
-                pygame.draw.line(surface, track_color, p1_screen, p2_screen, 1)
-        
-        # Case 2: One point visible, one not. Clip the line.
-        # This requires both screen positions, even for the non-visible one, to get direction.
-        elif p1_screen and p2_screen:
-            # Determine which point is inside and which is outside
-            inside_point = None
-            outside_point = None
-            if p1_info['is_visible'] and not p2_info['is_visible']:
-                inside_point = p1_screen
-                outside_point = p2_screen
-            elif not p1_info['is_visible'] and p2_info['is_visible']:
-                inside_point = p2_screen
-                outside_point = p1_screen
-            
-            if inside_point and outside_point:
-                # Use the 2D screen-based line clipping function
-                intersection = get_screen_line_circle_intersection(
-                    inside_point, outside_point,
-                    cc_x, cc_y, disp_radius_px - 0.5 # a bit of inset
-                )
-                if intersection:
-                    pygame.draw.line(surface, track_color, inside_point, intersection, 1)
-        # Case 3: Both points are not visible.
-        # For performance, we do not calculate if a segment with both ends off-screen
-        # happens to pass through the circle. The visual impact of missing these
-        # rare segments is negligible compared to the performance gain.
+    cache = _history_cache
+    query_key = (span_h, s_max_meters_on_display, disp_radius_px)
+    now = time.time()
+    if (cache['query_key'] != query_key or cache['centre'] is None
+            or max(map(abs, geo_to_local_xy(ship_lat, ship_lon, *cache['centre']))) > s_max_meters_on_display):
+        r_m, r_n = local_radii_m(ship_lat)
+        half_lat = math.degrees(2.0 * s_max_meters_on_display / r_m)
+        half_lon = math.degrees(2.0 * s_max_meters_on_display / (r_n * max(math.cos(math.radians(ship_lat)), 1e-6)))
+        cache['box'] = (ship_lat - half_lat, ship_lat + half_lat, ship_lon - half_lon, ship_lon + half_lon)
+        _, _, lats, lons, segments = store.track_in_box(cache['box'], now - span_h * 3600.0, now)
+        cache['last_id'] = store.last_track_id
+        cache['raw'] = (lats, lons, segments)
+        cache['centre'] = (ship_lat, ship_lon)
+        cache['query_key'] = query_key
+        cache['version'] = None
+    if cache['version'] != store.version:
+        if store.last_track_id > cache['last_id']:
+            _, _, lats, lons, segments = store.track_in_box(cache['box'], now - span_h * 3600.0, now,
+                                                            after_id=cache['last_id'])
+            cache['raw'] = tuple(np.concatenate(pair) for pair in zip(cache['raw'], (lats, lons, segments)))
+            cache['last_id'] = store.last_track_id
+        cache['lat'], cache['lon'] = _thin_history(*cache['raw'], *cache['centre'],
+                                                   TRACK_LOD_TOLERANCE_PX * s_max_meters_on_display / disp_radius_px)
+        cache['version'] = store.version
+        cache['key'] = None
+
+    cache_key = (ship_lat, ship_lon, ship_hdg_deg, cc_x, cc_y)
+    if cache['key'] != cache_key:
+        xs, ys = geo_to_ppi_xy(cache['lat'], cache['lon'], ship_lat, ship_lon, ship_hdg_deg,
+                               disp_radius_px / s_max_meters_on_display)
+        cache['runs'] = clip_polyline_to_circle(xs + cc_x, ys + cc_y, cc_x, cc_y, disp_radius_px - 0.5)
+        cache['key'] = cache_key
+
+    for run in cache['runs']:
+        pygame.draw.lines(surface, track_color, False, run, 1)
 
 # --- End Track Drawing Logic ---
 
+# --- AIS Target Drawing ---
+AIS_ICON_SIZE = 14 # Length of the vessel triangle in pixels
+
+def draw_ais_targets(surface, xs, ys, course_deg, color):
+    """Draws the projected AIS vessels: a triangle pointing along heading/COG, or a circle if unknown."""
+    if not len(xs):
+        return
+    course_rad = np.radians(np.nan_to_num(course_deg))
+    sin_c, cos_c = np.sin(course_rad), np.cos(course_rad)
+    half = AIS_ICON_SIZE / 2.0
+    # Vertices of every triangle at once: tip ahead, two corners astern
+    tip_x, tip_y = xs + sin_c * half, ys - cos_c * half
+    left_x = xs - sin_c * half - cos_c * half * 0.6
+    left_y = ys + cos_c * half - sin_c * half * 0.6
+    right_x = xs - sin_c * half + cos_c * half * 0.6
+    right_y = ys + cos_c * half + sin_c * half * 0.6
+    has_course = ~np.isnan(course_deg)
+    for i in range(len(xs)):
+        if has_course[i]:
+            pygame.draw.polygon(surface, color, ((tip_x[i], tip_y[i]), (left_x[i], left_y[i]),
+                                                 (right_x[i], right_y[i])), 1)
+        else:
+            pygame.draw.circle(surface, color, (int(xs[i]), int(ys[i])), int(half * 0.6), 1)
+# --- End AIS Target Drawing ---
+
 # --- Calculation Logic for Targets ---
 def calculate_target_data(targets, current_tilt_angle_deg, S_max_range, display_radius_px, 
                           current_unit_str, circle_center_coords, current_ship_hdg_deg):
@@ -3603,13 +5582,14 @@ def calculate_target_data(targets, current_tilt_angle_deg, S_max_range, display_
         return # Not enough targets for any calculation
 
     # --- Calculations for the last target (T2) ---
-    t2 = targets[-1]
+    t2 = len(targets) - 1
+    t2_geo, t2_scr = targets.geo_pos(t2), targets.initial_pos(t2)
     cc_x, cc_y = circle_center_coords # Unpack for screen calculations
 
     # --- T2: Distance from Center & Depth ---
-    if t2['mode'] == 'geo' and t2['geo_pos'] and current_ship_lat_deg is not None and current_ship_lon_deg is not None:
+    if t2_geo and current_ship_lat_deg is not None and current_ship_lon_deg is not None:
         ship_point = Point(latitude=current_ship_lat_deg, longitude=current_ship_lon_deg)
-        t2_geo_point = Point(latitude=t2['geo_pos']['lat'], longitude=t2['geo_pos']['lon'])
+        t2_geo_point = Point(*t2_geo)
         dist_meters_ship_to_t2 = geodesic(ship_point, t2_geo_point).meters
         
         s_range_t2_display_units = dist_meters_ship_to_t2
@@ -3620,8 +5600,8 @@ def calculate_target_data(targets, current_tilt_angle_deg, S_max_range, display_
         depth_t2 = s_range_t2_display_units * math.sin(tilt_rad_t2)
         ui_state['target_depth_t2'] = f"{int(round(depth_t2))}" # No unit suffix
 
-    elif t2['mode'] == 'screen' and t2['initial_screen_pos']:
-        t2_scr_x, t2_scr_y = t2['initial_screen_pos']
+    elif t2_scr:
+        t2_scr_x, t2_scr_y = t2_scr
         pixel_dist_center_to_t2_scr = math.sqrt((t2_scr_x - cc_x)**2 + (t2_scr_y - cc_y)**2)
         s_range_t2_scr = (pixel_dist_center_to_t2_scr / display_radius_px) * S_max_range if display_radius_px > 0 else 0
         # S_max_range is already in display units, so s_range_t2_scr is too.
@@ -3639,18 +5619,19 @@ def calculate_target_data(targets, current_tilt_angle_deg, S_max_range, display_
         return 
 
     # --- Calculations involving the last two targets (T1 and T2) ---
-    t1 = targets[-2] 
+    t1 = t2 - 1
+    t1_geo, t1_scr = targets.geo_pos(t1), targets.initial_pos(t1)
 
-    if t1['mode'] == 'geo' and t2['mode'] == 'geo' and t1['geo_pos'] and t2['geo_pos']:
-        t1_geo_point = Point(latitude=t1['geo_pos']['lat'], longitude=t1['geo_pos']['lon'])
-        t2_geo_point = Point(latitude=t2['geo_pos']['lat'], longitude=t2['geo_pos']['lon']) # Already defined if T2 was geo
+    if t1_geo and t2_geo:
+        t1_geo_point = Point(*t1_geo)
+        t2_geo_point = Point(*t2_geo) # Already defined if T2 was geo
 
         dist_meters_t1_t2 = geodesic(t1_geo_point, t2_geo_point).meters
         dist_t1_t2_display_units = dist_meters_t1_t2
         if current_unit_str == "BRAZAS": dist_t1_t2_display_units /= 1.8288
         ui_state['target_dist_t1_t2'] = f"{int(round(dist_t1_t2_display_units))}" # No unit suffix
 
-        time_diff_ms = t2['timestamp'] - t1['timestamp']
+        time_diff_ms = targets.timestamp[t2] - targets.timestamp[t1]
         if time_diff_ms > 0:
             speed_m_per_s_t1_t2 = dist_meters_t1_t2 / (time_diff_ms / 1000.0)
             ui_state['target_speed_t1_t2'] = f"{(speed_m_per_s_t1_t2 * 1.94384):.1f} kn"
@@ -3665,16 +5646,16 @@ def calculate_target_data(targets, current_tilt_angle_deg, S_max_range, display_
         true_bearing_t1_to_t2_deg = (math.degrees(math.atan2(y_brg, x_brg)) + 360) % 360
         ui_state['target_course_t1_t2'] = f"{int(round(true_bearing_t1_to_t2_deg))}°"
 
-    elif t1['mode'] == 'screen' and t2['mode'] == 'screen' and t1['initial_screen_pos'] and t2['initial_screen_pos']:
-        t1_scr_x, t1_scr_y = t1['initial_screen_pos']
-        t2_scr_x, t2_scr_y = t2['initial_screen_pos']
+    elif t1_scr and t2_scr:
+        t1_scr_x, t1_scr_y = t1_scr
+        t2_scr_x, t2_scr_y = t2_scr
 
         pixel_dist_t1_t2_scr = math.sqrt((t2_scr_x - t1_scr_x)**2 + (t2_scr_y - t1_scr_y)**2)
         dist_t1_t2_scr = (pixel_dist_t1_t2_scr / display_radius_px) * S_max_range if display_radius_px > 0 else 0
         # S_max_range is already in display units
         ui_state['target_dist_t1_t2'] = f"{int(round(dist_t1_t2_scr))}" # No unit suffix
         
-        time_diff_ms_scr = t2['timestamp'] - t1['timestamp']
+        time_diff_ms_scr = targets.timestamp[t2] - targets.timestamp[t1]
         if time_diff_ms_scr > 0:
             speed_disp_units_per_sec = dist_t1_t2_scr / (time_diff_ms_scr / 1000.0)
             speed_m_per_s = speed_disp_units_per_sec
@@ -3696,106 +5677,6 @@ def calculate_target_data(targets, current_tilt_angle_deg, S_max_range, display_
         ui_state['target_speed_t1_t2'] = "---"
         ui_state['target_course_t1_t2'] = "---"
 
-# --- Real-time Screen Position Calculation for Markers ---
-def update_marker_screen_positions(targets, ship_lat, ship_lon, ship_hdg_deg, 
-                                   cc_x, cc_y, disp_radius_px, s_max_disp_range, current_disp_unit):
-    """
-    Updates the 'current_screen_pos' for each geographically-locked target marker
-    based on the current ship position and heading.
-    """
-    # Updates the 'current_screen_pos' for each target marker.
-    # Handles 'geo' markers based on ship position and 'screen' markers based on display changes.
-
-    ship_point = None
-    if ship_lat is not None and ship_lon is not None:
-        ship_point = Point(latitude=ship_lat, longitude=ship_lon)
-
-    for marker in targets:
-        if marker['mode'] == 'geo':
-            if ship_point and marker['geo_pos']:
-                target_point = Point(latitude=marker['geo_pos']['lat'], longitude=marker['geo_pos']['lon'])
-                dist_meters_to_target = geodesic(ship_point, target_point).meters
-                
-                s_max_meters_on_display = s_max_disp_range # s_max_disp_range is already in display units
-                if current_disp_unit == "BRAZAS": # if display is brazas, convert s_max_disp_range (brazas) to meters
-                    s_max_meters_on_display *= 1.8288
-
-                if dist_meters_to_target > s_max_meters_on_display:
-                    marker['current_screen_pos'] = None
-                    continue
-
-                # Calculate true bearing from ship to target
-                delta_lon = math.radians(target_point.longitude - ship_point.longitude)
-                lat1_rad = math.radians(ship_point.latitude)
-                lat2_rad = math.radians(target_point.latitude)
-                y_brg = math.sin(delta_lon) * math.cos(lat2_rad)
-                x_brg = math.cos(lat1_rad) * math.sin(lat2_rad) - \
-                        math.sin(lat1_rad) * math.cos(lat2_rad) * math.cos(delta_lon)
-                true_bearing_to_target_rad = math.atan2(y_brg, x_brg)
-                true_bearing_to_target_deg = (math.degrees(true_bearing_to_target_rad) + 360) % 360
-                
-                # Relative bearing for drawing on screen (0 deg is UP)
-                relative_bearing_deg = (true_bearing_to_target_deg - ship_hdg_deg + 360) % 360
-                angle_rad_for_draw = math.radians(relative_bearing_deg - 90) # Adjust for Pygame: 0=East, -90=North/Up
-                
-                # Pixel distance from center
-                # s_max_disp_range is in current display units (m or fm)
-                # dist_meters_to_target needs to be converted to current display units if they differ.
-                dist_units_to_target = dist_meters_to_target
-                if current_disp_unit == "BRAZAS":
-                    dist_units_to_target /= 1.8288 # Convert meters to brazas for proportional calculation
-
-                pixel_dist_from_center = (dist_units_to_target / s_max_disp_range) * disp_radius_px if s_max_disp_range > 0 else 0
-                
-                screen_x_rel_center = pixel_dist_from_center * math.cos(angle_rad_for_draw)
-                screen_y_rel_center = pixel_dist_from_center * math.sin(angle_rad_for_draw) 
-                
-                marker_screen_x = cc_x + screen_x_rel_center
-                marker_screen_y = cc_y + screen_y_rel_center # Pygame's Y is already handled by angle adjustment
-                marker['current_screen_pos'] = (int(round(marker_screen_x)), int(round(marker_screen_y)))
-            else:
-                marker['current_screen_pos'] = None # No ship or geo position for geo marker
-
-        elif marker['mode'] == 'screen':
-            # 'Screen' mode markers always rescale with the current sonar display settings,
-            # regardless of NMEA status, as they are not tied to a geographic point.
-            if marker.get('initial_distance_meters') is not None and \
-               marker.get('original_angle_rad') is not None and \
-               s_max_disp_range > 0 and disp_radius_px > 0: # s_max_disp_range is in current_disp_unit
-                
-                marker_dist_m = marker['initial_distance_meters']
-                angle_rad_initial = marker['original_angle_rad'] # This is atan2(dy,dx)
-
-                # Convert current display's max range to meters for comparison
-                s_max_meters_on_display = s_max_disp_range
-                if current_disp_unit == "BRAZAS": # current_disp_unit is argument to this function
-                    s_max_meters_on_display *= 1.8288
-
-                if marker_dist_m <= s_max_meters_on_display:
-                    # Both marker_dist_m and s_max_meters_on_display are in meters.
-                    # Ratio is correct for scaling against pixel radius.
-                    new_pixel_dist = (marker_dist_m / s_max_meters_on_display) * disp_radius_px \
-                                     if s_max_meters_on_display > 0 else 0 # Avoid division by zero if s_max_meters is 0
-                    
-                    # original_angle_rad (atan2(dy,dx)) means:
-                    # x = cos(angle), y = sin(angle) for standard math axes
-                    # Pygame screen: x_screen = center_x + R*cos(angle), y_screen = center_y + R*sin(angle)
-                    new_x = cc_x + new_pixel_dist * math.cos(angle_rad_initial)
-                    new_y = cc_y + new_pixel_dist * math.sin(angle_rad_initial)
-                    marker['current_screen_pos'] = (int(round(new_x)), int(round(new_y)))
-                else:
-                    marker['current_screen_pos'] = None # Marker's conceptual distance in meters is outside current display range in meters
-            
-            # Fallback conditions if rescaling data is incomplete.
-            elif marker.get('initial_screen_pos') is not None:
-                marker['current_screen_pos'] = marker['initial_screen_pos']
-            
-            else:
-                # No information to position the marker.
-                marker['current_screen_pos'] = None
-        else:
-            marker['current_screen_pos'] = None # Unknown mode
-
 def get_line_circle_intersection(p1, p2, circle_center, circle_radius):
     """
     Calculates the intersection point of a line segment starting at p1 and directed towards p2,
@@ -3956,6 +5837,8 @@ class Echosounder:
         self.distancia_barco = 0.0
         self.tiempo_acumulado = 0.0
         self.last_profundidad = 0.0
+        self.batimetria = None # Batimetria del escenario (opcional)
+        self.posicion_barco_m = None # (x, y) del barco en el plano del escenario, si se conoce
         self.font = pygame.font.SysFont("monospace", 16, bold=True)
         self.fuente_info = pygame.font.SysFont("monospace", 20, bold=True)
         self.resize(width, height, colors, config)
@@ -3983,6 +5866,14 @@ class Echosounder:
             self.surface.blit(old_surface, (0, 0))
 
     def _obtener_profundidad(self, config):
+        if self.batimetria is not None:
+            # Sin posición real del barco se recorre la rejilla hacia el Norte con distancia_barco
+            x_m, y_m = self.posicion_barco_m if self.posicion_barco_m is not None else (0.0, self.distancia_barco)
+            prof_fondo = self.batimetria.profundidad_en(x_m, y_m)
+            if prof_fondo is not None:
+                self.last_profundidad = max(10.0, prof_fondo)
+                return self.last_profundidad
+
         base = 280.0  # Fixed base depth for simulation
         amp = 40.0
         
@@ -4231,12 +6122,51 @@ class Echosounder:
                 # pygame.draw.line(screen, (255, 0, 0), (dest_rect.left, y_quilla_screen), (dest_rect.right, y_quilla_screen), 1)
 
 
+# --- Local Projection Helpers ---
+# Plano tangente alrededor de un punto de referencia (x = Este, y = Norte, en metros).
+# A las distancias de un sonar (pocos km) el error frente a geodesic es despreciable
+# y funciona igual con escalares que con arrays de NumPy.
+WGS84_A = 6378137.0
+WGS84_E2 = 6.69437999014e-3
+DEG_TO_RAD = math.pi / 180.0
+
+def local_radii_m(ref_lat_deg):
+    """Radios de curvatura meridiano y primer vertical (m) en ref_lat_deg."""
+    s = math.sin(math.radians(ref_lat_deg))
+    w = 1.0 - WGS84_E2 * s * s
+    return WGS84_A * (1.0 - WGS84_E2) / (w * math.sqrt(w)), WGS84_A / math.sqrt(w)
+
+def geo_to_local_xy(lat, lon, ref_lat, ref_lon):
+    """Lat/lon (grados) -> (x Este, y Norte) en metros respecto a la referencia."""
+    r_m, r_n = local_radii_m(ref_lat)
+    dlon = (lon - ref_lon + 180.0) % 360.0 - 180.0
+    x = dlon * DEG_TO_RAD * r_n * math.cos(math.radians(ref_lat))
+    y = (lat - ref_lat) * DEG_TO_RAD * r_m
+    return x, y
+
+def local_xy_to_geo(x, y, ref_lat, ref_lon):
+    """(x Este, y Norte) en metros respecto a la referencia -> lat/lon (grados)."""
+    r_m, r_n = local_radii_m(ref_lat)
+    lat = ref_lat + (y / r_m) / DEG_TO_RAD
+    lon = ref_lon + (x / (r_n * math.cos(math.radians(ref_lat)))) / DEG_TO_RAD
+    return lat, (lon + 180.0) % 360.0 - 180.0
+
+def geo_to_ppi_xy(lat, lon, ship_lat, ship_lon, ship_hdg_deg, px_por_metro):
+    """Lat/lon -> desplazamiento en píxeles desde el centro del PPI, proa arriba (x derecha, y abajo)."""
+    x_este, y_norte = geo_to_local_xy(lat, lon, ship_lat, ship_lon)
+    hdg_rad = math.radians(ship_hdg_deg)
+    x_estribor = x_este * math.cos(hdg_rad) - y_norte * math.sin(hdg_rad)
+    y_proa = x_este * math.sin(hdg_rad) + y_norte * math.cos(hdg_rad)
+    return x_estribor * px_por_metro, -y_proa * px_por_metro
+# --- End Local Projection Helpers ---
+
+
 # --- Clase Cardumen ---
 class Cardumen:
     def __init__(self, lat_inicial, lon_inicial, profundidad_centro_inicial_m,
                  velocidad_nudos, curso_grados,
                  radio_horizontal_m, profundidad_superior_m, profundidad_inferior_m,
-                 reflectividad_base=0.95):
+                 reflectividad_base=0.95, patron_movimiento=None):
         self.lat = lat_inicial
         self.lon = lon_inicial
         self.profundidad_centro = profundidad_centro_inicial_m
@@ -4249,9 +6179,32 @@ class Cardumen:
         self.reflectividad_base = reflectividad_base
         self.x_sim = 0
         self.y_sim = 0
-        self.avg_intensity = 0.0 # For Echo Average
+        # Patrón de movimiento: {'type': 'linear'|'circular'|'zigzag'|'stationary', ...}
+        self.patron = patron_movimiento or {'type': 'linear'}
+        self.curso_base_rad = self.curso_rad
+        self.tiempo_s = 0.0
+        self.geo_inicializado = False # Posición lat/lon derivada de x_sim/y_sim con NMEA
+        self.activo = False # Dentro del alcance del sonar (se simula frame a frame)
+        self.semilla_eco = 123 # Forma de la mancha en la pantalla del sonar
+        self.peces = None # PecesCardumen si se usa el modelo de partículas
+        self.num_peces = 0 # Peces del modelo de partículas; se crea al entrar en alcance
+        if self.patron.get('type') == 'stationary':
+            self.velocidad_mps = 0.0
+
+    def _actualizar_curso(self, delta_tiempo_s):
+        """Aplica el patrón de movimiento al curso del cardumen."""
+        self.tiempo_s += delta_tiempo_s
+        tipo = self.patron.get('type', 'linear')
+        if tipo == 'circular':
+            self.curso_rad += math.radians(self.patron.get('turn_rate_deg_s', 1.0)) * delta_tiempo_s
+        elif tipo == 'zigzag':
+            periodo = max(1.0, self.patron.get('period_s', 60.0))
+            amplitud = math.radians(self.patron.get('amplitude_deg', 30.0))
+            lado = 1.0 if (self.tiempo_s % periodo) < periodo / 2.0 else -1.0
+            self.curso_rad = self.curso_base_rad + lado * amplitud
 
     def actualizar_posicion(self, delta_tiempo_s, datos_nmea_disponibles=False):
+        self._actualizar_curso(delta_tiempo_s)
         distancia_movimiento = self.velocidad_mps * delta_tiempo_s
 
         if datos_nmea_disponibles:
@@ -4266,6 +6219,15 @@ class Cardumen:
             self.x_sim += dx_cardumen
             self.y_sim += dy_cardumen
 
+    def desplazamiento_lote(self, delta_tiempo_s):
+        """
+        Avance barato para cardúmenes fuera del alcance del sonar: actualiza el curso y
+        devuelve el desplazamiento (dx Este, dy Norte) en metros; quien llama lo aplica
+        en bloque (x_sim/y_sim o lat/lon) para todos los cardúmenes inactivos a la vez.
+        """
+        self._actualizar_curso(delta_tiempo_s)
+        distancia_movimiento = self.velocidad_mps * delta_tiempo_s
+        return distancia_movimiento * math.sin(self.curso_rad), distancia_movimiento * math.cos(self.curso_rad)
 
     def get_posicion_relativa_barco(self, barco_lat, barco_lon, barco_rumbo_deg, datos_nmea_disponibles=True):
         """
@@ -4334,6 +6296,598 @@ class Cardumen:
 
 # --- Fin Clase Cardumen ---
 
+# --- Modelo de Partículas del Cardumen ---
+# Peces (dispersores) que, sumados en una celda del buffer polar, saturan el color
+PECES_SATURACION = 4.0
+
+class PecesCardumen:
+    """
+    Modelo opcional de partículas para un Cardumen: posición y velocidad de cada pez
+    (float32, metros, relativas al centro del cardumen; x Este, y Norte, z hacia abajo).
+    El movimiento es un boids simplificado, todo en arrays: cohesión hacia el volumen
+    del cardumen, alineación con la velocidad media y separación respecto al centro de
+    masas de la celda de rejilla en la que cae cada pez (bincount, sin vecinos O(n²)).
+    """
+    CELDA_SEPARACION_M = 8.0
+    K_COHESION = 0.6
+    K_ALINEACION = 0.8
+    K_SEPARACION = 0.5
+    RUIDO_ACELERACION = 0.6
+    VELOCIDAD_MAX_MPS = 2.0
+
+    def __init__(self, num_peces, radio_horizontal_m, altura_m, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.num_peces = int(num_peces)
+        self.radio = float(radio_horizontal_m)
+        self.media_altura = max(1.0, altura_m / 2.0)
+        r = self.radio * np.sqrt(self.rng.random(self.num_peces, dtype=np.float32))
+        th = self.rng.random(self.num_peces, dtype=np.float32) * np.float32(2 * math.pi)
+        self.pos = np.empty((3, self.num_peces), dtype=np.float32)
+        self.pos[0] = r * np.sin(th)
+        self.pos[1] = r * np.cos(th)
+        self.pos[2] = (self.rng.random(self.num_peces, dtype=np.float32) - 0.5) * np.float32(2 * self.media_altura)
+        self.vel = self.rng.normal(0.0, 0.3, (3, self.num_peces)).astype(np.float32)
+        # Reflectividad individual (tamaño/orientación del pez)
+        self.reflectividad = self.rng.uniform(0.5, 1.0, self.num_peces).astype(np.float32)
+
+        # Rejilla de separación (celdas por eje, con margen para peces fuera del cilindro)
+        c = self.CELDA_SEPARACION_M
+        self._celdas_h = int(math.ceil(2.5 * self.radio / c)) + 1
+        self._celdas_v = int(math.ceil(2.5 * self.media_altura / c)) + 1
+        self._escala = np.array([[1.0 / self.radio], [1.0 / self.radio], [1.0 / self.media_altura]], dtype=np.float32)
+        # Banco de ruido precalculado: cada frame se toma una ventana con desplazamiento
+        # aleatorio (generar normales para todos los peces en cada frame es lo más caro).
+        self._ruido = self.rng.standard_normal((3, 2 * self.num_peces), dtype=np.float32)
+        self._ruido *= np.float32(self.RUIDO_ACELERACION)
+        self._ruido[2] *= 0.3 # Los peces se mueven poco en vertical
+
+    def actualizar(self, delta_tiempo_s):
+        dt = np.float32(min(delta_tiempo_s, 0.1))
+        if dt <= 0: return
+        pos, vel = self.pos, self.vel
+
+        # Cohesión: sólo actúa sobre los peces que salen del 80% del volumen del cardumen
+        pos_norm = pos * self._escala
+        rn = np.sqrt(np.einsum('ij,ij->j', pos_norm, pos_norm))
+        exceso = np.maximum(rn - 0.8, 0.0) / np.maximum(rn, 1e-3)
+        acc = pos * (-self.K_COHESION * exceso)
+
+        # Alineación con la velocidad media del cardumen
+        acc -= self.K_ALINEACION * (vel - vel.mean(axis=1, keepdims=True))
+
+        # Separación: alejarse del centro de masas de la celda si hay más de un pez
+        c = self.CELDA_SEPARACION_M
+        ix = np.clip((pos[0] / c).astype(np.int32) + self._celdas_h // 2, 0, self._celdas_h - 1)
+        iy = np.clip((pos[1] / c).astype(np.int32) + self._celdas_h // 2, 0, self._celdas_h - 1)
+        iz = np.clip((pos[2] / c).astype(np.int32) + self._celdas_v // 2, 0, self._celdas_v - 1)
+        celda = (iz * self._celdas_h + iy) * self._celdas_h + ix
+        total = self._celdas_h * self._celdas_h * self._celdas_v
+        cuenta = np.bincount(celda, minlength=total)
+        centros = np.empty((3, total), dtype=np.float32)
+        for eje in range(3):
+            centros[eje] = np.bincount(celda, weights=pos[eje], minlength=total)
+        centros /= np.maximum(cuenta, 1)
+        # Peso por celda (float32) y np.take: la máscara booleana por pez pasaba todo a float64
+        peso = np.where(cuenta > 1, np.float32(self.K_SEPARACION), np.float32(0.0))
+        separacion = pos - np.take(centros, celda, axis=1)
+        separacion *= np.take(peso, celda)
+        acc += separacion
+
+        desplaz = int(self.rng.integers(0, self.num_peces + 1))
+        acc += self._ruido[:, desplaz:desplaz + self.num_peces]
+
+        vel += acc * dt
+        velocidad = np.sqrt(np.einsum('ij,ij->j', vel, vel))
+        vel *= np.minimum(1.0, self.VELOCIDAD_MAX_MPS / np.maximum(velocidad, 1e-3))
+        pos += vel * dt
+
+    def geometria_eco(self, pos_rel_cardumen, tilt_deg, apertura_haz_vertical_deg):
+        """
+        Rumbo relativo, distancia inclinada y amplitud de los peces dentro del haz vertical.
+        pos_rel_cardumen: diccionario de Cardumen.get_posicion_relativa_barco.
+        """
+        d = pos_rel_cardumen["dist_horizontal_m"]
+        b = math.radians(pos_rel_cardumen["rumbo_relativo_deg"])
+        # Rumbo del barco = rumbo verdadero al cardumen - rumbo relativo
+        h = math.radians(pos_rel_cardumen["rumbo_verdadero_deg"] - pos_rel_cardumen["rumbo_relativo_deg"])
+        cos_h, sin_h = np.float32(math.cos(h)), np.float32(math.sin(h))
+        x, y, z = self.pos
+        # Coordenadas en el marco del barco (X estribor, Y proa)
+        X = np.float32(d * math.sin(b)) + x * cos_h - y * sin_h
+        Y = np.float32(d * math.cos(b)) + x * sin_h + y * cos_h
+        horiz = np.sqrt(X * X + Y * Y)
+        prof = np.float32(pos_rel_cardumen["profundidad_centro_m"]) + z
+
+        # Ponderación del haz vertical: mitad de potencia en el borde de la apertura
+        media_apertura = max(0.5, apertura_haz_vertical_deg / 2.0)
+        desvio = (np.degrees(np.arctan2(prof, horiz)) - np.float32(tilt_deg)) / np.float32(media_apertura)
+        en_haz = np.abs(desvio) <= 1.5
+        if not en_haz.any():
+            vacio = np.empty(0, dtype=np.float32)
+            return vacio, vacio, vacio
+        X, Y, horiz, prof, desvio = X[en_haz], Y[en_haz], horiz[en_haz], prof[en_haz], desvio[en_haz]
+        rumbos = np.degrees(np.arctan2(X, Y)) % 360.0
+        dists = np.sqrt(horiz * horiz + prof * prof)
+        amplitudes = self.reflectividad[en_haz] * np.exp(np.float32(-0.693) * desvio * desvio)
+        return rumbos, dists, amplitudes
+
+# Objetivo del modelo: 100.000 peces sin bajar de 60 FPS
+PECES_BENCH_OBJETIVO_FPS = 60
+
+def benchmark_peces(num_peces, frames=120):
+    """
+    Tiempo por frame del modelo de partículas (movimiento, geometría del haz e inyección
+    en el buffer polar) para un cardumen de num_peces, a proa y cruzando 0°/360°.
+    """
+    simulador = SonarEchoSimulator(50)
+    peces = PecesCardumen(num_peces, 100.0, 60.0, seed=1)
+    presupuesto_ms = 1000.0 / PECES_BENCH_OBJETIVO_FPS
+    resultados = {}
+    for rumbo in (45.0, 0.0):
+        pos_rel = {"dist_horizontal_m": 300.0, "rumbo_relativo_deg": rumbo,
+                   "rumbo_verdadero_deg": rumbo, "profundidad_centro_m": 70.0}
+        en_haz = len(peces.geometria_eco(pos_rel, 13.0, 15.0)[2])
+        t0 = time.perf_counter()
+        for _ in range(frames):
+            peces.actualizar(1.0 / PECES_BENCH_OBJETIVO_FPS)
+            rumbos, dists, amplitudes = peces.geometria_eco(pos_rel, 13.0, 15.0)
+            simulador.inject_scatterers(rumbos, dists, amplitudes, 600.0, longitud_impulso_m=32.0)
+        ms = (time.perf_counter() - t0) * 1000.0 / frames
+        resultados[rumbo] = ms
+        veredicto = "OK" if ms <= presupuesto_ms else "POR ENCIMA DEL PRESUPUESTO"
+        print(f"INFO: Peces: {num_peces:,} peces ({en_haz:,} en el haz), rumbo {rumbo:05.1f}°: "
+              f"{ms:.2f} ms/frame (presupuesto {presupuesto_ms:.1f} ms a {PECES_BENCH_OBJETIVO_FPS} FPS: {veredicto})")
+    return resultados
+
+if cli_args.bench_peces:
+    benchmark_peces(cli_args.bench_peces)
+    raise SystemExit(0)
+
+# --- Fin Modelo de Partículas del Cardumen ---
+
+# --- Escenarios ---
+# Un escenario es un fichero JSON que describe el entorno simulado:
+#   {
+#     "schools": [{"x_m": 0, "y_m": 1200, "depth_center_m": 70, "depth_top_m": 40,
+#                  "depth_bottom_m": 100, "radius_m": 100, "speed_kn": 4, "course_deg": 180,
+#                  "reflectivity": 0.95, "model": "particles", "fish": 5000,
+#                  "motion": {"type": "zigzag", "period_s": 60, "amplitude_deg": 30}}],
+#     "school_model": "blob",
+#     "seabed": {"file": "fondo.npy", "cell_size_m": 10, "origin_x_m": -5000, "origin_y_m": -5000},
+#     "own_ship": {"lat": 43.36, "lon": -8.40, "heading_deg": 0, "speed_kn": 8,
+#                  "route": [[43.36, -8.40], [43.40, -8.40]], "loop": true},
+#     "menu_options": {"tvg_lejano": 5}
+#   }
+# "model" (o "school_model" para todos) elige entre la mancha clásica ("blob") y el
+# modelo de partículas ("particles", con "fish" peces por cardumen).
+# Las posiciones de los cardúmenes son metros (x Este, y Norte) respecto al barco propio
+# en el arranque. El fondo (.npy o binario crudo con "shape"/"dtype") se abre con memmap
+# sólo cuando se consulta por primera vez, así que su tamaño no afecta al arranque.
+SCENARIO_FILE = "scenario.json"
+
+ESCENARIO_POR_DEFECTO = {
+    "schools": [{
+        # Profundidad centro: 40m (sup) + 60m (altura) / 2 = 70m desde superficie.
+        "x_m": 0, "y_m": 1200, # 1200m en proa (+Y es Norte/proa en la simulación sin NMEA)
+        "depth_center_m": 70, "depth_top_m": 40, "depth_bottom_m": 100,
+        "radius_m": 200 / 2, # Diámetro 200m
+        "speed_kn": 4, "course_deg": 180
+    }]
+}
+
+# Intervalo de refresco de la lista de cardúmenes cercanos al barco
+INTERVALO_CARDUMENES_ACTIVOS_S = 1.0
+
+class Batimetria:
+    """Rejilla de profundidades (filas hacia el Norte, columnas hacia el Este), cargada bajo demanda."""
+    def __init__(self, ruta, cell_size_m, origin_x_m=0.0, origin_y_m=0.0, shape=None, dtype='float32'):
+        self.ruta = ruta
+        self.cell_size_m = float(cell_size_m)
+        self.origin_x_m = float(origin_x_m)
+        self.origin_y_m = float(origin_y_m)
+        self.shape = tuple(shape) if shape else None
+        self.dtype = dtype
+        self._rejilla = None
+
+    @property
+    def rejilla(self):
+        if self._rejilla is None:
+            if self.ruta.lower().endswith('.npy'):
+                self._rejilla = np.load(self.ruta, mmap_mode='r')
+            else:
+                self._rejilla = np.memmap(self.ruta, dtype=self.dtype, mode='r', shape=self.shape)
+            print(f"INFO: Batimetría '{self.ruta}' mapeada en memoria ({self._rejilla.shape[0]}x{self._rejilla.shape[1]}).")
+        return self._rejilla
+
+    def profundidad_en(self, x_m, y_m):
+        """Profundidad en la posición local (m), o None fuera de la rejilla."""
+        fila = int((y_m - self.origin_y_m) // self.cell_size_m)
+        col = int((x_m - self.origin_x_m) // self.cell_size_m)
+        rejilla = self.rejilla
+        if 0 <= fila < rejilla.shape[0] and 0 <= col < rejilla.shape[1]:
+            return float(rejilla[fila, col])
+        return None
+
+
+class OwnShipRoute:
+    """
+    Own-ship track described by a scenario. It is turned into simulated NMEA
+    (GGA, VTG, HDT, ZDA) once per second so the rest of the program sees it
+    exactly like a GPS on the serial port.
+    """
+    SENTENCE_INTERVAL_S = 1.0
+
+    def __init__(self, lat, lon, heading_deg=0.0, speed_kn=0.0, waypoints=None, loop=False):
+        self.lat0 = float(lat)
+        self.lon0 = float(lon)
+        self.heading0 = float(heading_deg)
+        self.speed_kn = float(speed_kn)
+        self.speed_mps = self.speed_kn * 0.514444
+        self.loop = loop
+        self.waypoints = [(float(p[0]), float(p[1])) for p in (waypoints or [])]
+        # Tramos de la ruta en el plano local de cada waypoint: (dx, dy, longitud, rumbo)
+        self.legs = []
+        self.leg_start_s = [0.0]
+        for (lat_a, lon_a), (lat_b, lon_b) in zip(self.waypoints, self.waypoints[1:]):
+            dx, dy = geo_to_local_xy(lat_b, lon_b, lat_a, lon_a)
+            length = math.hypot(dx, dy)
+            self.legs.append((dx, dy, length, (math.degrees(math.atan2(dx, dy)) + 360) % 360))
+            self.leg_start_s.append(self.leg_start_s[-1] + length)
+        self.last_emit_s = None
+
+    def pose_at(self, t_s):
+        """(lat, lon, heading_deg, speed_kn) after t_s seconds on the route."""
+        dist = self.speed_mps * t_s
+        if not self.legs:
+            h = math.radians(self.heading0)
+            lat, lon = local_xy_to_geo(dist * math.sin(h), dist * math.cos(h), self.lat0, self.lon0)
+            return lat, lon, self.heading0, self.speed_kn
+        total = self.leg_start_s[-1]
+        speed = self.speed_kn
+        if total <= 0:
+            return self.waypoints[0][0], self.waypoints[0][1], self.heading0, 0.0
+        if self.loop:
+            dist %= total
+        elif dist >= total:
+            dist = total
+            speed = 0.0
+        i = 0
+        while i < len(self.legs) - 1 and dist > self.leg_start_s[i + 1]:
+            i += 1
+        dx, dy, length, bearing = self.legs[i]
+        frac = (dist - self.leg_start_s[i]) / length if length > 0 else 0.0
+        lat, lon = local_xy_to_geo(dx * frac, dy * frac, *self.waypoints[i])
+        return lat, lon, bearing, speed
+
+    def poll(self, t_s):
+        """Sentences due at t_s (seconds since the route started); empty between emissions."""
+        if self.last_emit_s is not None and t_s - self.last_emit_s < self.SENTENCE_INTERVAL_S:
+            return []
+        self.last_emit_s = t_s
+        lat, lon, hdg, spd = self.pose_at(t_s)
+        lat_s, ns = format_nmea_lat(lat)
+        lon_s, ew = format_nmea_lon(lon)
+        utc = time.gmtime()
+        hms = time.strftime("%H%M%S", utc)
+        return [
+            build_nmea_sentence(f"GPGGA,{hms}.00,{lat_s},{ns},{lon_s},{ew},1,08,1.0,0.0,M,0.0,M,,"),
+            build_nmea_sentence(f"GPVTG,{hdg:.1f},T,,M,{spd:.1f},N,{spd * 1.852:.1f},K,A"),
+            build_nmea_sentence(f"GPHDT,{hdg:.1f},T"),
+            build_nmea_sentence(f"GPZDA,{hms}.00,{utc.tm_mday:02d},{utc.tm_mon:02d},{utc.tm_year:04d},00,00"),
+        ]
+
+
+class Escenario:
+    """Escenario ya parseado. Los recursos pesados (batimetría) se abren bajo demanda."""
+    def __init__(self, datos, directorio_base="."):
+        self.datos_cardumenes = datos.get('schools', [])
+        self.modelo_cardumenes = datos.get('school_model', 'blob')
+        self.menu_options = datos.get('menu_options', {})
+
+        self.batimetria = None
+        fondo = datos.get('seabed')
+        if fondo and fondo.get('file'):
+            ruta_fondo = fondo['file']
+            if not os.path.isabs(ruta_fondo):
+                ruta_fondo = os.path.join(directorio_base, ruta_fondo)
+            self.batimetria = Batimetria(ruta_fondo, fondo.get('cell_size_m', 10.0),
+                                         fondo.get('origin_x_m', 0.0), fondo.get('origin_y_m', 0.0),
+                                         fondo.get('shape'), fondo.get('dtype', 'float32'))
+
+        self.ruta_barco = None
+        barco = datos.get('own_ship')
+        if barco and 'lat' in barco and 'lon' in barco:
+            self.ruta_barco = OwnShipRoute(barco['lat'], barco['lon'],
+                                           barco.get('heading_deg', 0.0), barco.get('speed_kn', 0.0),
+                                           barco.get('route'), barco.get('loop', False))
+
+    def crear_cardumenes(self):
+        cardumenes = []
+        for i, d in enumerate(self.datos_cardumenes):
+            prof_sup = d.get('depth_top_m', 40)
+            prof_inf = d.get('depth_bottom_m', 100)
+            c = Cardumen(
+                lat_inicial=0.0, # Placeholder hasta que haya NMEA; se usa x_sim, y_sim
+                lon_inicial=0.0,
+                profundidad_centro_inicial_m=d.get('depth_center_m', (prof_sup + prof_inf) / 2.0),
+                velocidad_nudos=d.get('speed_kn', 0.0),
+                curso_grados=d.get('course_deg', 0.0),
+                radio_horizontal_m=d.get('radius_m', 100),
+                profundidad_superior_m=prof_sup,
+                profundidad_inferior_m=prof_inf,
+                reflectividad_base=d.get('reflectivity', 0.95),
+                patron_movimiento=d.get('motion')
+            )
+            c.x_sim = d.get('x_m', 0.0)
+            c.y_sim = d.get('y_m', 0.0)
+            c.semilla_eco = 123 + i
+            if d.get('model', self.modelo_cardumenes) == 'particles':
+                c.num_peces = d.get('fish', 5000) # Los arrays de peces se crean al entrar en alcance
+            cardumenes.append(c)
+        return cardumenes
+
+
+def cargar_escenario(ruta):
+    """Carga un escenario JSON; si falla se usa el escenario por defecto."""
+    t_inicio = time.perf_counter()
+    try:
+        with open(ruta, 'r') as f:
+            datos = json.load(f)
+    except (IOError, json.JSONDecodeError) as e:
+        print(f"ADVERTENCIA: No se pudo cargar el escenario '{ruta}': {e}. Usando escenario por defecto.")
+        return Escenario(ESCENARIO_POR_DEFECTO)
+    escenario = Escenario(datos, os.path.dirname(os.path.abspath(ruta)))
+    print(f"INFO: Escenario '{ruta}' cargado en {(time.perf_counter() - t_inicio) * 1000:.0f} ms "
+          f"({len(escenario.datos_cardumenes)} cardúmenes).")
+    return escenario
+
+
+def refrescar_cardumenes_activos(cardumenes, delta_inactivos_s, nmea_activo, barco_lat, barco_lon, radio_m):
+    """
+    Devuelve los cardúmenes al alcance del sonar (los que se simulan frame a frame).
+    Los demás se avanzan en bloque con el tiempo transcurrido desde el último refresco.
+    """
+    activos = []
+    if not cardumenes:
+        return activos
+    n = len(cardumenes)
+    inactivos = [c for c in cardumenes if not c.activo]
+    if inactivos and delta_inactivos_s > 0:
+        desplaz = np.array([c.desplazamiento_lote(delta_inactivos_s) for c in inactivos], dtype=float)
+        if nmea_activo:
+            # Escala de la proyección local en la latitud del barco (válida para todo el escenario)
+            r_m, r_n = local_radii_m(barco_lat)
+            dlat = desplaz[:, 1] / r_m / DEG_TO_RAD
+            dlon = desplaz[:, 0] / (r_n * math.cos(math.radians(barco_lat))) / DEG_TO_RAD
+            for c, d_lat, d_lon in zip(inactivos, dlat.tolist(), dlon.tolist()):
+                c.lat += d_lat
+                c.lon += d_lon
+        else:
+            for c, dx, dy in zip(inactivos, desplaz[:, 0].tolist(), desplaz[:, 1].tolist()):
+                c.x_sim += dx
+                c.y_sim += dy
+    if nmea_activo:
+        lats = np.fromiter((c.lat for c in cardumenes), dtype=float, count=n)
+        lons = np.fromiter((c.lon for c in cardumenes), dtype=float, count=n)
+        xs, ys = geo_to_local_xy(lats, lons, barco_lat, barco_lon)
+    else:
+        xs = np.fromiter((c.x_sim for c in cardumenes), dtype=float, count=n)
+        ys = np.fromiter((c.y_sim for c in cardumenes), dtype=float, count=n)
+    radios = np.fromiter((c.radio_horizontal for c in cardumenes), dtype=float, count=n)
+    cerca = (np.hypot(xs, ys) <= radio_m + radios).tolist()
+    for c, es_activo in zip(cardumenes, cerca):
+        c.activo = es_activo
+        if es_activo:
+            if c.peces is None and c.num_peces:
+                c.peces = PecesCardumen(c.num_peces, c.radio_horizontal, c.altura_total, seed=c.semilla_eco)
+            activos.append(c)
+    return activos
+
+# Objetivo de arranque: 10.000 cardúmenes y un fondo de 100 MB en menos de un segundo
+ESCENARIO_BENCH_OBJETIVO_S = 1.0
+
+def benchmark_escenario(num_cardumenes=10000, tamano_fondo_mb=100):
+    """
+    Tiempo de arranque de un escenario grande: lectura del JSON, creación de los cardúmenes
+    (la mitad con modelo de partículas), primer refresco de los cardúmenes al alcance y
+    primera consulta al fondo, que se abre con memmap.
+    """
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as carpeta:
+        lado = int(math.sqrt(tamano_fondo_mb * 1024 * 1024 / 4))
+        fondo = np.lib.format.open_memmap(os.path.join(carpeta, "fondo.npy"), mode='w+',
+                                          dtype=np.float32, shape=(lado, lado))
+        fondo[:] = 80.0
+        fondo.flush()
+        del fondo
+        xs, ys = rng.uniform(-20000.0, 20000.0, (2, num_cardumenes)).tolist()
+        datos = {
+            "schools": [{"x_m": x, "y_m": y, "depth_center_m": 70, "depth_top_m": 40, "depth_bottom_m": 100,
+                         "radius_m": 100, "speed_kn": 3, "course_deg": (37 * i) % 360,
+                         "model": "particles" if i % 2 else "blob", "fish": 5000}
+                        for i, (x, y) in enumerate(zip(xs, ys))],
+            "seabed": {"file": "fondo.npy", "cell_size_m": 10, "origin_x_m": -5 * lado, "origin_y_m": -5 * lado},
+        }
+        ruta = os.path.join(carpeta, "escenario.json")
+        with open(ruta, 'w') as f:
+            json.dump(datos, f)
+        t0 = time.perf_counter()
+        escenario = cargar_escenario(ruta)
+        cardumenes = escenario.crear_cardumenes()
+        activos = refrescar_cardumenes_activos(cardumenes, 0.0, False, None, None, 1500.0)
+        profundidad = escenario.batimetria.profundidad_en(0.0, 0.0)
+        elapsed = time.perf_counter() - t0
+        escenario.batimetria._rejilla = None # Cierra el memmap antes de borrar la carpeta
+    veredicto = "OK" if elapsed < ESCENARIO_BENCH_OBJETIVO_S else "POR ENCIMA DEL OBJETIVO"
+    print(f"INFO: Arranque del escenario: {num_cardumenes:,} cardúmenes y fondo de {tamano_fondo_mb} MB en "
+          f"{elapsed * 1000:.0f} ms ({len(activos)} al alcance, fondo {profundidad:g} m; "
+          f"objetivo < {ESCENARIO_BENCH_OBJETIVO_S * 1000:.0f} ms: {veredicto})")
+    return elapsed
+
+if cli_args.bench_escenario:
+    benchmark_escenario()
+    raise SystemExit(0)
+
+# --- Fin Escenarios ---
+
+# --- Synthetic NMEA Generator ---
+NMEA_GENERATOR_MAX_POSITION_HZ = 100.0
+NMEA_GENERATOR_MAX_HEADING_HZ = 50.0
+NMEA_GENERATOR_DEFAULT_ROUTE = (43.36, -8.40, 45.0, 10.0) # lat, lon, heading, knots
+
+class NmeaGenerator:
+    """
+    Synthetic NMEA for an OwnShipRoute trajectory at any rate: GGA, RMC and VTG at
+    position_hz, HDT and PFEC,GPatt at heading_hz and ZDA once per second.
+    Checksums are correct except for the 'corruption' fraction of sentences.
+    poll() works like OwnShipRoute.poll, so it can replace it as a source.
+    """
+    def __init__(self, route, position_hz=10.0, heading_hz=None, corruption=0.0, seed=None):
+        self.route = route
+        self.position_hz = max(0.1, min(float(position_hz), NMEA_GENERATOR_MAX_POSITION_HZ))
+        self.heading_hz = max(0.1, min(float(heading_hz or position_hz), NMEA_GENERATOR_MAX_HEADING_HZ))
+        self.corruption = corruption
+        self.rng = random.Random(seed)
+        self.utc0 = time.time() # UTC of t = 0
+        self.last_poll_s = None
+
+    def _stamp(self, t_s):
+        utc = self.utc0 + t_s
+        tm = time.gmtime(utc)
+        return f"{tm.tm_hour:02d}{tm.tm_min:02d}{tm.tm_sec:02d}.{int(utc * 100) % 100:02d}", tm
+
+    def _finish(self, body):
+        sentence = build_nmea_sentence(body)
+        if self.corruption > 0 and self.rng.random() < self.corruption:
+            i = self.rng.randrange(1, len(body) + 1)
+            sentence = sentence[:i] + ('#' if sentence[i] != '#' else '%') + sentence[i + 1:]
+        return sentence
+
+    def position_sentences(self, t_s):
+        lat, lon, hdg, spd = self.route.pose_at(t_s)
+        lat_s, ns = format_nmea_lat(lat)
+        lon_s, ew = format_nmea_lon(lon)
+        hms, tm = self._stamp(t_s)
+        date = f"{tm.tm_mday:02d}{tm.tm_mon:02d}{tm.tm_year % 100:02d}"
+        return [
+            self._finish(f"GPGGA,{hms},{lat_s},{ns},{lon_s},{ew},1,10,0.8,5.0,M,50.0,M,,"),
+            self._finish(f"GNRMC,{hms},A,{lat_s},{ns},{lon_s},{ew},{spd:.1f},{hdg:.1f},{date},,,A"),
+            self._finish(f"GPVTG,{hdg:.1f},T,,M,{spd:.1f},N,{spd * 1.852:.1f},K,A"),
+        ]
+
+    def heading_sentences(self, t_s):
+        hdg = self.route.pose_at(t_s)[2]
+        pitch = 2.0 * math.sin(t_s * 2 * math.pi / 7.0) # Balance sintético
+        roll = 5.0 * math.sin(t_s * 2 * math.pi / 9.0)
+        return [
+            self._finish(f"HEHDT,{hdg:.1f},T"),
+            self._finish(f"PFEC,GPatt,{hdg:.1f},{pitch:+.1f},{roll:+.1f}"),
+        ]
+
+    def time_sentences(self, t_s):
+        hms, tm = self._stamp(t_s)
+        return [self._finish(f"GPZDA,{hms},{tm.tm_mday:02d},{tm.tm_mon:02d},{tm.tm_year:04d},00,00")]
+
+    def sentences_between(self, t0_s, t1_s):
+        """(t, sentence) of every emission in (t0_s, t1_s], in time order."""
+        out = []
+        for hz, make in ((self.position_hz, self.position_sentences),
+                         (self.heading_hz, self.heading_sentences),
+                         (1.0, self.time_sentences)):
+            k = math.floor(t0_s * hz) + 1
+            while k / hz <= t1_s:
+                t = k / hz
+                out.extend((t, sentence) for sentence in make(t))
+                k += 1
+        out.sort(key=operator.itemgetter(0))
+        return out
+
+    def poll(self, t_s):
+        """Sentences due since the previous call (t_s = seconds since the generator started)."""
+        t0 = t_s - 1e-9 if self.last_poll_s is None else self.last_poll_s
+        self.last_poll_s = t_s
+        return [sentence for _, sentence in self.sentences_between(t0, t_s)]
+
+def benchmark_nmea_ingest(rates=(1000, 5000, 20000, 50000, 100000), step_s=1.0):
+    """
+    End-to-end ingest capacity of each input path: generated sentences are pushed at
+    a fixed rate while a consumer drains and dispatches them every ~16 ms, as the
+    main loop does. Reports the highest rate delivered without loss.
+    """
+    generator = NmeaGenerator(OwnShipRoute(*NMEA_GENERATOR_DEFAULT_ROUTE),
+                              NMEA_GENERATOR_MAX_POSITION_HZ, NMEA_GENERATOR_MAX_HEADING_HZ)
+    pool = [sentence for _, sentence in generator.sentences_between(0.0, 60.0)]
+    raw_pool = [(sentence + "\r\n").encode('ascii') for sentence in pool]
+
+    def run_path(name, open_path):
+        capacity = 0
+        for rate in rates:
+            state = NmeaState()
+            send, drain, close = open_path()
+            total = int(rate * step_s)
+            sent = delivered = 0
+            t_start = time.perf_counter()
+            next_drain = t_start
+            while sent < total or time.perf_counter() - t_start < step_s + 0.2:
+                due = min(total, int((time.perf_counter() - t_start) * rate))
+                while sent < due:
+                    send(raw_pool[sent % len(raw_pool)])
+                    sent += 1
+                if time.perf_counter() >= next_drain:
+                    for record in drain():
+                        apply_nmea_record(record, state)
+                        delivered += 1
+                    next_drain += 1 / 60.0
+                if sent >= total and delivered >= total:
+                    break
+            elapsed = time.perf_counter() - t_start
+            close()
+            ok = delivered >= total
+            if ok:
+                capacity = rate
+            print(f"INFO: Ingesta {name}: {rate:>7,}/s pedidas -> {delivered / elapsed:>9,.0f}/s entregadas "
+                  f"({delivered}/{total}{'' if ok else ', SATURADO'})")
+            if not ok:
+                break
+        return capacity
+
+    def inproc_path():
+        pending = collections.deque()
+        return (lambda data: pending.append(data.decode('ascii').strip()),
+                lambda: [parse_nmea_sentence(line) for line in (pending.popleft() for _ in range(len(pending)))
+                         if is_valid_nmea_checksum(line)],
+                lambda: None)
+
+    def serial_path():
+        connection, reader = open_nmea_serial('loop://', 115200)
+        return connection.write, reader.drain, lambda: close_nmea_serial(connection, reader)
+
+    def udp_path():
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        hub = NmeaInputHub()
+        hub.set_sources([f"udp:{port}"])
+        time.sleep(0.2) # Let the listener bind
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        def close():
+            sender.close()
+            hub.stop()
+        return (lambda data: sender.sendto(data, ('127.0.0.1', port)), hub.drain, close)
+
+    results = {}
+    for name, open_path in (('en proceso', inproc_path), ('serie loop://', serial_path), ('UDP', udp_path)):
+        results[name] = run_path(name, open_path)
+    print("INFO: Capacidad de ingesta sin pérdidas: " +
+          ", ".join(f"{name} >= {rate:,}/s" for name, rate in results.items()))
+    return results
+
+if cli_args.bench_ingest:
+    benchmark_nmea_ingest()
+    raise SystemExit(0)
+# --- End Synthetic NMEA Generator ---
+
 # --- Lógica de Intersección Sonar-Cardumen ---
 def calcular_interseccion_sonar_cardumen(pos_rel_cardumen, tilt_deg, apertura_haz_vertical_deg, max_rango_sonar_m, menu_options=None, cardumen_obj=None):
     """
@@ -4345,7 +6899,7 @@ def calcular_interseccion_sonar_cardumen(pos_rel_cardumen, tilt_deg, apertura_ha
     apertura_haz_vertical_deg: Apertura total vertical del haz del sonar (ej. 15 grados).
     max_rango_sonar_m: Alcance máximo actual del sonar en metros.
     menu_options: Diccionario con las opciones del menú para aplicar efectos (TVG, Gain, etc.).
-    cardumen_obj: Objeto Cardumen para mantener estado (promedio).
+    cardumen_obj: Objeto Cardumen (sin uso: el promedio de eco se aplica al buffer polar completo).
     """
     dist_h = pos_rel_cardumen["dist_horizontal_m"]
     if dist_h == 0: # Evitar división por cero si el cardumen está directamente debajo
@@ -4433,52 +6987,31 @@ def calcular_interseccion_sonar_cardumen(pos_rel_cardumen, tilt_deg, apertura_ha
     # Intensidad final combinada
     # El factor de "200tn" se considera en cardumen.reflectividad_base
     intensidad_final = factor_solapamiento_vertical * factor_atenuacion_distancia
+    # Intensidad a inyectar en el buffer polar: sin potencia, TVG, CAG ni respuesta de color,
+    # que la etapa de ganancia del simulador aplica después a todo el ping.
+    intensidad_eco = intensidad_final
 
     # --- Procesamiento de Señal (Menu Options) ---
     if menu_options:
-        # 1. Potencia TX (1-10)
-        potencia_tx = menu_options.get('potencia_tx', 8)
-        intensidad_final *= (potencia_tx / 10.0)
-
-        # 2. TVG (Time Varied Gain)
+        # 1-2. Potencia TX y TVG (Time Varied Gain)
+        # La misma curva que SonarEchoSimulator.aplicar_ganancia aplica a todo el buffer polar.
         norm_dist = dist_slant_centro_solapamiento / max_rango_sonar_m if max_rango_sonar_m > 0 else 0
         norm_dist = min(norm_dist, 1.0)
-
-        tvg_near = menu_options.get('tvg_proximo', 6)
-        if tvg_near > 0:
-            suppression_factor = (tvg_near / 12.0) * math.exp(-norm_dist * 8) 
-            intensidad_final *= (1.0 - suppression_factor)
-
-        tvg_far = menu_options.get('tvg_lejano', 7)
-        if tvg_far > 0:
-            gain_boost = (tvg_far / 5.0) * norm_dist * norm_dist
-            intensidad_final *= (1.0 + gain_boost)
+        intensidad_final *= ganancia_tx_tvg(menu_options, norm_dist)
 
         # 3. CAG (Control Automático de Ganancia)
-        cag = menu_options.get('cag', 2)
-        # El AGC reduce la ganancia para ecos fuertes (como fondo o cardúmenes grandes)
-        if cag > 0:
-            # Factor de supresión cuadrático: afecta más a las señales fuertes
-            factor_cag = cag / 10.0
-            supresion = factor_cag * (intensidad_final ** 2)
-            intensidad_final -= supresion
-            if intensidad_final < 0:
-                intensidad_final = 0
-        
-        cag_2 = menu_options.get('cag_2', 1)
+        # El AGC reduce la ganancia para ecos fuertes (como fondo o cardúmenes grandes), con la
+        # misma compresión monótona que el buffer polar: un eco fuerte lejano no llega a cero.
+        intensidad_final = comprimir_cag_escalar(intensidad_final, menu_options.get('cag', 2))
         # 2do CAG: capa adicional de supresión
-        if cag_2 > 0:
-            factor_cag_2 = cag_2 / 10.0
-            supresion_2 = factor_cag_2 * (intensidad_final ** 2)
-            intensidad_final -= supresion_2
-            if intensidad_final < 0:
-                intensidad_final = 0
+        intensidad_final = comprimir_cag_escalar(intensidad_final, menu_options.get('cag_2', 1))
 
         # 4. Longitud de Impulso
         long_impulso = menu_options.get('long_impulso', 8)
         extra_length = (long_impulso / 10.0) * 40.0 
         longitud_radial_mancha_m += extra_length
         intensidad_final *= (1.0 + long_impulso / 20.0)
+        intensidad_eco *= (1.0 + long_impulso / 20.0)
 
         # 5. Limitar Ruido (Noise Limiter)
         # Suprime señales débiles (ruido de fondo simulado)
@@ -4491,26 +7024,12 @@ def calcular_interseccion_sonar_cardumen(pos_rel_cardumen, tilt_deg, apertura_ha
                 intensidad_final -= (noise_threshold * 0.5) # Reducción suave sobre el umbral
 
         # 6. Rechazo Interf (Interference Reject)
-        # Simulamos reducción aleatoria o filtrado
-        rechazo_interf = menu_options.get('rechazo_interf', 1) # 0-3
-        if rechazo_interf > 0:
-            # Simulación simple: reducir picos aleatorios o suavizar.
-            # Aquí solo aplicamos una pequeña reducción constante para simular el filtrado agresivo.
-            intensidad_final *= (1.0 - (rechazo_interf * 0.05))
+        # Se filtra ping a ping en SonarEchoSimulator.aplicar_rechazo_interferencia
+        # (picos de interferencia que no se repiten entre pings consecutivos).
 
         # 7. Promedio Eco (Echo Average)
-        promedio_eco = menu_options.get('promedio_eco', 1) # 0-3
-        if cardumen_obj:
-            # Blend with history
-            alpha = 1.0
-            if promedio_eco == 1: alpha = 0.5
-            elif promedio_eco == 2: alpha = 0.25
-            elif promedio_eco == 3: alpha = 0.125
-            
-            if promedio_eco > 0:
-                intensidad_final = (intensidad_final * alpha) + (cardumen_obj.avg_intensity * (1.0 - alpha))
-            
-            cardumen_obj.avg_intensity = intensidad_final
+        # Se aplica pixel a pixel entre pings en SonarEchoSimulator.aplicar_promedio
+        # (afecta a toda la imagen, ruido incluido, no sólo al eco del cardumen).
 
         # 8. Angulo Haz Hor (Horizontal Beamwidth)
         # ANCHO vs ESTRECHO
@@ -4536,14 +7055,13 @@ def calcular_interseccion_sonar_cardumen(pos_rel_cardumen, tilt_deg, apertura_ha
         
         if intensidad_final > 0:
             intensidad_final = pow(intensidad_final, gamma)
+        if intensidad_eco > 0:
+            intensidad_eco = pow(min(intensidad_eco, 1.0), gamma)
 
         # Respuesta: Afecta la ganancia dinámica (pendiente)
         # "valores más altos (4), más rojo... da la sensación de que se ha aumentado la ganancia."
         # Se implementa como un multiplicador de ganancia adicional.
-        factor_respuesta = 1.0
-        if respuesta_color == 2: factor_respuesta = 1.2
-        elif respuesta_color == 3: factor_respuesta = 1.5
-        elif respuesta_color == 4: factor_respuesta = 1.9 # Almost double
+        factor_respuesta = FACTORES_RESPUESTA_COLOR.get(respuesta_color, 1.0)
         
         intensidad_final *= factor_respuesta
 
@@ -4553,10 +7071,12 @@ def calcular_interseccion_sonar_cardumen(pos_rel_cardumen, tilt_deg, apertura_ha
 
     return {
         "intensidad_factor": max(0, min(intensidad_final, 1.0)), # Clamp entre 0 y 1
+        "intensidad_eco": max(0, min(intensidad_eco, 1.0)), # Antes de la etapa de ganancia
         "dist_slant_m": dist_slant_centro_solapamiento, # Distancia inclinada al centro del eco
         "rumbo_relativo_deg": pos_rel_cardumen["rumbo_relativo_deg"], # Rumbo para colocarlo en PPI
         "media_anchura_angular_rad": media_anchura_angular_subtendida_rad, # Para el ancho de la mancha en PPI
-        "longitud_radial_m": longitud_radial_mancha_m # Para la "profundidad" de la mancha en PPI
+        "longitud_radial_m": longitud_radial_mancha_m, # Para la "profundidad" de la mancha en PPI
+        "factor_solapamiento": factor_solapamiento_vertical # El modelo de partículas pondera el haz pez a pez
     }
 
 # --- Fin Lógica de Intersección ---
@@ -4783,57 +7303,57 @@ except pygame.error as e:
 
 
 # --- Auto-connect on Startup ---
-if puerto:
+# The worker keeps retrying with backoff, so a saved port that is missing at startup
+# connects as soon as it is plugged in.
+serial_manager = SerialConnectionManager()
+if puerto and puerto != "Ninguno":
     print(f"INFO: Se ha encontrado una configuración de puerto guardada. Intentando conectar a {puerto}@{baudios}...")
-    try:
-        ser = serial.Serial(puerto, baudios, timeout=1)
-        serial_port_available = True
-        print(f"INFO: Conectado automáticamente a {puerto}.")
-    except serial.SerialException as e:
-        print(f"ADVERTENCIA: No se pudo conectar automáticamente al puerto guardado {puerto}: {e}")
-        puerto = None # Reset to avoid repeated failed attempts by other logic
-        ser = None
-        serial_port_available = False
+serial_manager.request(puerto, baudios)
+# ---
+
+# --- Network NMEA sources (UDP / TCP) selected in the SISTEMA menu ---
+nmea_hub = NmeaInputHub()
+nmea_hub.set_sources(nmea_network_sources(menu.options))
+nmea_recorder = None # NmeaRecorder while SISTEMA > GRABAR NMEA is ON
+nmea_replay = open_nmea_replay(cli_args.replay, cli_args.replay_speed, cli_args.replay_start) if cli_args.replay else None
+# ---
+
+# --- Track and marks history across sessions (SISTEMA > HISTORIAL DERROTA) ---
+# Opened by update_nav_history() once the option is on and there is a fix
+nav_history = None
+nav_history_failed = False
 # ---
 
 # --- Inicialización del Cardumen ---
-# Parámetros iniciales del cardumen
-# Lat/Lon iniciales (si NMEA está disponible, sino se usan x_sim, y_sim)
-# Para un barco en lat=0, lon=0, y el cardumen en la proa a 600m,
-# si la proa es Norte (0°), el cardumen estaría en lat_cardumen_inicial, lon=0.
-# geopy puede calcular esto: Point(0,0).destination(meters=600, bearing=0)
-# Por ahora, si no hay NMEA, la posición geográfica no se usa activamente para el movimiento.
-# Usaremos una lat/lon placeholder y nos centraremos en x_sim, y_sim.
-lat_cardumen_placeholder = 0.0
-lon_cardumen_placeholder = 0.0
-
-# Profundidad centro: 40m (sup) + 60m (altura) / 2 = 70m desde superficie.
-profundidad_centro_cardumen_m = 70
-velocidad_cardumen_nudos = 4
-curso_cardumen_grados = 180
-radio_hor_cardumen_m = 200 / 2 # Diámetro 200m
-prof_sup_cardumen_m = 40
-prof_inf_cardumen_m = 100
-
-cardumen_simulado = Cardumen(
-    lat_inicial=lat_cardumen_placeholder,
-    lon_inicial=lon_cardumen_placeholder,
-    profundidad_centro_inicial_m=profundidad_centro_cardumen_m,
-    velocidad_nudos=velocidad_cardumen_nudos,
-    curso_grados=curso_cardumen_grados,
-    radio_horizontal_m=radio_hor_cardumen_m,
-    profundidad_superior_m=prof_sup_cardumen_m,
-    profundidad_inferior_m=prof_inf_cardumen_m
-)
-
-# Posición inicial simulada del cardumen: 1200m en proa.
-# En nuestro sistema simulado sin NMEA, proa es +Y (Norte).
-cardumen_simulado.x_sim = 0  # Directamente en proa
-cardumen_simulado.y_sim = 1200 # A 1200m hacia el "Norte" relativo del barco
+# Los cardúmenes (y opcionalmente el fondo y la derrota del barco propio) vienen del
+# escenario; sin fichero de escenario se usa el cardumen por defecto en proa a 1200m.
+ruta_escenario = cli_args.scenario or (SCENARIO_FILE if os.path.exists(SCENARIO_FILE) else None)
+escenario = cargar_escenario(ruta_escenario) if ruta_escenario else Escenario(ESCENARIO_POR_DEFECTO)
+if escenario.menu_options:
+    menu.options.update(escenario.menu_options)
+cardumenes = escenario.crear_cardumenes()
+cardumenes_activos = []
+tiempo_ultimo_refresco_cardumenes = None # Fuerza un refresco en el primer frame
+own_ship_route = escenario.ruta_barco
+own_ship_route_start_s = time.monotonic()
+# Synthetic high-rate NMEA (--nmea-sim) for the scenario route, or a default one
+nmea_generator = None
+nmea_generator_socket = None
+if cli_args.nmea_sim:
+    if own_ship_route is None:
+        own_ship_route = OwnShipRoute(*NMEA_GENERATOR_DEFAULT_ROUTE)
+    nmea_generator = NmeaGenerator(own_ship_route, cli_args.nmea_sim, corruption=cli_args.nmea_sim_corrupt)
+    sim_output = cli_args.nmea_sim_output
+    if isinstance(sim_output, tuple): # (host, port), validated by nmea_sim_output_arg
+        nmea_generator_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sim_output = f"udp:{sim_output[0]}:{sim_output[1]}"
+    print(f"INFO: Generador NMEA a {nmea_generator.position_hz:g} Hz (rumbo {nmea_generator.heading_hz:g} Hz) "
+          f"-> {sim_output}.")
 # --- Fin Inicialización del Cardumen ---
 
 # --- Inicialización del Sistema Sonda ---
 echosounder_sim = Echosounder(100, 100, current_colors, menu.options) # Initial size, will be resized
+echosounder_sim.batimetria = escenario.batimetria
 # ---
 
 # --- Inicialización del Simulador de Eco ---
@@ -4844,6 +7364,7 @@ echo_simulator = SonarEchoSimulator(initial_display_radius)
 
 # --- Estado de Inicialización Geográfica del Cardumen ---
 cardumen_posicion_geografica_inicializada = False
+nmea_input_available = serial_port_available or nmea_hub.active or own_ship_route is not None or nmea_replay is not None # Puerto serie, red, derrota simulada o replay
 # --- Fin Estado de Inicialización Geográfica del Cardumen ---
 
 # --- Variables para el Retardo del Sonido del Eco ---
@@ -4860,23 +7381,11 @@ while not hecho:
     nuevos_baudios = menu.options.get('port_baudios', 9600)
 
     # Lógica para reconectar el puerto serie si cambia en el menú
+    # (the open itself happens in the connection manager's worker, never in this loop)
     if nuevo_puerto != puerto or nuevos_baudios != baudios:
-        if ser:
-            ser.close()
         puerto = nuevo_puerto
         baudios = nuevos_baudios
-        if puerto and puerto != "Ninguno":
-            try:
-                ser = serial.Serial(puerto, baudios, timeout=1)
-                serial_port_available = True
-                print(f"Conectado al puerto {puerto} a {baudios} baudios.")
-            except serial.SerialException as e:
-                print(f"No se pudo conectar al puerto {puerto}: {e}")
-                ser = None
-                serial_port_available = False
-        else:
-            ser = None
-            serial_port_available = False
+        serial_manager.request(puerto, baudios)
     
     # --- Recalcular dimensiones de UI basadas en el tamaño actual de la ventana (`dimensiones`) ---
     # Primero, definir el ancho del panel de datos. Podría ser fijo o un porcentaje.
@@ -4969,80 +7478,73 @@ while not hecho:
         ui_state["show_plus_cursor"] = True
         ui_state["mouse_cursor_pos"] = (mouse_x, mouse_y)
 
-        # Calculate metric distance
-        pixel_dist = dist_to_center
         # Ensure current_range_index is valid before accessing presets
         if current_range_index >= len(range_presets_map[current_unit]):
             current_range_index = len(range_presets_map[current_unit]) - 1
         S_max = range_presets_map[current_unit][current_range_index] # Max slant range for display edge
-        
-        if display_radius_pixels > 0:
-            S_cursor = (pixel_dist / display_radius_pixels) * S_max # Slant range to cursor point ("posicion del cursor horizontal (distancia)")
-            
-            H_display = S_cursor # Default if no tilt (Horizontal Projection = Slant Range)
-            D_display = 0.0      # Default if no tilt (Depth = 0)
-
-            if current_tilt_angle != 0:
-                tilt_rad = math.radians(current_tilt_angle)
-                H_display = S_cursor * math.cos(tilt_rad) # Horizontal projection ("distancia diagonal" in user example)
-                D_display = S_cursor * math.sin(tilt_rad) # Depth ("profundidad" in user example)
-
-            # Bearing Calculation
-            dx = mouse_x - circle_center_x
-            dy = mouse_y - circle_center_y
-            if pixel_dist == 0: # Cursor exactly at center
-                bearing_deg_normalized = 0 
-            else:
-                angle_rad_atan2 = math.atan2(dy, dx)
-                # atan2: 0 is East. Pygame y is inverted.
-                # +90 to make North 0. +360 to ensure positive before final modulo.
-                bearing_deg_normalized = (math.degrees(angle_rad_atan2) + 90 + 360) % 360
-
-            ui_state["cursor_H_proj_display"] = f"{int(round(H_display))}"
-            ui_state["cursor_S_range_display"] = f"{int(round(S_cursor))}" 
-            ui_state["cursor_Depth_display"] = f"{int(round(D_display))}"
-            ui_state["cursor_bearing_display"] = f"{int(round(bearing_deg_normalized))}"
-
-            # --- NEW: Calculate Geographic Position of Cursor ---
-            if current_ship_lat_deg is not None and current_ship_lon_deg is not None:
-                # S_cursor is slant range in current units. Convert to meters for geo calculation.
-                s_cursor_meters = S_cursor
-                if current_unit == "BRAZAS":
-                    s_cursor_meters *= 1.8288
-                elif current_unit == "PIES":
-                    s_cursor_meters *= 0.3048
-
-                # bearing_deg_normalized is bearing relative to SCREEN UP.
-                # We need bearing relative to TRUE NORTH.
-                true_bearing_deg = (bearing_deg_normalized + current_ship_heading) % 360
-
-                start_point = Point(latitude=current_ship_lat_deg, longitude=current_ship_lon_deg)
-                destination = geodesic(meters=s_cursor_meters).destination(point=start_point, bearing=true_bearing_deg)
-
-                lat_deg = destination.latitude
-                lon_deg = destination.longitude
-
-                lat_hem = 'N' if lat_deg >= 0 else 'S'
-                lon_hem = 'E' if lon_deg >= 0 else 'W'
-                
-                lat_deg_abs = abs(lat_deg)
-                lat_d = int(lat_deg_abs)
-                lat_m = (lat_deg_abs - lat_d) * 60
-                
-                lon_deg_abs = abs(lon_deg)
-                lon_d = int(lon_deg_abs)
-                lon_m = (lon_deg_abs - lon_d) * 60
 
-                ui_state["cursor_lat_str"] = f"{lat_d:02d}° {lat_m:06.3f}'{lat_hem}"
-                ui_state["cursor_lon_str"] = f"{lon_d:03d}° {lon_m:06.3f}'{lon_hem}"
+        # The readout (and its strings) only changes with the mouse, the render pose or the view
+        cursor_readout_key = (mouse_x, mouse_y, circle_center_x, circle_center_y, display_radius_pixels,
+                              S_max, current_unit, current_tilt_angle,
+                              current_ship_lat_deg, current_ship_lon_deg, current_ship_heading)
+        if cursor_readout_key != last_cursor_readout_key:
+            last_cursor_readout_key = cursor_readout_key
+            # Calculate metric distance
+            pixel_dist = dist_to_center
+            if display_radius_pixels > 0:
+                S_cursor = (pixel_dist / display_radius_pixels) * S_max # Slant range to cursor point ("posicion del cursor horizontal (distancia)")
+            
+                H_display = S_cursor # Default if no tilt (Horizontal Projection = Slant Range)
+                D_display = 0.0      # Default if no tilt (Depth = 0)
+
+                if current_tilt_angle != 0:
+                    tilt_rad = math.radians(current_tilt_angle)
+                    H_display = S_cursor * math.cos(tilt_rad) # Horizontal projection ("distancia diagonal" in user example)
+                    D_display = S_cursor * math.sin(tilt_rad) # Depth ("profundidad" in user example)
+
+                # Bearing Calculation
+                dx = mouse_x - circle_center_x
+                dy = mouse_y - circle_center_y
+                if pixel_dist == 0: # Cursor exactly at center
+                    bearing_deg_normalized = 0 
+                else:
+                    angle_rad_atan2 = math.atan2(dy, dx)
+                    # atan2: 0 is East. Pygame y is inverted.
+                    # +90 to make North 0. +360 to ensure positive before final modulo.
+                    bearing_deg_normalized = (math.degrees(angle_rad_atan2) + 90 + 360) % 360
+
+                ui_state["cursor_H_proj_display"] = f"{int(round(H_display))}"
+                ui_state["cursor_S_range_display"] = f"{int(round(S_cursor))}" 
+                ui_state["cursor_Depth_display"] = f"{int(round(D_display))}"
+                ui_state["cursor_bearing_display"] = f"{int(round(bearing_deg_normalized))}"
+
+                # --- NEW: Calculate Geographic Position of Cursor ---
+                if current_ship_lat_deg is not None and current_ship_lon_deg is not None:
+                    # S_cursor is slant range in current units. Convert to meters for geo calculation.
+                    s_cursor_meters = S_cursor
+                    if current_unit == "BRAZAS":
+                        s_cursor_meters *= 1.8288
+                    elif current_unit == "PIES":
+                        s_cursor_meters *= 0.3048
+
+                    # bearing_deg_normalized is bearing relative to SCREEN UP.
+                    # We need bearing relative to TRUE NORTH.
+                    true_bearing_deg = (bearing_deg_normalized + current_ship_heading) % 360
+
+                    # Local projection around the ship (no geodesic call at sonar ranges)
+                    true_bearing_rad = math.radians(true_bearing_deg)
+                    lat_deg, lon_deg = local_xy_to_geo(s_cursor_meters * math.sin(true_bearing_rad),
+                                                       s_cursor_meters * math.cos(true_bearing_rad),
+                                                       current_ship_lat_deg, current_ship_lon_deg)
+                    ui_state["cursor_lat_str"], ui_state["cursor_lon_str"] = format_lat_lon_dm(lat_deg, lon_deg)
+                else:
+                    ui_state["cursor_lat_str"] = "N/A"
+                    ui_state["cursor_lon_str"] = "N/A"
             else:
-                ui_state["cursor_lat_str"] = "N/A"
-                ui_state["cursor_lon_str"] = "N/A"
-        else:
-            ui_state["cursor_H_proj_display"] = "Error"
-            ui_state["cursor_S_range_display"] = "Error"
-            ui_state["cursor_Depth_display"] = "Error"
-            ui_state["cursor_bearing_display"] = "Error"
+                ui_state["cursor_H_proj_display"] = "Error"
+                ui_state["cursor_S_range_display"] = "Error"
+                ui_state["cursor_Depth_display"] = "Error"
+                ui_state["cursor_bearing_display"] = "Error"
     else:
         pygame.mouse.set_visible(True)
         ui_state["show_plus_cursor"] = False
@@ -5050,6 +7552,7 @@ while not hecho:
         ui_state["cursor_S_range_display"] = "---"
         ui_state["cursor_Depth_display"] = "---"
         ui_state["cursor_bearing_display"] = "---"
+        last_cursor_readout_key = None
     # --- End Mouse Tracking Logic ---
 
     # --- Calculate Target Data ---
@@ -5058,9 +7561,16 @@ while not hecho:
         current_range_index = len(range_presets_map[current_unit]) - 1
     s_max_for_calc = range_presets_map[current_unit][current_range_index]
     
-    calculate_target_data(target_markers, current_tilt_angle, s_max_for_calc, 
-                           display_radius_pixels, current_unit, 
-                           (circle_center_x, circle_center_y), current_ship_heading)
+    # Only redone when a target is added, removed or converted, the pose moves or the view,
+    # units, tilt or range change
+    target_data_key = (target_markers.version, current_ship_lat_deg, current_ship_lon_deg, current_ship_heading,
+                       current_tilt_angle, s_max_for_calc, display_radius_pixels, current_unit,
+                       circle_center_x, circle_center_y)
+    if target_data_key != last_target_data_key:
+        calculate_target_data(target_markers, current_tilt_angle, s_max_for_calc, 
+                               display_radius_pixels, current_unit, 
+                               (circle_center_x, circle_center_y), current_ship_heading)
+        last_target_data_key = target_data_key
     # --- End Calculate Target Data ---
 
     # --- Update Marker Screen Positions based on Geo Pos ---
@@ -5069,44 +7579,45 @@ while not hecho:
         current_range_index = len(range_presets_map[current_unit]) - 1
     s_max_for_update = range_presets_map[current_unit][current_range_index]
 
-    update_marker_screen_positions(target_markers, current_ship_lat_deg, current_ship_lon_deg,
-                                   current_ship_heading, circle_center_x, circle_center_y,
-                                   display_radius_pixels, s_max_for_update, current_unit)
-    update_marker_screen_positions(triangle_markers, current_ship_lat_deg, current_ship_lon_deg,
-                                   current_ship_heading, circle_center_x, circle_center_y,
-                                   display_radius_pixels, s_max_for_update, current_unit)
+    # The render pose only changes when it moves the picture by a pixel or more, so the
+    # (vectorized) reprojection is skipped while the pose, view and marker stores are unchanged.
+    marker_view_key = (current_ship_lat_deg, current_ship_lon_deg, current_ship_heading,
+                       circle_center_x, circle_center_y, display_radius_pixels, s_max_for_update, current_unit,
+                       target_markers.version, triangle_markers.version)
+    if marker_view_key != last_marker_view_key:
+        range_m_for_update = s_max_for_update * (1.8288 if current_unit == "BRAZAS" else 1.0)
+        for markers in (target_markers, triangle_markers):
+            markers.reproject(current_ship_lat_deg, current_ship_lon_deg, current_ship_heading,
+                              circle_center_x, circle_center_y, display_radius_pixels, range_m_for_update)
+        target_line_runs = clip_polyline_to_circle(target_markers.x[:len(target_markers)],
+                                                   target_markers.y[:len(target_markers)],
+                                                   circle_center_x, circle_center_y, display_radius_pixels - 0.5)
+        last_marker_view_key = marker_view_key
     # --- End Update Marker Screen Positions ---
 
     # --- Inicialización/Actualización de Posición Geográfica del Cardumen con NMEA ---
-    if serial_port_available and current_ship_lat_deg is not None and current_ship_lon_deg is not None:
-        if not cardumen_posicion_geografica_inicializada:
-            # NMEA acaba de activarse con una posición válida, y el cardumen aún no ha sido posicionado geográficamente.
-            distancia_sim_m = math.sqrt(cardumen_simulado.x_sim**2 + cardumen_simulado.y_sim**2)
-            # Angulo de (0,0) a (x_sim, y_sim) en el plano simulado (Norte = 0 rad, Este = PI/2 rad)
-            # atan2(dx, dy) -> atan2(x_sim, y_sim)
-            bearing_sim_rad = math.atan2(cardumen_simulado.x_sim, cardumen_simulado.y_sim)
-            # bearing_sim_deg es el rumbo relativo del cardumen respecto a la proa del barco (0° = proa)
-            # en el sistema de coordenadas simulado (donde proa es +Y).
-            # Si x_sim=0, y_sim=600 (proa), bearing_sim_rad = atan2(0,600) = 0 rad = 0 deg.
-            # Si x_sim=600, y_sim=0 (estribor), bearing_sim_rad = atan2(600,0) = PI/2 rad = 90 deg.
-            bearing_sim_deg = math.degrees(bearing_sim_rad) 
-
-            # El rumbo verdadero al cardumen es el rumbo actual del barco + el rumbo relativo simulado.
-            true_bearing_to_cardumen_deg = (current_ship_heading + bearing_sim_deg + 360) % 360
-            
-            start_point = Point(latitude=current_ship_lat_deg, longitude=current_ship_lon_deg)
-            try:
-                destination = geodesic(meters=distancia_sim_m).destination(point=start_point, bearing=true_bearing_to_cardumen_deg)
-                cardumen_simulado.lat = destination.latitude
-                cardumen_simulado.lon = destination.longitude
-                cardumen_posicion_geografica_inicializada = True
-                print(f"INFO: Cardumen inicializado geográficamente en Lat: {cardumen_simulado.lat:.4f}, Lon: {cardumen_simulado.lon:.4f} (Dist: {distancia_sim_m:.1f}m, Bearing: {true_bearing_to_cardumen_deg:.1f}° from ship at {current_ship_lat_deg:.4f},{current_ship_lon_deg:.4f} heading {current_ship_heading:.1f}°)")
-            except Exception as e_geo_init:
-                print(f"ERROR: Fallo al calcular destino geográfico inicial del cardumen: {e_geo_init}")
-                # El cardumen permanecerá en su lat/lon placeholder (0,0) hasta el próximo intento exitoso.
-                # cardumen_posicion_geografica_inicializada permanecerá False.
-
-    elif not serial_port_available or current_ship_lat_deg is None or current_ship_lon_deg is None:
+    if nmea_input_available and current_ship_lat_deg is not None and current_ship_lon_deg is not None:
+        if not cardumen_posicion_geografica_inicializada and cardumenes:
+            # NMEA acaba de activarse con una posición válida, y los cardúmenes aún no han sido posicionados geográficamente.
+            # (x_sim, y_sim) están en el plano simulado donde proa es +Y, así que se giran con el rumbo
+            # actual del barco y se pasan a lat/lon con la proyección local (todos a la vez).
+            xs_sim = np.array([c.x_sim for c in cardumenes], dtype=float)
+            ys_sim = np.array([c.y_sim for c in cardumenes], dtype=float)
+            hdg_rad = math.radians(current_ship_heading)
+            xs_este = xs_sim * math.cos(hdg_rad) + ys_sim * math.sin(hdg_rad)
+            ys_norte = ys_sim * math.cos(hdg_rad) - xs_sim * math.sin(hdg_rad)
+            lats, lons = local_xy_to_geo(xs_este, ys_norte, current_ship_lat_deg, current_ship_lon_deg)
+            for c, lat_c, lon_c in zip(cardumenes, lats, lons):
+                c.lat = float(lat_c)
+                c.lon = float(lon_c)
+                c.geo_inicializado = True
+            cardumen_posicion_geografica_inicializada = True
+            tiempo_ultimo_refresco_cardumenes = None # Recalcular activos en coordenadas geográficas
+            print(f"INFO: {len(cardumenes)} cardumen(es) inicializados geográficamente desde el barco en "
+                  f"{current_ship_lat_deg:.4f},{current_ship_lon_deg:.4f} heading {current_ship_heading:.1f}° "
+                  f"(primero en Lat: {cardumenes[0].lat:.4f}, Lon: {cardumenes[0].lon:.4f}).")
+
+    elif not nmea_input_available or current_ship_lat_deg is None or current_ship_lon_deg is None:
         # NMEA se ha perdido o no está disponible. Reseteamos el flag.
         if cardumen_posicion_geografica_inicializada:
             print("INFO: Conexión NMEA perdida o inválida. Cardumen volverá a modo simulación XY si NMEA se reactiva.")
@@ -5114,40 +7625,26 @@ while not hecho:
             # conocida geográficamente, para una transición más suave si NMEA vuelve.
             # Por ahora, simplemente reseteamos el flag.
             cardumen_posicion_geografica_inicializada = False
+            tiempo_ultimo_refresco_cardumenes = None
     # --- Fin Inicialización/Actualización de Posición Geográfica del Cardumen ---
 
     # --- Hover Logic for Target Markers ---
     ui_state['hovered_marker_index'] = None # Reset hover state each frame
     ui_state['hovered_marker_list'] = None
     if not menu.active:
-        # Reset hover state for all markers first
-        for marker in target_markers: marker['is_hovered'] = False
-        for marker in triangle_markers: marker['is_hovered'] = False
-
-        # Check target_markers
-        for i, marker_data in enumerate(target_markers):
-            if marker_data['current_screen_pos']:
-                mx, my = marker_data['current_screen_pos']
-                marker_icon_size = 18
-                hover_rect = pygame.Rect(mx - marker_icon_size // 2, my - marker_icon_size // 2, marker_icon_size, marker_icon_size)
-                if hover_rect.collidepoint(mouse_x, mouse_y):
-                    ui_state['hovered_marker_index'] = i
-                    ui_state['hovered_marker_list'] = 'target'
-                    marker_data['is_hovered'] = True
-                    break
-        
-        # If no hover found yet, check triangle_markers
-        if ui_state['hovered_marker_index'] is None:
-            for i, marker_data in enumerate(triangle_markers):
-                if marker_data['current_screen_pos']:
-                    mx, my = marker_data['current_screen_pos']
-                    marker_icon_size = 18
-                    hover_rect = pygame.Rect(mx - marker_icon_size // 2, my - marker_icon_size // 2, marker_icon_size, marker_icon_size)
-                    if hover_rect.collidepoint(mouse_x, mouse_y):
-                        ui_state['hovered_marker_index'] = i
-                        ui_state['hovered_marker_list'] = 'triangle'
-                        marker_data['is_hovered'] = True
-                        break
+        # Targets first, then triangles; only the first marker under the cursor is hovered
+        hovered_row = target_markers.hit(mouse_x, mouse_y)
+        target_markers.set_hovered(hovered_row)
+        if hovered_row is not None:
+            ui_state['hovered_marker_index'] = hovered_row
+            ui_state['hovered_marker_list'] = 'target'
+            triangle_markers.set_hovered(None)
+        else:
+            hovered_row = triangle_markers.hit(mouse_x, mouse_y)
+            triangle_markers.set_hovered(hovered_row)
+            if hovered_row is not None:
+                ui_state['hovered_marker_index'] = hovered_row
+                ui_state['hovered_marker_list'] = 'triangle'
     # --- End Hover Logic ---
 
     # --- Update Ship Track ---
@@ -5210,19 +7707,8 @@ while not hecho:
     
     # Determinar si hay datos NMEA válidos para la actualización del cardumen
     # (current_ship_lat_deg no es None y current_ship_lon_deg no es None)
-    # Y serial_port_available es True.
-    nmea_para_cardumen = serial_port_available and current_ship_lat_deg is not None and current_ship_lon_deg is not None
-
-    cardumen_simulado.actualizar_posicion(delta_tiempo_s, datos_nmea_disponibles=nmea_para_cardumen)
-
-    # Obtener posición relativa del cardumen para la lógica de intersección y dibujo
-    # Usar current_ship_heading (que es 0.0 si no hay NMEA)
-    pos_rel_cardumen = cardumen_simulado.get_posicion_relativa_barco(
-        current_ship_lat_deg, # Puede ser None
-        current_ship_lon_deg, # Puede ser None
-        effective_heading, # Usar effective_heading para aplicar ajuste de proa
-        datos_nmea_disponibles=nmea_para_cardumen
-    )
+    # Y hay entrada NMEA (puerto serie o derrota del escenario).
+    nmea_para_cardumen = nmea_input_available and current_ship_lat_deg is not None and current_ship_lon_deg is not None
 
     # Calcular intersección
     # Necesitamos el rango máximo del sonar EN METROS
@@ -5231,23 +7717,60 @@ while not hecho:
     if current_unit == "BRAZAS":
         max_rango_actual_metros *= 1.8288
     
+    # Sólo los cardúmenes al alcance del sonar se simulan frame a frame
+    ahora_s = time.monotonic()
+    if tiempo_ultimo_refresco_cardumenes is None or \
+       ahora_s - tiempo_ultimo_refresco_cardumenes >= INTERVALO_CARDUMENES_ACTIVOS_S:
+        delta_inactivos_s = 0.0 if tiempo_ultimo_refresco_cardumenes is None else ahora_s - tiempo_ultimo_refresco_cardumenes
+        tiempo_ultimo_refresco_cardumenes = ahora_s
+        cardumenes_activos = refrescar_cardumenes_activos(
+            cardumenes, delta_inactivos_s, nmea_para_cardumen,
+            current_ship_lat_deg, current_ship_lon_deg, max_rango_actual_metros * 1.5)
+
     # Conectar la opción del menú 'angulo_haz_ver' a la lógica
     angulo_haz_ver_str = menu.options.get('angulo_haz_ver', 'ANCHO')
     apertura_haz_vertical_deg = 15.0 if angulo_haz_ver_str == 'ANCHO' else 7.5
 
-    info_interseccion_cardumen = calcular_interseccion_sonar_cardumen(
-        pos_rel_cardumen,
-        current_tilt_angle, # El tilt actual del sonar
-        apertura_haz_vertical_deg,
-        max_rango_actual_metros,
-        menu.options, # Pasar opciones del menú
-        cardumen_simulado # Pasar objeto cardumen
-    )
+    ecos_cardumenes = [] # (cardumen, info de intersección) de cada cardumen activo
+    info_interseccion_cardumen = None # El eco más intenso (sonido y alarma)
+    pos_rel_cardumen = None # El cardumen más cercano en horizontal (sonda)
+    for cardumen in cardumenes_activos:
+        cardumen.actualizar_posicion(delta_tiempo_s, datos_nmea_disponibles=nmea_para_cardumen)
+        if cardumen.peces is not None:
+            cardumen.peces.actualizar(delta_tiempo_s)
+
+        # Obtener posición relativa del cardumen para la lógica de intersección y dibujo
+        # Usar current_ship_heading (que es 0.0 si no hay NMEA)
+        pos_rel = cardumen.get_posicion_relativa_barco(
+            current_ship_lat_deg, # Puede ser None
+            current_ship_lon_deg, # Puede ser None
+            effective_heading, # Usar effective_heading para aplicar ajuste de proa
+            datos_nmea_disponibles=nmea_para_cardumen
+        )
+        if pos_rel_cardumen is None or pos_rel["dist_horizontal_m"] < pos_rel_cardumen["dist_horizontal_m"]:
+            pos_rel_cardumen = pos_rel
+
+        info = calcular_interseccion_sonar_cardumen(
+            pos_rel,
+            current_tilt_angle, # El tilt actual del sonar
+            apertura_haz_vertical_deg,
+            max_rango_actual_metros,
+            menu.options, # Pasar opciones del menú
+            cardumen # Pasar objeto cardumen
+        )
+        ecos_cardumenes.append((cardumen, pos_rel, info))
+        if info_interseccion_cardumen is None or \
+           info["intensidad_factor"] > info_interseccion_cardumen["intensidad_factor"]:
+            info_interseccion_cardumen = info
     
     # --- Update Echosounder System ---
     if modo_presentac in ['COMBI-1', 'COMBI-2']:
         if sounder_rect and (sounder_rect.width != echosounder_sim.width or sounder_rect.height != echosounder_sim.height):
              echosounder_sim.resize(sounder_rect.width, sounder_rect.height, current_colors, menu.options)
+        if escenario.batimetria is not None and nmea_para_cardumen and own_ship_route is not None:
+            # Posición del barco en el plano local del escenario (origen = posición inicial del barco)
+            echosounder_sim.posicion_barco_m = geo_to_local_xy(current_ship_lat_deg, current_ship_lon_deg,
+                                                               own_ship_route.lat0, own_ship_route.lon0)
         echosounder_sim.update(delta_tiempo_s, menu.options, current_colors, pos_rel_cardumen)
     # --- Fin Actualización y Lógica del Cardumen ---
 
@@ -5255,24 +7778,50 @@ while not hecho:
     if menu.options.get("transmision") == "ON":
         echo_simulator.update_background_noise() # 1. Reset/Update Noise Buffer
         
-        # 2. Inject Echo if available
-        if 'info_interseccion_cardumen' in locals() and info_interseccion_cardumen and \
-           info_interseccion_cardumen.get("intensidad_factor", 0) > 0.05:
-            
-            dist_px = (info_interseccion_cardumen["dist_slant_m"] / max_rango_actual_metros) * display_radius_pixels if max_rango_actual_metros > 0 else 0
+        # 2. Inject Echo of every school in range
+        for cardumen, pos_rel, info in ecos_cardumenes:
+            if info.get("intensidad_factor", 0) <= 0.05:
+                continue
+            if cardumen.peces is not None:
+                # Modelo de partículas: el haz se pondera pez a pez, así que se descuenta
+                # el solapamiento vertical ya incluido en intensidad_factor.
+                rumbos, dists, amplitudes = cardumen.peces.geometria_eco(
+                    pos_rel, current_tilt_angle, apertura_haz_vertical_deg)
+                echo_simulator.inject_scatterers(
+                    rumbos, dists, amplitudes, max_rango_actual_metros,
+                    intensity_factor=min(1.0, info["intensidad_eco"] / max(info["factor_solapamiento"], 0.05)),
+                    longitud_impulso_m=(menu.options.get('long_impulso', 8) / 10.0) * 40.0)
+                continue
+            dist_px = (info["dist_slant_m"] / max_rango_actual_metros) * display_radius_pixels if max_rango_actual_metros > 0 else 0
             grosor_sim = 80 # Meters
             ancho_sim = 180 # Meters
             
             echo_simulator.inject_echo(
                 dist_px,
-                info_interseccion_cardumen["rumbo_relativo_deg"],
+                info["rumbo_relativo_deg"],
                 grosor_sim,
                 ancho_sim,
                 max_rango_actual_metros,
-                intensity_factor=info_interseccion_cardumen["intensidad_factor"]
+                intensity_factor=info["intensidad_eco"],
+                seed=cardumen.semilla_eco
             )
             
-        # 3. Render Sweep to Surface
+        if cli_args.sim_interference: # Demo only: interference from other sonars, to try the rejection filter
+            echo_simulator.inyectar_interferencia()
+
+        # 3. Receiver gain stage (TX power, TVG, AGC, color response) on the whole ping
+        echo_simulator.aplicar_ganancia(menu.options, max_rango_actual_metros)
+
+        # 4. Interference Rejection (ping-to-ping filter)
+        echo_simulator.aplicar_rechazo_interferencia(menu.options.get('rechazo_interf', 1),
+                                                     rango_actual_m=max_rango_actual_metros)
+
+        # 5. Echo Average / Echo Trail between pings
+        echo_simulator.aplicar_promedio(menu.options.get('promedio_eco', 1),
+                                        estela=menu.options.get('estela_eco', 'OFF') == 'ON',
+                                        rango_actual_m=max_rango_actual_metros)
+
+        # 6. Render Sweep to Surface
         limitar_ruido_val = menu.options.get('limitar_ruido', 3)
         anular_color_val = menu.options.get('anular_color', 0)
         echo_simulator.render_sweep(int(current_sweep_radius_pixels), int(sweep_increment_ppf) + 1, 
@@ -5282,7 +7831,7 @@ while not hecho:
 
     # --- Lógica de Programación y Reproducción del Sonido del Eco con Retardo ---
     if menu.options.get("transmision") == "ON" and sonar_ping_sound and \
-       'info_interseccion_cardumen' in locals() and info_interseccion_cardumen and \
+       info_interseccion_cardumen and \
        info_interseccion_cardumen.get("intensidad_factor", 0) > 0.1: # Solo si hay un eco significativo
 
         dist_eco_m = info_interseccion_cardumen["dist_slant_m"]
@@ -5349,7 +7898,7 @@ while not hecho:
     nivel_alarma = menu.options.get('nivel_alarma', 9) # 1-10
     alarm_threshold = nivel_alarma / 10.0
     
-    if 'info_interseccion_cardumen' in locals() and info_interseccion_cardumen:
+    if info_interseccion_cardumen:
         if info_interseccion_cardumen.get("intensidad_factor", 0) >= alarm_threshold and alarm_threshold > 0:
             # Dibujar indicador de alarma visual
             alarm_text = font_very_large.render(menu.tr('LBL_ALARM'), True, current_colors["TARGET_HOVER"]) # Rojo
@@ -5365,6 +7914,8 @@ while not hecho:
         
         action = menu.handle_event(evento)
         if action == 'clear_markers':
+            if nav_history is not None:
+                nav_history.delete_marks(target_markers.store_ids())
             target_markers.clear()
             print("INFO: Todas las marcas de derrota han sido borradas.")
 
@@ -5387,130 +7938,125 @@ while not hecho:
                 pass
 
 
-    # Read from serial port if available
-    if serial_port_available and ser: # Check ser object directly
-        try:
-            if ser.in_waiting > 0:
-                line = ser.readline().decode('ascii', errors='replace').strip()
-                
-                # Process only if a line was actually received
-                if line and is_valid_nmea_checksum(line):
-                    if line.startswith('$GPGLL') or line.startswith('$GNGLL'):
-                        parse_gll(line)
-                    elif line.startswith('$GPGGA') or line.startswith('$GNGGA'):
-                        parse_gga(line)
-                    elif line.startswith('$GPRMC') or line.startswith('$GNRMC'):
-                        parse_rmc(line)
-                    elif line.startswith('$GPVTG') or line.startswith('$GNVTG'):
-                        parse_vtg(line)
-                    elif line.startswith('$GPHDT') or line.startswith('$GNHDT'):
-                        parse_hdt(line)
-                    elif line.startswith('$GPHDG') or line.startswith('$GNHDG'):
-                        parse_hdg(line)
-                    elif line.startswith('$GPZDA') or line.startswith('$GNZDA'): # Common talkers for ZDA
-                        parse_zda(line)
-                    elif line.startswith('$PFEC,GPatt'): # Specific check for the proprietary sentence
-                        parse_fec_gpatt(line)
-                elif line:
-                    # Optional: Print discarded sentences for debugging
-                    print(f"Discarding corrupt NMEA sentence: {line}")
-        except serial.SerialException as se:
-            print(f"COM port error/disconnected: {se}")
-            if ser and ser.is_open:
-                try:
-                    ser.close()
-                except Exception as close_ex:
-                    print(f"Error closing COM port: {close_ex}")
-            ser = None
-            serial_port_available = False
-            # Optionally, could update a global status message here for UI
-            # e.g., global_ui_message = "COM Port Disconnected"
-        except Exception as e: # Catch other potential errors like parsing errors, etc.
-            print(f"Error processing serial data: {e}")
-            # For general errors, we might not want to disable the port,
-            # unless they are recurrent and indicate a fundamental issue.
-            # For now, just print and continue.
-
-    # --- Automatic COM Port Reconnection Attempt ---
-    if not serial_port_available and puerto is not None: # 'puerto' holds the last known good port
-        current_pygame_time = pygame.time.get_ticks()
-        if current_pygame_time - last_reconnect_attempt_time > RECONNECT_INTERVAL_MS:
-            last_reconnect_attempt_time = current_pygame_time
-            # print(f"DEBUG: Attempting auto-reconnect to {puerto}@{baudios}...") # Optional for debugging
-            try:
-                if ser and ser.is_open: # Try to close if it somehow still exists and is open
-                    try: ser.close()
-                    except Exception: pass 
-                ser = None # Ensure clean state
-
-                temp_ser = serial.Serial(puerto, baudios, timeout=1)
-                ser = temp_ser # Assign to global ser
-                serial_port_available = True # If successful, this gets set to True
-                print(f"INFO: Puerto COM {puerto} reconectado automáticamente.")
-            except serial.SerialException:
-                # Auto-reconnect failed, try again later. This is a silent failure.
-                pass
-            except Exception as e_reconnect:
-                # Other unexpected error during auto-reconnect attempt.
-                # print(f"DEBUG: Unexpected error during auto-reconnect: {e_reconnect}") # Optional
-                pass
-    # --- End Automatic Reconnection Attempt ---
-
-    # --- Marker 'Screen' to 'Geo' Conversion on NMEA Activation ---
-    # This logic needs to run *after* a potential auto-reconnect might make serial_port_available True
-    if serial_port_available and not prev_serial_port_available and \
-       current_ship_lat_deg is not None and current_ship_lon_deg is not None:
-        # NMEA data just became available with a valid fix (either by manual or auto-reconnect)
-        # print("DEBUG: NMEA activated, attempting to convert 'screen' markers to 'geo'.") # Debug
-        for marker in target_markers:
-            if marker['mode'] == 'screen' and marker.get('screen_bearing_rad') is not None \
-               and marker.get('initial_distance_meters') is not None: # Now using initial_distance_meters
-                
-                # print(f"DEBUG: Converting marker: {marker}") # Debug
-                screen_bearing_deg = math.degrees(marker['screen_bearing_rad'])
-                # true_marker_bearing_deg is relative to true North
-                # current_ship_heading is true heading. screen_bearing_deg is relative to ship's current screen up.
-                true_marker_bearing_deg = (current_ship_heading + screen_bearing_deg + 360) % 360
-                
-                distance_m = marker['initial_distance_meters'] # Already in meters
-                
-                # print(f"DEBUG: ship_heading={current_ship_heading}, screen_bearing_deg={screen_bearing_deg}, true_marker_bearing={true_marker_bearing_deg}, dist_m={distance_m}") # Debug
-
-                try:
-                    ship_pos_at_conversion = Point(latitude=current_ship_lat_deg, longitude=current_ship_lon_deg)
-                    destination = geodesic(meters=distance_m).destination(point=ship_pos_at_conversion, bearing=true_marker_bearing_deg)
-                    
-                    marker['geo_pos'] = {'lat': destination.latitude, 'lon': destination.longitude}
-                    marker['mode'] = 'geo'
-                    # print(f"DEBUG: Marker converted to GEO. New geo_pos: {marker['geo_pos']}") # Debug
-                    # Optionally, clear screen-specific fields if they are strictly no longer needed
-                    # marker.pop('screen_bearing_rad', None) # Keep for potential future reversion logic?
-                    # marker.pop('initial_distance_units', None) # Keep for potential future reversion logic?
-                except Exception as geo_calc_e:
-                    print(f"Error calculating geo_pos for marker conversion: {geo_calc_e}")
-
+    # Sensor priority (SISTEMA > VELOC/RUMBO and DATOS NAV)
+    nmea_state.sensors.set_scheme(menu.options.get('veloc_rumbo', 'DATO NAV'), menu.options.get('datos_nav', 'GPS'))
 
+    # Process every sentence the reader thread queued since the last frame (never blocks).
+    # Reconnection after a lost port is handled by serial_manager in the background.
+    nmea_reader = serial_manager.reader
+    serial_port_available = nmea_reader is not None
+    if nmea_reader is not None:
+        for record in nmea_reader.drain(): # Already parsed by the reader thread
+            try:
+                apply_nmea_record(record)
+            except Exception as e: # Parsing errors etc. must not stop the UI
+                print(f"Error processing serial data: {e}")
+
+    # --- Raw NMEA recording (SISTEMA > GRABAR NMEA) ---
+    if menu.options.get('grabar_nmea', 'OFF') == 'ON':
+        if nmea_recorder is None:
+            nmea_recorder = NmeaRecorder()
+    elif nmea_recorder is not None:
+        nmea_recorder.stop()
+        print(f"INFO: Grabación NMEA finalizada ({nmea_recorder.lines_written} sentencias).")
+        nmea_recorder = None
+    if nmea_reader is not None:
+        nmea_reader.recorder = nmea_recorder
+    nmea_hub.recorder = nmea_recorder
+    # ---
+
+    # --- Network NMEA (UDP / TCP) ---
+    nmea_hub.set_sources(nmea_network_sources(menu.options))
+    for record in nmea_hub.drain():
+        try:
+            apply_nmea_record(record)
+        except Exception as e:
+            print(f"Error processing network NMEA data: {e}")
+    # ---
+
+    # --- Simulated own-ship NMEA from the scenario route ---
+    if nmea_generator is not None:
+        for sentence in nmea_generator.poll(time.monotonic() - own_ship_route_start_s):
+            if nmea_generator_socket is not None: # Through the network input (NMEA UDP in SISTEMA)
+                nmea_generator_socket.sendto((sentence + "\r\n").encode('ascii'), cli_args.nmea_sim_output)
+            elif cli_args.nmea_sim_output == 'serial': # Through the open port, e.g. loop:// or a pty pair
+                if serial_manager.connection is not None:
+                    serial_manager.connection.write((sentence + "\r\n").encode('ascii'))
+            else:
+                process_nmea_sentence(sentence)
+    elif own_ship_route is not None:
+        for sentence in own_ship_route.poll(time.monotonic() - own_ship_route_start_s):
+            process_nmea_sentence(sentence)
+
+    # --- NMEA log replay (--replay) ---
+    if nmea_replay is not None:
+        replay_deadline = time.perf_counter() + NMEA_REPLAY_FRAME_BUDGET_S
+        for _, sentence in nmea_replay.due(time.monotonic()):
+            last_fix = nmea_state.fix
+            t_parse = time.perf_counter()
+            process_nmea_sentence(sentence)
+            nmea_replay.note_parse(time.perf_counter() - t_parse)
+            if nmea_state.fix is not last_fix:
+                # The track follows the log's clock, so sped-up replays build it at full density
+                current_ship_lat_deg, current_ship_lon_deg = nmea_state.lat, nmea_state.lon
+                track_clock_ms = nmea_replay.clock_s * 1000.0
+                update_ship_track()
+            if nmea_replay.speed is None and time.perf_counter() > replay_deadline:
+                break
+        nmea_replay.report(time.monotonic(), force=nmea_replay.finished)
+        if nmea_replay.finished:
+            print(f"INFO: Fin del registro NMEA ({nmea_replay.sentences} sentencias).")
+            nmea_replay = None
+            track_clock_ms = None # Back to pygame ticks
+            last_track_point_add_time = 0
+            if nav_history is not None:
+                nav_history.break_track()
+    # ---
+
+    nmea_input_available = serial_port_available or nmea_hub.active or own_ship_route is not None or nmea_replay is not None
+    if nmea_replay is None:
+        # Render with the pose extrapolated to this frame instead of the last (1-10 Hz) fix
+        frame_range_m = range_presets_map[current_unit][current_range_index] * (1.8288 if current_unit == "BRAZAS" else 1.0)
+        frame_t = time.monotonic()
+        ship_motion.observe(frame_t, nmea_state)
+        render_pose = ship_motion.render_pose(frame_t, frame_range_m / max(display_radius_pixels, 1),
+                                              display_radius_pixels)
+    else: # Replays jump in log time, so they are drawn fix by fix
+        ship_motion.reset()
+        render_pose = None if nmea_state.lat is None else (nmea_state.lat, nmea_state.lon, nmea_state.heading_deg)
+    if render_pose is not None:
+        current_ship_lat_deg, current_ship_lon_deg, current_ship_heading = render_pose
+    else:
+        current_ship_lat_deg, current_ship_lon_deg = None, None
+        current_ship_heading = nmea_state.heading_deg
+    # ---
+
+    update_nav_history(HISTORY_SPANS_H.get(menu.options.get('historial', 'OFF'), 0),
+                       current_ship_lat_deg is not None and current_ship_lon_deg is not None)
+
+    # --- Marker 'Screen' / 'Geo' Conversion on Fix Changes ---
+    # This logic needs to run *after* a potential auto-reconnect might make nmea_input_available True.
+    # All pending markers are converted at once, so a large mark set does not stall the frame.
+    if current_ship_lat_deg is not None and current_ship_lon_deg is not None:
+        if marker_fix_pose is None: # Fix just acquired (by manual or auto-reconnect)
+            lock_screen_markers(current_ship_lat_deg, current_ship_lon_deg, current_ship_heading)
+        marker_fix_pose = (current_ship_lat_deg, current_ship_lon_deg, current_ship_heading)
+    elif marker_fix_pose is not None: # Fix lost: keep the markers where they were, relative to the ship
+        range_m_for_conversion = range_presets_map[current_unit][current_range_index] * (1.8288 if current_unit == "BRAZAS" else 1.0)
+        for markers in (target_markers, triangle_markers):
+            markers.to_screen(*marker_fix_pose, circle_center_x, circle_center_y,
+                              display_radius_pixels / range_m_for_conversion)
+        marker_fix_pose = None
     # --- End Marker Conversion ---
 
     # --- Reset NMEA display data if port/NMEA fix is lost ---
-    if not serial_port_available or current_ship_lat_deg is None:
-        latitude_str = "N/A"
-        longitude_str = "N/A"
-        speed_str = "N/A"
-        # heading_str refers to the text display in the panel.
+    if not nmea_input_available or current_ship_lat_deg is None:
+        # Every display string is derived from nmea_state, so clearing it resets the panel.
         # current_ship_heading is the float value for calculations and rose display.
-        heading_str = "N/A" 
+        nmea_state.reset()
         current_ship_heading = 0.0 # Default heading for rose when NMEA is lost
-        
-        zda_time_str = "N/A"
-        zda_date_str = "N/A"
-        att_pitch_str = "N/A"
-        att_roll_str = "N/A"
     # --- End Reset NMEA display data ---
 
-    # Update previous serial port availability for the *next* frame's logic
-    prev_serial_port_available = serial_port_available
-
     # Limpia la pantalla y establece su color de fondo
     brightness_factor = menu.options.get('iluminacion', 5) / 10.0
     bg_color_base = current_colors["BACKGROUND"]
@@ -5639,12 +8185,7 @@ while not hecho:
     text_rect_longitud.top = unified_data_box_dims[1] + 5
     screen.blit(text_surface_longitud, text_rect_longitud)
 
-    if speed_str == "N/A":
-        display_speed_text = "N/A"
-    else:
-        # Assuming speed_str is like "X.X Knots" or just "X.X" if NMEA is different
-        numeric_part_speed = speed_str.replace(" Knots", "").strip()
-        display_speed_text = f"{numeric_part_speed} kn"
+    display_speed_text = nmea_state.speed_str() # Formatted only here, when the panel is drawn
 
     text_surface_speed_data = font_size_54.render(display_speed_text, True, current_colors["PRIMARY_TEXT"]) # Changed to font_size_54
     text_rect_speed_data = text_surface_speed_data.get_rect()
@@ -5661,25 +8202,7 @@ while not hecho:
     text_rect_velocidad.top = y_offset_rumbo + 5 # 5px from top of its allocated section
     screen.blit(text_surface_velocidad, text_rect_velocidad)
 
-    display_heading_text = "N/A" # Default
-    if heading_str == "N/A":
-        display_heading_text = "N/A"
-    else:
-        numeric_part_heading = ""
-        for char_h in heading_str: # Extract leading numeric part
-            if char_h.isdigit() or char_h == '.':
-                numeric_part_heading += char_h
-            else:
-                break 
-
-        if numeric_part_heading: # If we got a numeric string
-            try:
-                heading_value = int(float(numeric_part_heading))
-                display_heading_text = f"{heading_value}°"
-            except ValueError:
-                display_heading_text = heading_str # Fallback on conversion error
-        else: # If no numeric string was extracted (e.g., heading_str was non-numeric)
-            display_heading_text = heading_str # Fallback
+    display_heading_text = nmea_state.heading_str()
 
     text_surface_heading_data = font_size_54.render(display_heading_text, True, current_colors["PRIMARY_TEXT"]) # Changed to font_size_54
     text_rect_heading_data = text_surface_heading_data.get_rect()
@@ -5692,10 +8215,10 @@ while not hecho:
     text_surface_latitud = font.render(menu.tr('LBL_LAT_LON'), True, current_colors["PRIMARY_TEXT"])
     text_rect_latitud = text_surface_latitud.get_rect()
 
-    text_surface_lat_data = font_size_54.render(latitude_str, True, current_colors["PRIMARY_TEXT"]) # Changed to font_size_54
+    text_surface_lat_data = font_size_54.render(nmea_state.latitude_str(), True, current_colors["PRIMARY_TEXT"]) # Changed to font_size_54
     text_rect_lat_data = text_surface_lat_data.get_rect()
 
-    text_surface_lon_data = font_size_54.render(longitude_str, True, current_colors["PRIMARY_TEXT"]) # Changed to font_size_54
+    text_surface_lon_data = font_size_54.render(nmea_state.longitude_str(), True, current_colors["PRIMARY_TEXT"]) # Changed to font_size_54
     text_rect_lon_data = text_surface_lon_data.get_rect()
 
     # Set all horizontal positions
@@ -5832,17 +8355,18 @@ while not hecho:
             
             current_y_offset_target_data = start_y_for_target_block
     
-            # Calculate the maximum width of the rendered lines to ensure right-alignment
-            max_line_width = 0
-            rendered_lines = []
-            for label_str, value_str, is_special in target_data_lines_info:
-                font_for_label = large_symbol_font if is_special else label_font
-                label_surf = font_for_label.render(label_str, True, current_colors["PRIMARY_TEXT"])
-                value_surf = label_font.render(value_str, True, current_colors["PRIMARY_TEXT"])
-                line_width = label_surf.get_width() + symbol_value_spacing + value_surf.get_width()
-                if line_width > max_line_width:
-                    max_line_width = line_width
-                rendered_lines.append({'label_surf': label_surf, 'value_surf': value_surf, 'is_special': is_special})
+            # The text surfaces are rendered again only when a value or the colour changes
+            panel_key = (tuple(value_str for _, value_str, _ in target_data_lines_info), current_colors["PRIMARY_TEXT"])
+            if panel_key != target_panel_cache['key']:
+                rendered_lines = []
+                for label_str, value_str, is_special in target_data_lines_info:
+                    font_for_label = large_symbol_font if is_special else label_font
+                    label_surf = font_for_label.render(label_str, True, current_colors["PRIMARY_TEXT"])
+                    value_surf = label_font.render(value_str, True, current_colors["PRIMARY_TEXT"])
+                    rendered_lines.append({'label_surf': label_surf, 'value_surf': value_surf, 'is_special': is_special})
+                target_panel_cache['key'] = panel_key
+                target_panel_cache['lines'] = rendered_lines
+            rendered_lines = target_panel_cache['lines']
             
             # --- AHORA LA PARTE MODIFICADA: POSICIONAR EL BLOQUE RESPECTO AL PANEL DE DATOS ---
             margin_right_to_data_panel = 10
@@ -5866,19 +8390,12 @@ while not hecho:
         # --- End Display Calculated Target Data ---
 
     # --- Speed Warning Message ---
-    if menu.options.get('mensaje_veloc') == 'ON' and speed_str != "N/A":
-        try:
-            # Extraer la parte numérica de la cadena de velocidad
-            speed_value_str = speed_str.replace(" Knots", "").strip()
-            speed_value = float(speed_value_str)
-            if speed_value > 16:
-                warning_text = menu.tr('MSG_SPEED_WARNING')
-                warning_surface = font_very_large.render(warning_text, True, ROJO)
-                warning_rect = warning_surface.get_rect(center=(circle_center_x, circle_center_y))
-                pantalla.blit(warning_surface, warning_rect)
-        except (ValueError, IndexError):
-            # En caso de que speed_str no sea un número válido, ignorar silenciosamente
-            pass
+    speed_value = nmea_state.speed_knots
+    if menu.options.get('mensaje_veloc') == 'ON' and speed_value is not None and speed_value > 16:
+        warning_text = menu.tr('MSG_SPEED_WARNING')
+        warning_surface = font_very_large.render(warning_text, True, ROJO)
+        warning_rect = warning_surface.get_rect(center=(circle_center_x, circle_center_y))
+        pantalla.blit(warning_surface, warning_rect)
     # --- End Speed Warning Message ---
 
     # --- Draw Custom "+" Cursor ---
@@ -5894,168 +8411,14 @@ while not hecho:
     # --- End Draw Custom "+" Cursor ---
 
     # --- Draw Target Markers & Lines Between Them ---
-    # The size of the rhombus and X mark should match the '+' cursor size.
-    # The '+' cursor has arms of length `cursor_arm_length`, so total span is `cursor_arm_length * 2`.
-    # However, `cursor_arm_length` is defined inside the `while not hecho` loop, 
-    # so we need to ensure it's accessible or use its value (18*2 = 36 for size).
-    # For simplicity here, we'll use the value directly, but ideally, it should be passed or stored globally.
-    marker_icon_size = 18 # Reduced from 36
-
-    for marker in target_markers:
-        draw_pos = None
-        if marker['mode'] == 'geo':
-            if marker['current_screen_pos']: # Geo markers use dynamically updated screen_pos
-                # Check if the geo marker is within the sonar circle for drawing
-                mx_geo, my_geo = marker['current_screen_pos']
-                dist_sq_to_center = (mx_geo - circle_center_x)**2 + (my_geo - circle_center_y)**2
-                if dist_sq_to_center <= (display_radius_pixels + marker_icon_size/2)**2:
-                    draw_pos = marker['current_screen_pos']
-        
-        elif marker['mode'] == 'screen':
-            # For 'screen' mode markers, their position is determined by 'current_screen_pos',
-            # which should have been updated by update_marker_screen_positions()
-            # to reflect scaling if NMEA is off, or remain fixed if NMEA is on.
-            draw_pos = marker['current_screen_pos']
-
-        if draw_pos:
-            mx, my = draw_pos
-            current_marker_color = current_colors["TARGET_HOVER"] if marker.get('is_hovered', False) else current_colors["TARGET_BASE"]
-            if marker['type'] == TARGET_TYPE_RHOMBUS:
-                draw_rhombus(pantalla, current_marker_color, mx, my, marker_icon_size)
-            elif marker['type'] == TARGET_TYPE_X:
-                draw_x_mark(pantalla, current_marker_color, mx, my, marker_icon_size)
-
-    # Draw triangle markers separately
-    for marker in triangle_markers:
-        draw_pos = None
-        if marker['mode'] == 'geo':
-            if marker['current_screen_pos']:
-                mx_geo, my_geo = marker['current_screen_pos']
-                dist_sq_to_center = (mx_geo - circle_center_x)**2 + (my_geo - circle_center_y)**2
-                if dist_sq_to_center <= (display_radius_pixels + marker_icon_size/2)**2:
-                    draw_pos = marker['current_screen_pos']
-        elif marker['mode'] == 'screen':
-            draw_pos = marker['current_screen_pos']
-
-        if draw_pos:
-            mx, my = draw_pos
-            current_marker_color = current_colors["TARGET_HOVER"] if marker.get('is_hovered', False) else current_colors["TARGET_BASE"]
-            draw_triangle(pantalla, current_marker_color, mx, my, marker_icon_size)
-
-    # Draw lines between consecutive target markers (Rhombus/X only)
-    for i in range(len(target_markers) - 1):
-        marker1 = target_markers[i]
-        marker2 = target_markers[i+1]
-
-        pos1 = marker1['current_screen_pos']
-        pos2 = marker2['current_screen_pos'] # This will be None if marker is off-screen due to range
-
-        # s_max_disp_range is needed for 'screen' mode hypothetical point calculation.
-        # Ensure current_range_index is valid.
-        current_s_max_range_units = 0
-        if 0 <= current_range_index < len(range_presets_map[current_unit]):
-            current_s_max_range_units = range_presets_map[current_unit][current_range_index]
-        else: # Should not happen if current_range_index is always maintained correctly
-            current_s_max_range_units = range_presets_map[current_unit][0]
-
-
-        if pos1 and pos2:
-            # Both markers are on screen, draw a direct line.
-            pygame.draw.line(pantalla, current_colors["PRIMARY_TEXT"], pos1, pos2, 1)
-        
-        elif pos1 and not pos2: # Marker1 is on screen, Marker2 is off screen (pos2 is None)
-            hypothetical_pos2_far = None
-            if marker2['mode'] == 'screen' and marker2.get('original_angle_rad') is not None:
-                # SCREEN mode off-screen marker
-                far_radius = display_radius_pixels * 10 
-                # original_angle_rad for 'screen' markers is math.atan2(dy, dx) from center.
-                # x = center + R * cos(angle), y = center + R * sin(angle)
-                hypothetical_m2_x = circle_center_x + far_radius * math.cos(marker2['original_angle_rad'])
-                hypothetical_m2_y = circle_center_y + far_radius * math.sin(marker2['original_angle_rad'])
-                hypothetical_pos2_far = (hypothetical_m2_x, hypothetical_m2_y)
-            
-            elif marker2['mode'] == 'geo' and marker2.get('geo_pos') and \
-                 current_ship_lat_deg is not None and current_ship_lon_deg is not None:
-                # GEO mode off-screen marker
-                ship_point = Point(latitude=current_ship_lat_deg, longitude=current_ship_lon_deg)
-                target_point = Point(latitude=marker2['geo_pos']['lat'], longitude=marker2['geo_pos']['lon'])
-
-                # Calculate true bearing from ship to target (consistent with update_marker_screen_positions)
-                delta_lon_rad = math.radians(target_point.longitude - ship_point.longitude)
-                lat1_rad = math.radians(ship_point.latitude)
-                lat2_rad = math.radians(target_point.latitude)
-                y_brg = math.sin(delta_lon_rad) * math.cos(lat2_rad)
-                x_brg = math.cos(lat1_rad) * math.sin(lat2_rad) - \
-                        math.sin(lat1_rad) * math.cos(lat2_rad) * math.cos(delta_lon_rad)
-                true_bearing_to_target_rad = math.atan2(y_brg, x_brg)
-                true_bearing_to_target_deg = (math.degrees(true_bearing_to_target_rad) + 360) % 360
-                
-                relative_bearing_deg = (true_bearing_to_target_deg - current_ship_heading + 360) % 360
-                # angle_rad_for_draw: 0 is East, positive CCW. For screen: North is -PI/2.
-                angle_rad_for_draw = math.radians(relative_bearing_deg - 90) 
-
-                far_radius = display_radius_pixels * 10
-                # Use cos for X, sin for Y because angle_rad_for_draw is adjusted for screen (-90 deg)
-                # where 0 rad = East, PI/2 rad = South (if Y points down), -PI/2 rad = North (if Y points up)
-                hypothetical_m2_x = circle_center_x + far_radius * math.cos(angle_rad_for_draw)
-                hypothetical_m2_y = circle_center_y + far_radius * math.sin(angle_rad_for_draw)
-                hypothetical_pos2_far = (hypothetical_m2_x, hypothetical_m2_y)
-
-            if hypothetical_pos2_far:
-                dist_sq_pos1_from_center = (pos1[0] - circle_center_x)**2 + (pos1[1] - circle_center_y)**2
-                if dist_sq_pos1_from_center <= (display_radius_pixels + 1)**2: # pos1 is inside or on edge
-                    intersection_point = get_screen_line_circle_intersection(
-                        pos1, hypothetical_pos2_far, 
-                        circle_center_x, circle_center_y, 
-                        display_radius_pixels - 0.5 
-                    )
-                    if intersection_point:
-                        if math.sqrt((intersection_point[0]-pos1[0])**2 + (intersection_point[1]-pos1[1])**2) > 1:
-                              pygame.draw.line(pantalla, current_colors["PRIMARY_TEXT"], pos1, intersection_point, 1)
-
-        elif not pos1 and pos2: # Marker1 is off screen (pos1 is None), Marker2 is on screen
-            hypothetical_pos1_far = None
-            if marker1['mode'] == 'screen' and marker1.get('original_angle_rad') is not None:
-                # SCREEN mode off-screen marker1
-                far_radius = display_radius_pixels * 10
-                hypothetical_m1_x = circle_center_x + far_radius * math.cos(marker1['original_angle_rad'])
-                hypothetical_m1_y = circle_center_y + far_radius * math.sin(marker1['original_angle_rad'])
-                hypothetical_pos1_far = (hypothetical_m1_x, hypothetical_m1_y)
-
-            elif marker1['mode'] == 'geo' and marker1.get('geo_pos') and \
-                 current_ship_lat_deg is not None and current_ship_lon_deg is not None:
-                # GEO mode off-screen marker1
-                ship_point = Point(latitude=current_ship_lat_deg, longitude=current_ship_lon_deg)
-                target_point = Point(latitude=marker1['geo_pos']['lat'], longitude=marker1['geo_pos']['lon'])
-
-                delta_lon_rad = math.radians(target_point.longitude - ship_point.longitude)
-                lat1_rad = math.radians(ship_point.latitude)
-                lat2_rad = math.radians(target_point.latitude)
-                y_brg = math.sin(delta_lon_rad) * math.cos(lat2_rad)
-                x_brg = math.cos(lat1_rad) * math.sin(lat2_rad) - \
-                        math.sin(lat1_rad) * math.cos(lat2_rad) * math.cos(delta_lon_rad)
-                true_bearing_to_target_rad = math.atan2(y_brg, x_brg)
-                true_bearing_to_target_deg = (math.degrees(true_bearing_to_target_rad) + 360) % 360
-                
-                relative_bearing_deg = (true_bearing_to_target_deg - current_ship_heading + 360) % 360
-                angle_rad_for_draw = math.radians(relative_bearing_deg - 90)
-
-                far_radius = display_radius_pixels * 10
-                hypothetical_m1_x = circle_center_x + far_radius * math.cos(angle_rad_for_draw)
-                hypothetical_m1_y = circle_center_y + far_radius * math.sin(angle_rad_for_draw)
-                hypothetical_pos1_far = (hypothetical_m1_x, hypothetical_m1_y)
-
-            if hypothetical_pos1_far:
-                dist_sq_pos2_from_center = (pos2[0] - circle_center_x)**2 + (pos2[1] - circle_center_y)**2
-                if dist_sq_pos2_from_center <= (display_radius_pixels + 1)**2: # pos2 is inside or on edge
-                    intersection_point = get_screen_line_circle_intersection(
-                        pos2, hypothetical_pos1_far, 
-                        circle_center_x, circle_center_y,
-                        display_radius_pixels - 0.5
-                    )
-                    if intersection_point:
-                        if math.sqrt((intersection_point[0]-pos2[0])**2 + (intersection_point[1]-pos2[1])**2) > 1:
-                            pygame.draw.line(pantalla, current_colors["PRIMARY_TEXT"], pos2, intersection_point, 1)
+    draw_markers(pantalla, target_markers, circle_center_x, circle_center_y, display_radius_pixels,
+                 current_colors["TARGET_BASE"], current_colors["TARGET_HOVER"])
+    draw_markers(pantalla, triangle_markers, circle_center_x, circle_center_y, display_radius_pixels,
+                 current_colors["TARGET_BASE"], current_colors["TARGET_HOVER"])
+
+    # Lines between consecutive target markers (Rhombus/X only), including towards markers out of range
+    for run in target_line_runs:
+        pygame.draw.lines(pantalla, current_colors["PRIMARY_TEXT"], False, run, 1)
 
     # --- End Draw Target Markers & Lines ---
 
@@ -6065,12 +8428,33 @@ while not hecho:
         current_range_index = len(range_presets_map[current_unit]) - 1
     s_max_for_track_draw = range_presets_map[current_unit][current_range_index]
     
-    draw_ship_track(pantalla, ship_track_points, 
+    draw_history_track(pantalla, nav_history, HISTORY_SPANS_H.get(menu.options.get('historial', 'OFF'), 0),
+                       current_ship_lat_deg, current_ship_lon_deg, current_ship_heading,
+                       circle_center_x, circle_center_y, display_radius_pixels,
+                       s_max_for_track_draw, current_unit, current_colors["HISTORY_TRACK"])
+    draw_ship_track(pantalla, ship_track, 
                     current_ship_lat_deg, current_ship_lon_deg, current_ship_heading,
                     circle_center_x, circle_center_y, display_radius_pixels,
                     s_max_for_track_draw, current_unit, current_colors["SHIP_TRACK"])
     # --- End Draw Ship Track ---
 
+    # --- Draw AIS Targets ---
+    ais_vessels.expire(time.monotonic())
+    if menu.options.get('ais', 'ON') == 'ON' and ais_vessels.count:
+        # Vectorized projection of the whole table, redone only when the render pose, the view
+        # or a vessel position changed
+        ais_view_key = (current_ship_lat_deg, current_ship_lon_deg, current_ship_heading,
+                        circle_center_x, circle_center_y, display_radius_pixels,
+                        s_max_for_track_draw, current_unit, ais_vessels.version)
+        if ais_view_key != last_ais_view_key:
+            ais_projection = ais_vessels.project(
+                current_ship_lat_deg, current_ship_lon_deg, current_ship_heading,
+                circle_center_x, circle_center_y, display_radius_pixels,
+                s_max_for_track_draw * (1.8288 if current_unit == "BRAZAS" else 1.0))
+            last_ais_view_key = ais_view_key
+        draw_ais_targets(pantalla, *ais_projection[1:], current_colors["TARGET_BASE"])
+    # --- End Draw AIS Targets ---
+
     # --- Temporary Tilt Display on Sonar Circle (Proa) ---
     if show_tilt_temporarily:
         temp_tilt_text_str = f"T {current_tilt_angle}°" 
@@ -6139,24 +8523,12 @@ while not hecho:
     # --- OLD POPUP DRAWING LOGIC REMOVED ---
 
     # --- Display Coords for last Triangle Marker ---
-    if triangle_markers:
-        last_marker = triangle_markers[-1]
+    if len(triangle_markers):
+        last_marker_geo = triangle_markers.geo_pos(len(triangle_markers) - 1)
         lat_str = "N/A"
         lon_str = "N/A"
-        if last_marker.get('geo_pos'):
-            lat = last_marker['geo_pos']['lat']
-            lon = last_marker['geo_pos']['lon']
-            # Reusing the formatting logic from the cursor display
-            lat_hem = 'N' if lat >= 0 else 'S'
-            lon_hem = 'E' if lon >= 0 else 'W'
-            lat_deg_abs = abs(lat)
-            lat_d = int(lat_deg_abs)
-            lat_m = (lat_deg_abs - lat_d) * 60
-            lon_deg_abs = abs(lon)
-            lon_d = int(lon_deg_abs)
-            lon_m = (lon_deg_abs - lon_d) * 60
-            lat_str = f"{lat_d:02d}° {lat_m:06.3f}'{lat_hem}"
-            lon_str = f"{lon_d:03d}° {lon_m:06.3f}'{lon_hem}"
+        if last_marker_geo:
+            lat_str, lon_str = format_lat_lon_dm(*last_marker_geo)
         
         lat_surf = font.render(lat_str, True, current_colors["PRIMARY_TEXT"])
         lon_surf = font.render(lon_str, True, current_colors["PRIMARY_TEXT"])
@@ -6175,8 +8547,12 @@ while not hecho:
     # Limitamos a 60 fotogramas por segundo
     reloj.tick(60)
 
-if serial_port_available and ser is not None:
-    ser.close()
+serial_manager.stop()
+nmea_hub.stop()
+if nmea_recorder is not None:
+    nmea_recorder.stop()
+if nav_history is not None:
+    nav_history.close()
 
 # --- Save Settings on Exit ---
 save_settings()
@@ -0,0 +1,679 @@
+"""
+Checks for the pure parts of Sonar.py. The program opens its window and runs the main loop at
+import time, so each test module namespace is built by running only the imports and the
+sections the test needs (the '# --- Name ---' ... '# --- End Name ---' blocks).
+"""
+import socket
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+SONAR_PATH = Path(__file__).resolve().parent.parent / "Sonar.py"
+SONAR_SOURCE = SONAR_PATH.read_text(encoding="utf-8")
+IMPORTS_END = "# --- Command-line Arguments ---"
+
+
+def load_sonar(*spans):
+    """
+    Namespace with the imports of Sonar.py plus the given spans of its source, run in order.
+    A span is a section name (or the start of one) or a (start, end) pair of marker strings; line numbers are kept
+    so tracebacks point into Sonar.py.
+    """
+    namespace = {"__name__": "sonar_sections"}
+    exec(compile(SONAR_SOURCE[:SONAR_SOURCE.index(IMPORTS_END)], str(SONAR_PATH), "exec"), namespace)
+    for span in spans:
+        start, end = (f"# --- {span}", f"# --- End {span}") if isinstance(span, str) else span
+        i = SONAR_SOURCE.index(start)
+        j = SONAR_SOURCE.index(end, i + len(start))
+        code = "\n" * SONAR_SOURCE.count("\n", 0, i) + SONAR_SOURCE[i:j]
+        exec(compile(code, str(SONAR_PATH), "exec"), namespace)
+    return namespace
+
+
+# --- Receiver gain stage ---
+@pytest.fixture(scope="module")
+def echo_gain():
+    return load_sonar(("# --- NEW ECHO GENERATION CONSTANTS AND FUNCTIONS ---", "# --- PALETA FURUNO"))
+
+
+@pytest.mark.parametrize("nivel", range(0, 11))
+def test_agc_output_never_decreases_as_input_rises(echo_gain, nivel):
+    entrada = np.linspace(0.0, 500.0, 50001)
+    salida = echo_gain["comprimir_cag"](entrada.copy(), nivel)
+    assert np.all(np.diff(salida) >= 0)
+
+
+def test_agc_chain_keeps_strong_far_echoes(echo_gain):
+    # Max TVG and both AGC stages: a stronger echo at any range must not come out weaker
+    opciones = {'potencia_tx': 10, 'tvg_proximo': 10, 'tvg_lejano': 10}
+    curva = echo_gain["ganancia_tx_tvg"](opciones, (np.arange(500) + 0.5) / 500)
+    buf = np.linspace(0.0, 15.0, 301)[:, None] * curva[None, :]
+    for nivel in (10, 10):
+        echo_gain["comprimir_cag"](buf, nivel, np.empty_like(buf))
+    assert np.all(np.diff(buf, axis=0) >= 0)
+    assert buf[-1, -1] > buf[-1, 0] # The TVG boost still shows at the far end
+
+
+def test_agc_matches_quadratic_law_for_weak_echoes(echo_gain):
+    buf = np.linspace(0.0, 0.5, 51)
+    esperado = buf - (5 / 10.0 / 15.0) * buf * buf
+    np.testing.assert_allclose(echo_gain["comprimir_cag"](buf.copy(), 5), esperado, atol=1e-3)
+
+
+def school_echo(ns, dist_h_m, options, range_m=600.0):
+    pos_rel = {"dist_horizontal_m": dist_h_m, "profundidad_superior_m": 10.0, "profundidad_inferior_m": 30.0,
+               "radio_horizontal_m": 50.0, "rumbo_relativo_deg": 0.0}
+    return ns["calcular_interseccion_sonar_cardumen"](pos_rel, 2.0, 15.0, range_m, options)
+
+
+def test_scalar_agc_keeps_strong_far_schools():
+    ns = load_sonar(("# --- NEW ECHO GENERATION CONSTANTS AND FUNCTIONS ---", "# --- PALETA FURUNO"),
+                    ("# --- Lógica de Intersección Sonar-Cardumen ---", "# --- Fin Lógica de Intersección ---"))
+    opciones = {'potencia_tx': 10, 'tvg_proximo': 10, 'tvg_lejano': 10, 'cag': 10, 'cag_2': 10}
+    for dist_h in np.linspace(100.0, 590.0, 50): # Up to the range edge, where the TVG boost is largest
+        assert school_echo(ns, dist_h, opciones)["intensidad_factor"] > 0.05 # Drawn, heard and alarmed
+    # A stronger transmission never gives a weaker echo, whatever the AGC level
+    for cag in range(0, 11):
+        factores = [school_echo(ns, 590.0, dict(opciones, potencia_tx=tx, cag=cag))["intensidad_factor"]
+                    for tx in range(1, 11)]
+        assert all(b >= a for a, b in zip(factores, factores[1:])), cag
+
+
+def ping(sim, celdas):
+    sim.buffer_polar[...] = 0.0
+    for (fila, columna), valor in celdas.items():
+        sim.buffer_polar[fila, columna] = valor
+
+
+@pytest.mark.parametrize("nivel", [1, 2, 3])
+def test_interference_rejection_drops_one_ping_spikes_only(echo_ns, nivel):
+    sim = echo_ns["SonarEchoSimulator"](10)
+    eco, raya = (100, 250), (700, 120)
+    pings_necesarios = 2 if nivel == 2 else 3
+    for n in range(8):
+        ping(sim, {eco: 10.0, raya: 12.0} if n == 5 else {eco: 10.0})
+        sim.aplicar_rechazo_interferencia(nivel, 600.0)
+        if n >= pings_necesarios - 1:
+            assert sim.buffer_polar[eco] == pytest.approx(10.0) # Repeats on every ping: kept
+            assert sim.buffer_polar[raya] == 0.0 # Only on ping 5: dropped
+            assert np.count_nonzero(sim.buffer_polar) == 1
+    # After a range change the old pings do not count: the spike passes until the ring refills
+    ping(sim, {raya: 12.0})
+    sim.aplicar_rechazo_interferencia(nivel, 1200.0)
+    assert sim.buffer_polar[raya] == pytest.approx(12.0)
+
+
+def test_interference_rejection_off_leaves_the_ping_alone(echo_ns):
+    sim = echo_ns["SonarEchoSimulator"](10)
+    for _ in range(3):
+        ping(sim, {(700, 120): 12.0})
+        sim.aplicar_rechazo_interferencia(0, 600.0)
+        assert sim.buffer_polar[700, 120] == 12.0
+
+
+@pytest.mark.parametrize("nivel", [0, 1, 2, 3])
+def test_echo_averaging_converges_and_restarts_on_range_change(echo_ns, nivel):
+    alpha = echo_ns["ALFA_PROMEDIO_ECO"][nivel]
+    sim = echo_ns["SonarEchoSimulator"](10)
+    ping(sim, {})
+    sim.aplicar_promedio(nivel, rango_actual_m=600.0) # First ping: history = ping
+    for k in range(1, 40):
+        ping(sim, {(100, 250): 8.0})
+        sim.aplicar_promedio(nivel, rango_actual_m=600.0)
+        assert sim.buffer_polar[100, 250] == pytest.approx(8.0 * (1.0 - (1.0 - alpha) ** k))
+    assert sim.buffer_polar[100, 250] == pytest.approx(8.0, abs=0.05)
+    assert sim.historial_valido and sim.rango_historial_m == 600.0
+    # New range: the old history is for other distances, so the new ping shows as is
+    ping(sim, {(300, 40): 5.0})
+    sim.aplicar_promedio(nivel, rango_actual_m=1200.0)
+    assert sim.rango_historial_m == 1200.0
+    assert sim.buffer_polar[300, 40] == 5.0 and sim.buffer_polar[100, 250] == 0.0
+
+
+# --- Scenarios ---
+def test_scenario_opens_heavy_parts_only_when_needed(tmp_path):
+    ns = load_sonar(NMEA_PARSING_SPAN, "Local Projection Helpers",
+                    ("# --- Clase Cardumen ---", "# --- Fin Clase Cardumen ---"),
+                    ("PECES_SATURACION = ", "# Objetivo del modelo"), ("# --- Escenarios ---", "# Objetivo de arranque"))
+    np.save(tmp_path / "fondo.npy", np.full((10, 10), 55.0, dtype=np.float32))
+    escenario = ns["Escenario"]({
+        "schools": [{"x_m": 0, "y_m": 500, "model": "particles", "fish": 100},
+                    {"x_m": 0, "y_m": 9000, "model": "particles", "fish": 100},
+                    {"x_m": 0, "y_m": 400}],
+        "seabed": {"file": "fondo.npy", "cell_size_m": 10},
+    }, str(tmp_path))
+    cardumenes = escenario.crear_cardumenes()
+    assert all(c.peces is None for c in cardumenes) and escenario.batimetria._rejilla is None
+    activos = ns["refrescar_cardumenes_activos"](cardumenes, 0.0, False, None, None, 1500.0)
+    assert activos == [cardumenes[0], cardumenes[2]]
+    assert cardumenes[0].peces.num_peces == 100 # In range: fish created
+    assert cardumenes[1].peces is None and cardumenes[2].peces is None # Far away / blob model
+    assert escenario.batimetria.profundidad_en(15.0, 25.0) == 55.0
+
+
+# --- Fish particle model ---
+@pytest.fixture(scope="module")
+def echo_ns():
+    return load_sonar(("# --- NEW ECHO GENERATION CONSTANTS AND FUNCTIONS ---", "RANGE_PRESETS_METERS = "),
+                      ("PECES_SATURACION = ", "# Objetivo del modelo"))
+
+
+def test_school_across_north_is_injected_as_two_blocks(echo_ns):
+    rumbos = np.array([358.6, 359.9, 0.1, 1.2, 359.3], dtype=np.float32)
+    dists = np.array([300.0, 310.0, 305.0, 320.0, 300.0], dtype=np.float32)
+    amplitudes = np.array([1.0, 0.8, 0.9, 0.7, 0.6], dtype=np.float32)
+    juntos = echo_ns["SonarEchoSimulator"](10)
+    juntos.inject_scatterers(rumbos, dists, amplitudes, 600.0, longitud_impulso_m=32.0)
+    por_lados = echo_ns["SonarEchoSimulator"](10)
+    for lado in (rumbos > 180, rumbos < 180): # Each side alone does not wrap
+        por_lados.inject_scatterers(rumbos[lado], dists[lado], amplitudes[lado], 600.0, longitud_impulso_m=32.0)
+    np.testing.assert_allclose(juntos.buffer_polar, por_lados.buffer_polar)
+    filas = np.flatnonzero(juntos.buffer_polar.any(axis=1))
+    assert set(filas) == {0, 4, 1434, 1437, 1439}
+
+
+# --- NMEA input ---
+# Checksums, records, sentence parsers and AIS, up to parse_nmea_sentence()
+NMEA_PARSING_SPAN = ("# Initialize NMEA data variables", "# --- Sensor Selection ---")
+NMEA_INPUT_SPANS = (NMEA_PARSING_SPAN, "NMEA Serial Reader Thread", "NMEA Network Input")
+
+
+@pytest.fixture(scope="module")
+def nmea_ns():
+    return load_sonar(NMEA_PARSING_SPAN)
+
+
+@pytest.mark.parametrize("body, record_type, expected", [
+    ("GPGGA,120000.00,4321.6000,N,00824.0000,W,2,08,0.9,10.0,M,50.0,M,,", "Fix",
+     {"lat": 43.36, "lon": -8.4, "quality": 3}),
+    ("GNRMC,120000.00,A,4321.6000,N,00824.0000,W,8.5,045.0,191026,,,A", "Fix",
+     {"lat": 43.36, "quality": 2, "sog_knots": 8.5, "cog_deg": 45.0}),
+    ("GPRMC,120000.00,V,4321.6000,N,00824.0000,W,,,191026,,,N", "Fix", {"quality": 0, "cog_deg": None}),
+    ("GLGLL,4321.6000,S,00824.0000,E,120000.00,A,D", "Fix", {"lat": -43.36, "lon": 8.4, "quality": 3}),
+    ("GPVTG,045.0,T,,M,8.5,N,15.7,K,A", "Speed", {"knots": 8.5, "course": 45.0}),
+    ("VWVHW,,T,,M,6.2,N,11.5,K", "Speed", {"knots": 6.2, "course": None}),
+    ("HEHDT,045.0,T", "Heading", {"degrees": 45.0, "reference": "T"}),
+    ("HCHDG,044.0,,,1.0,W", "Heading", {"degrees": 44.0, "reference": "M"}),
+    ("GPZDA,120000.00,19,10,2026,00,00", "Time", {"hhmmss": "120000", "day": "19", "year": "2026"}),
+    ("PFEC,GPatt,045.0,+1.5,-2.0", "Attitude", {"pitch": 1.5, "roll": -2.0}),
+])
+def test_nmea_parsers_return_typed_records(nmea_ns, body, record_type, expected):
+    record = nmea_ns["parse_nmea_sentence"](nmea_ns["build_nmea_sentence"](body))
+    assert type(record) is nmea_ns[record_type]
+    assert record.source == body.split(',')[0]
+    for name, value in expected.items():
+        assert getattr(record, name) == (pytest.approx(value) if isinstance(value, float) else value), name
+
+
+@pytest.mark.parametrize("body", ["GPXXX,1,2,3", "PGRMZ,100,f", "HEHDT,,T", "GPVTG,045.0,T,,M,,N,,K"])
+def test_nmea_parsers_ignore_unhandled_or_empty_sentences(nmea_ns, body):
+    assert nmea_ns["parse_nmea_sentence"](nmea_ns["build_nmea_sentence"](body)) is None
+
+
+@pytest.mark.parametrize("lat, lon, fields", [
+    (43.36, -8.4, ("4321.6000", "N", "00824.0000", "W")),
+    (43.99999999, -8.999999999, ("4400.0000", "N", "00900.0000", "W")), # Minutes round up to 60
+    (-0.000000001, 179.999999999, ("0000.0000", "S", "18000.0000", "E")),
+])
+def test_nmea_coordinates_never_show_sixty_minutes(nmea_ns, lat, lon, fields):
+    lat_f, lat_h = nmea_ns["format_nmea_lat"](lat)
+    lon_f, lon_h = nmea_ns["format_nmea_lon"](lon)
+    assert (lat_f, lat_h, lon_f, lon_h) == fields
+    assert nmea_ns["nmea_to_decimal_degrees"](lat_f, lat_h) == pytest.approx(lat, abs=1e-6)
+    assert nmea_ns["nmea_to_decimal_degrees"](lon_f, lon_h) == pytest.approx(lon, abs=1e-6)
+
+
+def test_screen_coordinates_never_show_sixty_minutes(nmea_ns):
+    assert nmea_ns["format_lat_lon_dm"](43.9999999, -8.9999999) == ("44° 00.000'N", "009° 00.000'W")
+    assert nmea_ns["format_lat_lon_dm"](43.36, -8.4) == ("43° 21.600'N", "008° 24.000'W")
+
+
+def test_nmea_checksum_is_checked(nmea_ns):
+    sentence = nmea_ns["build_nmea_sentence"]("HEHDT,045.0,T")
+    assert nmea_ns["is_valid_nmea_checksum"](sentence)
+    assert not nmea_ns["is_valid_nmea_checksum"](sentence.replace("045", "046"))
+    assert not nmea_ns["is_valid_nmea_checksum"](sentence[:-2] + "ZZ")
+
+
+# Reference messages with their published decodings
+@pytest.mark.parametrize("sentence, mmsi, expected", [
+    ("!AIVDM,1,1,,B,177KQJ5000G?tO`K>RA1wUbN0TKH,0*5C", 477553000,
+     {"status": 5, "sog": 0.0, "lon": -122.345833, "lat": 47.582833, "cog": 51.0, "heading": 181}),
+    ("!AIVDM,1,1,,A,B52K>;h00Fc>jpUlNV@ikwpUoP06,0*4C", 338087471, # Class B, heading not available
+     {"sog": 0.1, "lon": -74.072132, "lat": 40.68454, "cog": 79.6}),
+])
+def test_ais_position_reports_are_decoded(nmea_ns, sentence, mmsi, expected):
+    assert nmea_ns["is_valid_nmea_checksum"](sentence)
+    report = nmea_ns["parse_nmea_sentence"](sentence)
+    assert report.mmsi == mmsi and report.source == "AIVDM" and not report.own
+    assert report.fields == pytest.approx(expected, abs=1e-6)
+
+
+def test_ais_two_part_static_report_is_joined(nmea_ns):
+    first = "!AIVDM,2,1,1,A,55?MbV02;H;s<HtKR20EHE:0@T4@Dn2222222216L961O5Gf0NSQEp6ClRp8,0*1C"
+    second = "!AIVDM,2,2,1,A,88888888880,2*25"
+    assert nmea_ns["parse_nmea_sentence"](first) is None
+    report = nmea_ns["parse_nmea_sentence"](second)
+    assert (report.mmsi, report.msg_type) == (351759000, 5)
+    assert report.fields == {"callsign": "3FOF8", "name": "EVER DIADEM", "shiptype": 70,
+                             "to_bow": 225, "to_stern": 70}
+
+
+def test_ais_fragment_without_its_first_part_is_dropped(nmea_ns):
+    assembler = nmea_ns["AisFragmentAssembler"]()
+    assert assembler.add(["AIVDM", "2", "2", "7", "A", "88888888880", "2"]) is None
+    assert assembler.add(["AIVDM", "3", "1", "7", "A", "55?Mb", "0"]) is None
+    assert assembler.add(["AIVDM", "3", "3", "7", "A", "888", "0"]) is None # Part 2 lost
+    assert assembler.pending == {}
+
+
+def test_ais_vessel_table_expires_and_compacts_rows(nmea_ns):
+    table = nmea_ns["AisVesselTable"](capacity=2)
+    for mmsi, t in ((111, 0.0), (222, 100.0), (333, 0.0)): # Grows past the initial capacity
+        table.update(nmea_ns["AisReport"](mmsi, 1, {"lat": mmsi / 10.0, "lon": 1.0}, False), t)
+    table.update(nmea_ns["AisReport"](333, 5, {"name": "SEIS"}, False), 50.0)
+    table.expire(400.0, timeout_s=360.0)
+    assert table.count == 2 and set(table.rows) == {222, 333}
+    for mmsi, row in table.rows.items():
+        assert table.mmsi[row] == mmsi and table.columns["lat"][row] == mmsi / 10.0
+    assert table.names[table.rows[333]] == "SEIS"
+
+
+def wait_until(condition, timeout_s=3.0):
+    deadline = time.monotonic() + timeout_s
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_failed_network_source_is_dropped_and_retried():
+    ns = load_sonar(*NMEA_INPUT_SPANS)
+    ns["NMEA_SOURCE_RETRY_S"] = 0.2
+    blocker = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    blocker.bind(('0.0.0.0', 0))
+    port = blocker.getsockname()[1]
+    spec = f"udp:{port}"
+    hub = ns["NmeaInputHub"]()
+    try:
+        hub.set_sources([spec]) # The port is taken: the source fails to bind
+        assert wait_until(lambda: spec not in hub._sources)
+        assert not hub.active
+        blocker.close()
+        time.sleep(0.25)
+        hub.set_sources([spec])
+        assert spec in hub._sources
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sentence = ns["build_nmea_sentence"]("HEHDT,045.0,T")
+        assert wait_until(lambda: sender.sendto(sentence.encode('ascii') + b"\r\n", ('127.0.0.1', port)) and hub.active)
+        sender.close()
+        records = hub.drain()
+        assert any(type(r).__name__ == 'Heading' and r.degrees == 45.0 and r.source == 'HEHDT' for r in records)
+    finally:
+        blocker.close()
+        hub.stop()
+
+
+def test_serial_reader_queues_parsed_records_and_drops_runaway_lines():
+    ns = load_sonar(*NMEA_INPUT_SPANS)
+    connection, reader = ns["open_nmea_serial"]("loop://", 115200)
+    try:
+        connection.write(b"\xff" * 3 * ns["NMEA_MAX_PENDING_BYTES"]) # No line break at all
+        assert wait_until(lambda: reader.corrupt >= 1)
+        connection.write(b"\r\n" + ns["build_nmea_sentence"]("HEHDT,045.0,T").encode('ascii') + b"\r\n")
+        assert wait_until(lambda: len(reader.queue) == 1)
+        record, = reader.drain()
+        assert type(record) is ns["Heading"] and record.degrees == 45.0
+    finally:
+        ns["close_nmea_serial"](connection, reader)
+
+
+def test_nmea_sim_output_is_validated_once():
+    ns = load_sonar(("def nmea_sim_output_arg", "arg_parser = "))
+    parse = ns["nmea_sim_output_arg"]
+    assert parse('inproc') == 'inproc' and parse('serial') == 'serial'
+    assert parse('udp:10110') == ('127.0.0.1', 10110)
+    assert parse('udp:192.168.1.20:2000') == ('192.168.1.20', 2000)
+    for bad in ('udp:', 'udp:abc', 'udp:70000', 'tcp:10110'):
+        with pytest.raises(ns["argparse"].ArgumentTypeError):
+            parse(bad)
+
+
+def test_recorder_index_points_at_first_line_of_each_second(tmp_path):
+    ns = load_sonar("NMEA Recorder")
+    recorder = ns["NmeaRecorder"](str(tmp_path))
+    for k, t in enumerate([100.2, 100.7, 101.1, 104.5, 104.9]): # Nothing in 102 and 103
+        recorder.record(t, f"$GPTXT,{k}")
+    recorder.stop()
+    path, = recorder.files
+    data = Path(path).read_bytes()
+
+    def line_at(t_s):
+        offset = ns["nmea_log_offset"](path, t_s)
+        return data[offset:].split(b"\n", 1)[0]
+
+    assert line_at(99.0) == line_at(100.9) == b"100.200\t$GPTXT,0"
+    assert line_at(101.0) == b"101.100\t$GPTXT,2"
+    assert line_at(102.0) == line_at(103.5) == line_at(104.0) == b"104.500\t$GPTXT,3"
+    assert line_at(105.0) == b"" # Past the end
+
+
+@pytest.mark.parametrize("with_index", [True, False])
+def test_replay_starts_at_requested_second(tmp_path, with_index):
+    ns = load_sonar("NMEA Recorder", "NMEA Replay")
+    recorder = ns["NmeaRecorder"](str(tmp_path))
+    for k in range(40):
+        recorder.record(1000.0 + k * 0.25, f"$HEHDT,{k:03d}.0,T")
+    recorder.stop()
+    path, = recorder.files
+    if not with_index: # Plain scan instead of the index jump
+        Path(path[:-4] + ".idx").unlink()
+    replay = ns["NmeaReplay"](path, speed=None, start_s=5.0)
+    items = list(replay.due(0.0))
+    assert replay.t_first == 1000.0 and replay.finished
+    assert items[0] == (1005.0, "$HEHDT,020.0,T") and len(items) == 20
+
+
+def test_plain_log_lines_before_first_time_get_that_time(tmp_path):
+    ns = load_sonar("NMEA Recorder", "NMEA Replay")
+    log = tmp_path / "plain.nmea"
+    log.write_text("$HEHDT,010.0,T\n$GPVTG,010.0,T,,M,5.0,N,9.3,K\n"
+                   "$GPGGA,120000.00,4321.6000,N,00824.0000,W,1,08,0.9,10.0,M,50.0,M,,\n"
+                   "$HEHDT,011.0,T\n$GPRMC,120001.00,A,4321.6000,N,00824.0000,W,5.0,010.0,191026,,,A\n")
+    replay = ns["NmeaReplay"](str(log), speed=None)
+    items = list(replay.due(0.0))
+    assert replay.t_first == 43200.0
+    assert [t for t, _ in items] == [43200.0] * 4 + [43201.0]
+    assert items[0][1] == "$HEHDT,010.0,T" # In log order
+
+
+# --- Markers ---
+@pytest.fixture(scope="module")
+def markers_ns():
+    return load_sonar("Local Projection Helpers", ("# --- Target Management System ---", "target_markers = "))
+
+
+@pytest.mark.parametrize("ref_lat", [0.0, 43.36, -70.0])
+def test_local_projection_matches_geodesic_at_sonar_ranges(markers_ns, ref_lat):
+    from geopy.distance import geodesic
+    ref_lon = -8.4
+    for bearing in range(0, 360, 15):
+        for dist_m in (100.0, 800.0, 2000.0): # The longest range preset is 1600 m
+            p = geodesic(meters=dist_m).destination((ref_lat, ref_lon), bearing)
+            x, y = markers_ns["geo_to_local_xy"](p.latitude, p.longitude, ref_lat, ref_lon)
+            b = np.radians(bearing)
+            assert np.hypot(x - dist_m * np.sin(b), y - dist_m * np.cos(b)) < 1.0
+            lat, lon = markers_ns["local_xy_to_geo"](x, y, ref_lat, ref_lon)
+            assert (lat, lon) == pytest.approx((p.latitude, p.longitude), abs=1e-9)
+
+
+def test_local_projection_crosses_the_antimeridian(markers_ns):
+    x, y = markers_ns["geo_to_local_xy"](np.array([10.0, 10.0]), np.array([-179.99, 179.99]), 10.0, 180.0)
+    assert x[0] == pytest.approx(-x[1]) and 1000.0 < x[0] < 1200.0 and np.allclose(y, 0.0) # East, not 40000 km west
+    lat, lon = markers_ns["local_xy_to_geo"](x, y, 10.0, 180.0)
+    np.testing.assert_allclose(lon, [-179.99, 179.99])
+
+
+def test_restored_marks_go_before_session_markers(markers_ns):
+    store = markers_ns["MarkerStore"](capacity=2)
+    store.add(markers_ns["MARKER_MODE_SCREEN"], 0, 5000.0, distance_m=100.0, angle_rad=0.0, bearing_rad=1.0)
+    store.insert_geo_first(1, np.array([1000.0, 2000.0]), np.array([7, 8]),
+                           np.array([43.0, 43.1]), np.array([-8.0, -8.1]))
+    assert len(store) == 3
+    assert store.store_ids() == [7, 8]
+    assert store.geo_pos(1) == (43.1, -8.1)
+    assert store.initial_pos(2) is None and store.distance_m[2] == 100.0 # Session marker kept, last
+    assert list(store.timestamp[:3]) == [1000.0, 2000.0, 5000.0]
+
+
+def test_marker_grid_pick_matches_brute_force(markers_ns):
+    ns = markers_ns
+    rng = np.random.default_rng(3)
+    store = ns["MarkerStore"]()
+    xs = np.concatenate((rng.integers(-20, 820, 300), rng.integers(395, 406, 60))) # Plus an overlapping cluster
+    ys = np.concatenate((rng.integers(-20, 820, 300), rng.integers(395, 406, 60)))
+    for k, (x, y) in enumerate(zip(xs, ys)):
+        store.add(ns["MARKER_MODE_SCREEN"], 0, float(k), initial_x=float(x), initial_y=float(y))
+    store.add(ns["MARKER_MODE_GEO"], 0, 999.0, lat=43.0, lon=-8.0) # No fix: not on screen
+    store.reproject(None, None, 0.0, 400, 400, 400, 0.0)
+    half, size = ns["MARKER_ICON_SIZE"] // 2, ns["MARKER_ICON_SIZE"]
+    probes = np.concatenate((rng.integers(-40, 840, (2000, 2)), rng.integers(380, 420, (500, 2))))
+    for px, py in probes.tolist():
+        inside = ((xs - half <= px) & (px < xs - half + size) & (ys - half <= py) & (py < ys - half + size))
+        expected = int(np.argmax(inside)) if inside.any() else None
+        assert store.hit(px, py) == expected, (px, py)
+
+
+# --- Ship track ---
+@pytest.fixture(scope="module")
+def track_ns():
+    return load_sonar("Local Projection Helpers", "Ship Track Variables",
+                      ("# --- Ship Track Logic ---", "ship_track = ShipTrack()"))
+
+
+def random_track(ns, n, seed=1, step_m=(0.0, 30.0)):
+    """n (lat, lon) points of a wandering track with steps of step_m metres."""
+    rng = np.random.default_rng(seed)
+    heading = np.cumsum(rng.normal(0.0, 0.3, n))
+    step = rng.uniform(*step_m, n)
+    x, y = np.cumsum(step * np.sin(heading)), np.cumsum(step * np.cos(heading))
+    return list(zip(*ns["local_xy_to_geo"](x, y, 43.36, -8.4)))
+
+
+def reference_track(ns, points, capacity, max_length_m):
+    """The points a ShipTrack should keep, worked out with plain lists."""
+    kept, dists = [], []
+    for lat, lon in points:
+        step = np.hypot(*ns["geo_to_local_xy"](lat, lon, *kept[-1])) if kept else 0.0
+        kept.append((lat, lon))
+        dists.append(dists[-1] + step if len(dists) else 0.0)
+        if len(kept) > capacity:
+            kept, dists = kept[1:], dists[1:]
+        while len(kept) > 1 and dists[-1] - dists[0] > max_length_m:
+            kept, dists = kept[1:], dists[1:]
+    return kept, (dists[-1] - dists[0] if len(dists) > 1 else 0.0)
+
+
+@pytest.mark.parametrize("capacity, max_length_m", [(16, 1e9), (64, 500.0), (16, 200.0)])
+def test_ship_track_ring_matches_list_reference(track_ns, capacity, max_length_m):
+    track = track_ns["ShipTrack"](capacity=capacity, max_length_m=max_length_m)
+    points = random_track(track_ns, 300)
+    for k, (lat, lon) in enumerate(points):
+        track.append(lat, lon, float(k))
+        if k % 37 == 0 or k == len(points) - 1: # Wrapped many times by the end
+            kept, length = reference_track(track_ns, points[:k + 1], capacity, max_length_m)
+            lats, lons = track.points()
+            np.testing.assert_array_equal(np.column_stack((lats, lons)), np.array(kept))
+            assert len(track) == len(kept) and track.length_m() == pytest.approx(length)
+    assert track.end == len(points) and track.end - track.start <= capacity
+
+
+def test_ship_track_clear_starts_afresh(track_ns):
+    track = track_ns["ShipTrack"](capacity=8, max_length_m=1e9)
+    points = random_track(track_ns, 20, step_m=(10.0, 20.0))
+    for k, (lat, lon) in enumerate(points[:13]):
+        track.append(lat, lon, float(k))
+    version = track.version
+    track.clear()
+    assert len(track) == 0 and track.length_m() == 0.0 and track.version != version
+    assert all(len(level) == 0 for level in track.lod)
+    assert len(track.points()[0]) == len(track.points(100.0)[0]) == 0
+    for k, (lat, lon) in enumerate(points[13:]):
+        track.append(lat, lon, float(k))
+    kept, length = reference_track(track_ns, points[13:], 8, 1e9)
+    np.testing.assert_array_equal(np.column_stack(track.points()), np.array(kept))
+    assert track.length_m() == pytest.approx(length)
+
+
+@pytest.mark.parametrize("max_length_m", [1e9, 3000.0]) # Without and with the start advancing
+def test_ship_track_levels_stay_within_their_tolerance(track_ns, max_length_m):
+    track = track_ns["ShipTrack"](capacity=4096, max_length_m=max_length_m)
+    for k, (lat, lon) in enumerate(random_track(track_ns, 3000, seed=2, step_m=(0.5, 12.0))):
+        track.append(lat, lon, float(k))
+    lats, lons = track.points()
+    base = track_ns["TRACK_LOD_BASE_M"]
+    for tolerance in (base, 8.0, 50.0, 300.0, 2000.0):
+        kept_lats, kept_lons = track.points(tolerance)
+        # Every point is within the level tolerance of the last kept point at or before it
+        kept_at = {(a, b): i for i, (a, b) in enumerate(zip(kept_lats.tolist(), kept_lons.tolist()))}
+        assert (lats[0], lons[0]) in kept_at # The oldest point of the track starts every level
+        level_tolerance = base * 2 ** int(np.log2(tolerance / base))
+        last = None
+        for lat, lon in zip(lats.tolist(), lons.tolist()):
+            if (lat, lon) in kept_at:
+                last = (lat, lon)
+                continue
+            assert np.hypot(*track_ns["geo_to_local_xy"](lat, lon, *last)) <= level_tolerance, tolerance
+        assert tolerance <= 8.0 or len(kept_lats) < len(lats) / 4 # Coarse levels do simplify
+    for level in track.lod: # Points trimmed off the start have left every level
+        assert all(track.start <= number < track.end for number in level)
+
+
+@pytest.fixture(scope="module")
+def clip():
+    return load_sonar(("def clip_polyline_to_circle", "def draw_ship_track"))["clip_polyline_to_circle"]
+
+
+def test_track_clipping_simple_cases(clip):
+    inside = clip(np.array([90.0, 110.0, 100.0]), np.array([100.0, 100.0, 120.0]), 100.0, 100.0, 50.0)
+    assert inside == [[(90.0, 100.0), (110.0, 100.0), (100.0, 120.0)]]
+    chord, = clip(np.array([0.0, 200.0]), np.array([100.0, 100.0]), 100.0, 100.0, 50.0) # Both ends outside
+    assert chord == [pytest.approx((50.0, 100.0)), pytest.approx((150.0, 100.0))]
+    assert clip(np.array([0.0, 200.0]), np.array([0.0, 0.0]), 100.0, 100.0, 50.0) == []
+    out_and_back = clip(np.array([100.0, 300.0, 100.0]), np.array([100.0, 100.0, 110.0]), 100.0, 100.0, 50.0)
+    assert len(out_and_back) == 2
+
+
+def test_track_clipping_matches_sampled_length(clip):
+    rng = np.random.default_rng(5)
+    xs, ys = rng.uniform(-100.0, 300.0, (2, 400)) # Jumps in and out of the ring, chords included
+    runs = clip(xs, ys, 100.0, 100.0, 120.0)
+    assert len(runs) > 50
+    for run in runs:
+        run = np.array(run)
+        assert np.all(np.hypot(run[:, 0] - 100.0, run[:, 1] - 100.0) <= 120.0 + 1e-6)
+    clipped_length = sum(np.hypot(*np.diff(np.array(run), axis=0).T).sum() for run in runs)
+    t = np.linspace(0.0, 1.0, 4001)[:, None]
+    px, py = xs[:-1] + t * np.diff(xs), ys[:-1] + t * np.diff(ys)
+    inside_fraction = (np.hypot(px - 100.0, py - 100.0) <= 120.0).mean(axis=0)
+    assert clipped_length == pytest.approx((inside_fraction * np.hypot(np.diff(xs), np.diff(ys))).sum(), rel=1e-3)
+
+
+def test_markers_survive_fix_loss_and_return(tmp_path):
+    ns = load_sonar("Navigation History Store", "Local Projection Helpers",
+                    ("# --- Target Management System ---", "last_marker_view_key = "),
+                    ("def add_marker_at_cursor", "def restore_stored_marks"))
+    ns.update(current_unit="METERS", current_ship_lat_deg=None, current_ship_lon_deg=None, current_ship_heading=0.0,
+              nav_history=ns["NavHistoryStore"](str(tmp_path / "history.db")))
+    store = ns["target_markers"]
+    view = (400, 400, 300, 600.0) # Centre, radius in pixels and range in metres: 0.5 px/m
+    pose, moved_pose = (43.36, -8.4, 30.0), (43.37, -8.39, 200.0)
+
+    def add_at(x, y):
+        return ns["add_marker_at_cursor"](store, 0, 'target', x, y, 400, 400, 300, 600.0)
+
+    def screen_xy(row, ship_pose):
+        store.reproject(*ship_pose, *view)
+        return store.x[row], store.y[row]
+
+    def stored_marks():
+        return ns["nav_history"].conn.execute("SELECT COUNT(*) FROM marks").fetchone()[0]
+
+    placed_on_screen = add_at(460, 320) # No fix yet
+    ns["lock_screen_markers"](*pose) # Fix acquired
+    assert store.mode[placed_on_screen] == ns["MARKER_MODE_GEO"] and stored_marks() == 1
+    assert screen_xy(placed_on_screen, pose) == pytest.approx((460, 320), abs=1e-6)
+    ns.update(current_ship_lat_deg=pose[0], current_ship_lon_deg=pose[1], current_ship_heading=pose[2])
+    placed_with_fix = add_at(350, 500)
+    assert stored_marks() == 2
+    assert screen_xy(placed_with_fix, pose) == pytest.approx((350, 500), abs=0.05) # geodesic vs local plane
+    geo = {row: store.geo_pos(row) for row in (placed_on_screen, placed_with_fix)}
+
+    store.to_screen(*pose, 400, 400, 0.5) # Fix lost
+    for row, clicked in ((placed_on_screen, (460, 320)), (placed_with_fix, (350, 500))):
+        assert store.mode[row] == ns["MARKER_MODE_SCREEN"]
+        assert store.initial_pos(row) == pytest.approx(clicked, abs=0.05)
+        assert screen_xy(row, (None, None, 0.0)) == pytest.approx(clicked, abs=0.05)
+
+    ns["lock_screen_markers"](*moved_pose) # Fix back somewhere else
+    for row in (placed_on_screen, placed_with_fix):
+        assert store.geo_pos(row) == geo[row] # Stored position back, not re-derived from the new pose
+    assert stored_marks() == 2
+
+
+# --- Sensor selection ---
+@pytest.fixture
+def sensors_ns():
+    return load_sonar("Sensor Selection")
+
+
+def test_preferred_position_source_takes_over_and_fails_over(sensors_ns):
+    sensors = sensors_ns["SensorManager"]()
+    sensors.set_scheme('DATO NAV', 'GPS')
+    stale = sensors_ns["SENSOR_STALE_S"]
+    assert sensors.offer('position', 'GNGGA', 2, 0.0)
+    assert sensors.offer('position', 'GPGGA', 2, 0.5) # GP ranks ahead of GN
+    assert not sensors.offer('position', 'GNGGA', 2, 1.0)
+    assert not sensors.offer('position', 'GNGGA', 2, 0.5 + stale)
+    assert sensors.offer('position', 'GNGGA', 2, 0.6 + stale) # GPGGA silent too long
+    assert sensors.offer('position', 'GPGGA', 2, 1.0 + stale) # and back when it returns
+    assert sensors.selected['position'].address == 'GPGGA'
+
+
+def test_invalid_fix_drops_the_selected_source(sensors_ns):
+    sensors = sensors_ns["SensorManager"]()
+    sensors.set_scheme('DATO NAV', 'GPS')
+    assert sensors.offer('position', 'GPRMC', 2, 0.0)
+    assert not sensors.offer('position', 'GPRMC', 0, 1.0) # Receiver flags the fix as invalid
+    assert sensors.age('position', 1.0) is None
+    assert sensors.offer('position', 'GLGLL', 2, 1.1)
+
+
+def test_gyro_heading_ranks_ahead_of_course_over_ground(sensors_ns):
+    sensors = sensors_ns["SensorManager"]()
+    for speed_course in sensors_ns["SENSOR_HEADING_SENTENCES"]:
+        sensors.set_scheme(speed_course, 'GPS')
+        assert sensors.offer('heading', 'GPVTG', None, 0.0)
+        assert sensors.offer('heading', 'HEHDT', None, 0.1)
+        assert not sensors.offer('heading', 'GPVTG', None, 0.2)
+
+
+# --- Own-ship motion ---
+@pytest.fixture(scope="module")
+def motion_ns():
+    return load_sonar(NMEA_PARSING_SPAN, "Sensor Selection", ("class NmeaState", "# --- NMEA Throughput"),
+                      "Local Projection Helpers", "Own-Ship Motion Estimator")
+
+
+def feed_fixes(ns, bodies_at):
+    """Feeds (t, [sentence bodies]) to a fresh NmeaState and ShipMotionEstimator; returns the estimator."""
+    state, motion = ns["NmeaState"](), ns["ShipMotionEstimator"]()
+    state.sensors.set_scheme('DATO NAV', 'GPS')
+    for t, bodies in bodies_at:
+        for body in bodies:
+            ns["process_nmea_sentence"](ns["build_nmea_sentence"](body), state)
+        motion.observe(t, state)
+    return motion
+
+
+def rmc_body(ns, lat, lon, sog="", cog=""):
+    lat_f, lat_h = ns["format_nmea_lat"](lat)
+    lon_f, lon_h = ns["format_nmea_lon"](lon)
+    return f"GPRMC,120000.00,A,{lat_f},{lat_h},{lon_f},{lon_h},{sog},{cog},191026,,,A"
+
+
+def test_motion_uses_rmc_course_not_heading(motion_ns):
+    # Heading 0 (gyro) but sailing east at 10 kn: the velocity follows the RMC course
+    motion = feed_fixes(motion_ns, [(0.0, ["HEHDT,000.0,T", rmc_body(motion_ns, 43.0, -8.0, "10.0", "090.0")])])
+    assert motion.vx == pytest.approx(10 * 1852 / 3600) and abs(motion.vy) < 1e-9
+    assert motion.predict(0.0)[2] == pytest.approx(0.0)
+
+
+def test_motion_without_course_is_seeded_from_two_fixes(motion_ns):
+    ns = motion_ns
+    lat1, _ = ns["local_xy_to_geo"](0.0, 5.0, 43.0, -8.0) # 5 m north in 1 s
+    motion = feed_fixes(ns, [(0.0, ["HEHDT,270.0,T", rmc_body(ns, 43.0, -8.0)])])
+    assert (motion.vx, motion.vy) == (0.0, 0.0) # Not towards the heading
+    motion = feed_fixes(ns, [(0.0, [rmc_body(ns, 43.0, -8.0)]), (1.0, [rmc_body(ns, lat1, -8.0)])])
+    assert motion.vy == pytest.approx(5.0, abs=0.2) and abs(motion.vx) < 0.2 # RMC keeps 0.0001 min (~0.2 m)